@@ -7,7 +7,7 @@ from wizard import (
     FailureStart, UpdateMagentoCatalogStart, UpdateMagentoCatalog,
     SuccessStart, ExportDataWizardConfigure, ExportDataWizard,
 )
-from channel import Channel, MagentoTier
+from channel import Channel, MagentoTier, TaxMapping
 from party import Party, MagentoWebsiteParty, Address
 from product import (
     Category, MagentoInstanceCategory, Product,
@@ -17,10 +17,12 @@ from country import Country, Subdivision
 from currency import Currency
 from carrier import SaleChannelCarrier
 from sale import (
-    Sale, StockShipmentOut, SaleLine
+    Sale, StockShipmentOut, SaleLine, MagentoOrderStateJournal
 )
-from bom import BOM
+from bom import BOM, BOMInput
 from payment import MagentoPaymentGateway, Payment
+from order_queue import MagentoOrderQueue
+from archive import MagentoPayloadArchive
 
 
 def register():
@@ -30,6 +32,7 @@ def register():
     Pool.register(
         Channel,
         MagentoTier,
+        TaxMapping,
         TestMagentoConnectionStart,
         ImportStoresStart,
         FailureStart,
@@ -52,10 +55,14 @@ def register():
         Sale,
         SaleChannelCarrier,
         SaleLine,
+        MagentoOrderStateJournal,
         BOM,
+        BOMInput,
         ProductSaleChannelListing,
         MagentoPaymentGateway,
         Payment,
+        MagentoOrderQueue,
+        MagentoPayloadArchive,
         module='magento', type_='model'
     )
     Pool.register(
@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
+import xmlrpclib
+from threading import Lock
+
 from magento.api import API
+from magento.utils import expand_url
+
+#: Fault code sent by magento when the session id is no longer valid
+SESSION_EXPIRED = 5
 
 
 class Core(API):
@@ -79,3 +86,161 @@ class OrderConfig(API):
                          ]
         """
         return self.call('sales_order.shipping_methods', [])
+
+
+class PooledSession(object):
+    """
+    A logged in magento XML-RPC session. The server proxy is kept for the
+    lifetime of the session so that its HTTP/1.1 connection is reused for
+    every call made over it.
+    """
+
+    def __init__(self, url, username, password):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.proxy = xmlrpclib.ServerProxy(url, allow_none=True)
+        self.session_id = None
+        #: Set when a call fails for any reason other than a fault, in which
+        #: case the connection cannot be trusted and is not reused.
+        self.broken = False
+
+    def login(self):
+        """
+        Login to magento and remember the session id
+        """
+        self.session_id = self.proxy.login(self.username, self.password)
+        return self.session_id
+
+    def request(self, method, *args):
+        """
+        Call the given method of the XML-RPC server with the session id as
+        the first argument. If magento reports that the session expired, login
+        again and retry once.
+        """
+        if self.session_id is None:
+            self.login()
+        try:
+            try:
+                return getattr(self.proxy, method)(self.session_id, *args)
+            except xmlrpclib.Fault, fault:
+                if fault.faultCode != SESSION_EXPIRED:
+                    raise
+            self.login()
+            return getattr(self.proxy, method)(self.session_id, *args)
+        except xmlrpclib.Fault:
+            raise
+        except Exception:
+            self.broken = True
+            raise
+
+    def close(self):
+        """
+        End the session on magento and close the connection
+        """
+        try:
+            if self.session_id is not None and not self.broken:
+                self.proxy.endSession(self.session_id)
+        except (xmlrpclib.Error, IOError):
+            pass
+        finally:
+            self.session_id = None
+            self.proxy('close')()
+
+
+class PooledClient(object):
+    """
+    Client used by an API instance in place of the XML-RPC server proxy.
+
+    Login takes a session from the pool instead of logging in again and
+    endSession gives it back to the pool, so the API instance can still be
+    used with the `with` statement.
+    """
+
+    def __init__(self, pool, url, username, password, max_size):
+        self.pool = pool
+        self.url = url
+        self.username = username
+        self.password = password
+        self.max_size = max_size
+        self.session = None
+
+    def login(self, username, password):
+        self.session = self.pool.acquire(self.url, username, password)
+        return self.session.session_id or self.session.login()
+
+    def call(self, session_id, resource_path, arguments):
+        return self.session.request('call', resource_path, arguments)
+
+    def multiCall(self, session_id, calls):
+        return self.session.request('multiCall', calls)
+
+    def endSession(self, session_id):
+        session, self.session = self.session, None
+        if session is not None:
+            self.pool.release(session, self.max_size)
+
+
+class SessionPool(object):
+    """
+    Pool of logged in magento sessions.
+
+    Sessions are pooled by URL and credentials, so a session logged in for
+    one resource (Order, Product, Customer, Core...) is reused by every other
+    resource of the same magento instance. At most `max_size` idle sessions
+    are kept for an instance, the others are ended when released.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sessions = {}
+
+    def get_api(self, api_class, url, username, password, max_size=4):
+        """
+        Return an instance of the API class which uses pooled sessions
+
+        :param api_class: Magento API class, like magento.Order
+        :param max_size: Maximum number of idle sessions to keep
+        """
+        api = api_class(url, username, password)
+        api.client = PooledClient(
+            self, expand_url(url, 'xmlrpc'), username, password, max_size
+        )
+        return api
+
+    def acquire(self, url, username, password):
+        """
+        Return an idle session for the instance or a new one
+        """
+        with self.lock:
+            sessions = self.sessions.get((url, username, password))
+            if sessions:
+                return sessions.pop()
+        return PooledSession(url, username, password)
+
+    def release(self, session, max_size):
+        """
+        Give the session back to the pool or end it if the pool is full
+        """
+        if not session.broken:
+            with self.lock:
+                sessions = self.sessions.setdefault(
+                    (session.url, session.username, session.password), []
+                )
+                if len(sessions) < max_size:
+                    sessions.append(session)
+                    return
+        session.close()
+
+    def clear(self):
+        """
+        End all the idle sessions
+        """
+        with self.lock:
+            sessions = [s for v in self.sessions.values() for s in v]
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
+
+
+session_pool = SessionPool()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import json
+import zlib
+import hashlib
+
+from trytond.model import ModelSQL, ModelView, fields
+
+__all__ = ['MagentoPayloadArchive']
+
+
+class MagentoPayloadArchive(ModelSQL, ModelView):
+    """
+    Archive of the data sent by magento for orders, products, customers and
+    categories.
+
+    The last payload received for an entity of a channel is kept compressed,
+    with the hash of its content, so that sales and products can be imported
+    again from the archive without calling magento.
+    """
+    __name__ = 'magento.payload.archive'
+    _rec_name = 'magento_id'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Magento Channel', required=True, readonly=True,
+        select=True, domain=[('source', '=', 'magento')]
+    )
+    kind = fields.Selection([
+        ('order', 'Order'),
+        ('product', 'Product'),
+        ('customer', 'Customer'),
+        ('category', 'Category'),
+    ], 'Kind', required=True, readonly=True, select=True)
+    magento_id = fields.Char(
+        'Magento ID', required=True, readonly=True, select=True,
+        help='Increment ID of the order, SKU of the product or ID of the '
+        'customer or category'
+    )
+    content_hash = fields.Char('Content Hash', required=True, readonly=True)
+    data = fields.Binary('Data', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        """
+        Setup the class before adding to pool
+        """
+        super(MagentoPayloadArchive, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'channel_kind_magento_id_unique',
+                'UNIQUE(channel, kind, magento_id)',
+                'A payload must be archived once for an entity of a channel',
+            )
+        ]
+
+    @staticmethod
+    def get_content_hash(payload):
+        """
+        Return the hash of the content of the payload, which does not depend
+        on the order of the keys of its dictionaries
+        """
+        return hashlib.sha1(json.dumps(payload, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def archive(cls, channel, kind, payloads):
+        """
+        Archive the payloads of the channel, if archiving is enabled on it.
+        Payloads whose content did not change are not written again.
+
+        :param channel: Active record of the magento channel
+        :param kind: 'order', 'product', 'customer' or 'category'
+        :param payloads: Dictionary of payloads by increment id, SKU or ID
+        """
+        if not channel.magento_archive_payloads or not payloads:
+            return
+
+        hashes = dict(
+            (magento_id, cls.get_content_hash(payload))
+            for magento_id, payload in payloads.iteritems()
+        )
+
+        def get_data(magento_id):
+            return buffer(zlib.compress(json.dumps(payloads[magento_id])))
+
+        existing = {}
+        for record in cls.search([
+            ('channel', '=', channel.id),
+            ('kind', '=', kind),
+            ('magento_id', 'in', payloads.keys()),
+        ]):
+            existing[record.magento_id] = record
+
+        to_write = []
+        to_create = []
+        for magento_id, content_hash in hashes.iteritems():
+            record = existing.get(magento_id)
+            if record is None:
+                to_create.append({
+                    'channel': channel.id,
+                    'kind': kind,
+                    'magento_id': magento_id,
+                    'content_hash': content_hash,
+                    'data': get_data(magento_id),
+                })
+            elif record.content_hash != content_hash:
+                to_write.extend([[record], {
+                    'content_hash': content_hash,
+                    'data': get_data(magento_id),
+                }])
+        if to_create:
+            cls.create(to_create)
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def load(cls, channel, kind, magento_ids=None):
+        """
+        Return the archived payloads of the channel
+
+        :param channel: Active record of the magento channel
+        :param kind: 'order', 'product', 'customer' or 'category'
+        :param magento_ids: List of increment ids, SKUs or IDs, all if None
+        :return: Dictionary of payloads by increment id, SKU or ID
+        """
+        domain = [
+            ('channel', '=', channel.id),
+            ('kind', '=', kind),
+        ]
+        if magento_ids is not None:
+            domain.append(('magento_id', 'in', magento_ids))
+
+        return dict(
+            (record.magento_id, json.loads(zlib.decompress(str(record.data))))
+            for record in cls.search(domain, order=[('id', 'ASC')])
+        )
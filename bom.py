@@ -1,15 +1,65 @@
 # -*- coding: utf-8 -*-
+import hashlib
+from collections import defaultdict
+
+from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
 
 
-__all__ = ['BOM']
+__all__ = ['BOM', 'BOMInput']
 __metaclass__ = PoolMeta
 
+#: Digits to which the quantities of the inputs of a BoM are rounded in its
+#: signature, magento sends quantities with 4 decimals
+SIGNATURE_DIGITS = 4
+
 
 class BOM:
     "Bill of Material"
     __name__ = 'production.bom'
 
+    magento_signature = fields.Char(
+        'Magento Signature', readonly=True, select=True,
+        help='Hash of the sorted inputs of the BoM, used to find the BoM '
+        'matching the components of a magento bundle'
+    )
+
+    @staticmethod
+    def get_magento_signature(inputs):
+        """
+        Return the canonical signature of a list of BoM inputs. Quantities
+        of the same product are added up and rounded, and the inputs are
+        sorted, so that the signature does not depend on the order of the
+        inputs or on float rounding.
+
+        :param inputs: List of tuples of product id and quantity
+        :return: Signature as an hexadecimal string
+        """
+        quantities = defaultdict(float)
+        for product_id, quantity in inputs:
+            quantities[product_id] += quantity
+
+        return hashlib.sha1(';'.join(
+            '%d:%.*f' % (product_id, SIGNATURE_DIGITS, quantities[product_id])
+            for product_id in sorted(quantities)
+        )).hexdigest()
+
+    @classmethod
+    def update_magento_signature(cls, boms):
+        """
+        Store the signature of the inputs of the given BoMs
+        """
+        to_write = []
+        for bom in boms:
+            signature = cls.get_magento_signature([
+                (input.product.id, input.quantity)
+                for input in bom.inputs
+            ])
+            if bom.magento_signature != signature:
+                to_write.extend([[bom], {'magento_signature': signature}])
+        if to_write:
+            cls.write(*to_write)
+
     @classmethod
     def identify_boms_from_magento_data(cls, order_data):
         """
@@ -46,12 +96,13 @@ class BOM:
         return bundles
 
     @classmethod
-    def find_or_create_bom_for_magento_bundle(cls, order_data):
+    def find_or_create_bom_for_magento_bundle(cls, order_data, products=None):
         """
         Find or create a BoM for bundle product from the data sent in
         magento order
 
         :param order_data: Order Data from magento
+        :param products: Dictionary of products already resolved by SKU
         :return: Found or created BoM's active record
         """
         ProductBom = Pool().get('product.product-production.bom')
@@ -64,9 +115,11 @@ class BOM:
 
         channel = Channel.get_current_magento_channel()
 
+        def get_product(sku):
+            return (products or {}).get(sku) or channel.get_product(sku)
+
         for item_id, data in identified_boms.iteritems():
-            bundle_product = \
-                channel.get_product(data['bundle']['sku'])
+            bundle_product = get_product(data['bundle']['sku'])
 
             # It contains a list of tuples, in which the first element is the
             # product's active record and second is its quantity in the BoM
@@ -74,35 +127,44 @@ class BOM:
             for each in data['components']:
                 if each['product_type'] not in ('virtual', 'downloadable'):
                     child_products.append((
-                        channel.get_product(
-                            each['sku']
-                        ), (
+                        get_product(each['sku']), (
                             float(each['qty_ordered']) /
                             float(data['bundle']['qty_ordered'])
                         )
                     ))
 
-            # Here we match the sets of BoM components for equality
-            # Each set contains tuples of product and quantity of that
-            # product in the BoM
-            # If everything for a BoM matches, then we dont create a new one
-            # and use this BoM itself
-            # XXX This might eventually have issues because of rounding
-            # in quantity
-            for product_bom in bundle_product.boms:
-                existing_bom_set = set([
-                    (input.product.id, input.quantity)
-                    for input in product_bom.bom.inputs
+            # The BoM whose inputs match the components is found with its
+            # signature. BoMs stored before the signature existed get theirs
+            # on the first lookup of their bundle.
+            signature = cls.get_magento_signature([
+                (product.id, quantity) for product, quantity in child_products
+            ])
+            domain = [('product', '=', bundle_product.id)]
+            product_boms = ProductBom.search(
+                domain + [('bom.magento_signature', '=', signature)], limit=1
+            )
+            if not product_boms:
+                boms_to_sign = cls.search([
+                    ('magento_signature', '=', None),
+                    ('id', 'in', [
+                        product_bom.bom.id
+                        for product_bom in ProductBom.search(domain)
+                    ]),
                 ])
-                new_bom_set = set([
-                    (product.id, qty) for product, qty in child_products
-                ])
-                if existing_bom_set == new_bom_set:
-                    break
+                if boms_to_sign:
+                    cls.update_magento_signature(boms_to_sign)
+                    product_boms = ProductBom.search(
+                        domain + [('bom.magento_signature', '=', signature)],
+                        limit=1
+                    )
+
+            if product_boms:
+                product_bom, = product_boms
             else:
                 # No matching BoM found, create a new one
                 bom, = cls.create([{
                     'name': bundle_product.name,
+                    'magento_signature': signature,
                     'inputs': [('create', [{
                         'uom': channel.default_uom,
                         'product': product.id,
@@ -115,9 +177,50 @@ class BOM:
                     }])]
                 }])
 
-                product_bom = ProductBom.create([{
+                product_bom, = ProductBom.create([{
                     'product': bundle_product.id,
                     'bom': bom.id,
                 }])
 
         return product_bom
+
+
+class BOMInput:
+    """
+    Bill of Material Input
+
+    The magento signature of the BoMs is updated whenever their inputs are
+    created, written or deleted.
+    """
+    __name__ = 'production.bom.input'
+
+    @classmethod
+    def create(cls, vlist):
+        BOM = Pool().get('production.bom')
+
+        inputs = super(BOMInput, cls).create(vlist)
+        BOM.update_magento_signature(
+            BOM.browse(list(set(input.bom.id for input in inputs)))
+        )
+        return inputs
+
+    @classmethod
+    def write(cls, *args):
+        BOM = Pool().get('production.bom')
+
+        bom_ids = set()
+        for inputs in args[::2]:
+            bom_ids.update(input.bom.id for input in inputs)
+        super(BOMInput, cls).write(*args)
+        # Inputs may have been moved to another BoM
+        for inputs in args[::2]:
+            bom_ids.update(input.bom.id for input in cls.browse(inputs))
+        BOM.update_magento_signature(BOM.browse(list(bom_ids)))
+
+    @classmethod
+    def delete(cls, inputs):
+        BOM = Pool().get('production.bom')
+
+        bom_ids = list(set(input.bom.id for input in inputs))
+        super(BOMInput, cls).delete(inputs)
+        BOM.update_magento_signature(BOM.browse(bom_ids))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+
+from trytond.cache import LRUDict
+
+__all__ = ['import_cache']
+
+
+class ImportCache(threading.local):
+    """
+    Cache of the records resolved from magento codes and ids during an
+    import run.
+
+    Every order of an import looks up the same currencies, countries,
+    subdivisions, customers and addresses again. While the cache is active,
+    the ids of the records found are kept in one store per model, bounded
+    to `size` entries each, dropping the least recently used first.
+
+    The cache is only active inside an `activate` block and is emptied at
+    the end of the outermost one. It is local to the thread, so that import
+    workers each have their own. Models invalidate their store on writes.
+    """
+    size = 1024
+
+    def __init__(self):
+        self.depth = 0
+        self.stores = {}
+
+    @contextmanager
+    def activate(self):
+        """
+        Activate the cache for the duration of the block
+        """
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.stores = {}
+
+    def get(self, name, key):
+        """
+        Return the value cached for the key in the named store
+
+        :param name: Name of the store, usually the name of the model
+        :param key: Key of the lookup
+        :return: Cached value or raises KeyError if not cached
+        """
+        store = self.stores.get(name)
+        if store is None:
+            raise KeyError(key)
+        value = store.pop(key)
+        store[key] = value
+        return value
+
+    def set(self, name, key, value):
+        """
+        Cache the value for the key in the named store, if the cache is
+        active
+
+        :param name: Name of the store, usually the name of the model
+        :param key: Key of the lookup
+        :param value: Value to cache, like the id of the record found
+        """
+        if not self.depth:
+            return
+        store = self.stores.get(name)
+        if store is None:
+            store = self.stores[name] = LRUDict(self.size)
+        store[key] = value
+
+    def invalidate(self, name=None):
+        """
+        Empty the named store, or every store if no name is given
+        """
+        if name is None:
+            self.stores = {}
+        else:
+            self.stores.pop(name, None)
+
+
+import_cache = ImportCache()
@@ -6,15 +6,25 @@ import magento
 import logging
 import xmlrpclib
 import socket
+import threading
+import traceback
+import Queue
 
+from sql import Null, Literal
+from sql.conditionals import Coalesce
+from sql.operators import Concat
+
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.model import ModelView, ModelSQL, fields
-from .api import OrderConfig
+from trytond.rpc import RPC
+from .api import OrderConfig, session_pool
+from .cache import import_cache
 
 __metaclass__ = PoolMeta
-__all__ = ['Channel', 'MagentoTier']
+__all__ = ['Channel', 'MagentoTier', 'TaxMapping']
 
 MAGENTO_STATES = {
     'invisible': ~(Eval('source') == 'magento'),
@@ -101,6 +111,96 @@ class Channel:
         'magento.instance.payment_gateway', 'channel', 'Payments',
     )
 
+    magento_session_pool_size = fields.Integer(
+        'API Session Pool Size', required=True,
+        help='Maximum number of idle magento API sessions kept logged in '
+        'for reuse by later API calls of this channel.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
+    #: Checking this will import orders one page at a time and commit the
+    #: transaction after each page, so that an interrupted import resumes
+    #: from the last completed page.
+    magento_stream_order_import = fields.Boolean(
+        'Stream Order Import', help='Checking this will commit the imported '
+        'orders after every page fetched from magento. An interrupted import '
+        'resumes from the last completed page instead of the first one.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_page = fields.Integer(
+        'Last Imported Order Page', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_checkpoint = fields.DateTime(
+        'Order Import Checkpoint', readonly=True,
+        help='Start time of an unfinished order import',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_import_overlap = fields.Integer(
+        'Order Import Overlap', required=True,
+        help='Number of minutes before the last order import time from '
+        'which orders are searched again, to allow for clock differences '
+        'between Tryton and Magento.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_resync_days = fields.Integer(
+        'Order Resync Window', required=True,
+        help='Number of days of orders imported by a full resync or when no '
+        'orders have been imported yet.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_defer_order_processing = fields.Boolean(
+        'Defer Order Processing', help='Checking this will import orders in '
+        'draft and leave their processing to the state of the order on '
+        'magento to the cron processing imported orders in bulk.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_merge_guest_customers = fields.Boolean(
+        'Merge Guest Customers', help='Checking this will import the orders '
+        'of guest customers with the same email to a single party, instead '
+        'of creating a new party for every guest order.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_import_workers = fields.Integer(
+        'Order Import Workers', required=True,
+        help='Number of orders created at the same time, each in its own '
+        'transaction, when importing orders with streaming enabled or from '
+        'the cron. This is not supported on SQLite, where orders are always '
+        'created one by one.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_queue_order_import = fields.Boolean(
+        'Queue Order Import', help='Checking this will queue the orders '
+        'found by the order import before importing them, like the orders '
+        'pushed by magento. Orders failing to import are retried later by '
+        'the cron processing the order queue.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_archive_payloads = fields.Boolean(
+        'Archive Payloads', help='Checking this will keep the data of the '
+        'orders and products fetched from magento, so that they can be '
+        'imported again from the archive without calling magento.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_full_inventory_push_interval = fields.Integer(
+        'Full Inventory Push Interval', required=True,
+        help='Number of hours after which the inventory export sends the '
+        'inventory of every listing again, instead of only the listings '
+        'whose inventory changed since the last push. Zero disables the '
+        'periodic full push.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_last_full_inventory_push = fields.DateTime(
+        'Last Full Inventory Push', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_status_updated_at = fields.DateTime(
+        'Last Order Status Update', readonly=True,
+        help='Start time of the last order status update. Only the orders '
+        'updated on magento since then are fetched by the next update.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -120,7 +220,12 @@ class Channel:
             "multiple_channels": 'Selected operation can be done only for one'
                 ' channel at a time',
             'invalid_magento_channel':
-                'Current channel does not belongs to Magento !'
+                'Current channel does not belongs to Magento !',
+            'payload_not_archived':
+                'No data of %s "%s" is archived for this channel',
+        })
+        cls.__rpc__.update({
+            'push_magento_orders': RPC(readonly=False, instantiate=0),
         })
         cls._buttons.update({
             'import_magento_carriers': {
@@ -128,7 +233,10 @@ class Channel:
             },
             'configure_magento_connection': {
                 'invisible': Eval('source') != 'magento'
-            }
+            },
+            'reimport_from_magento_archive': {
+                'invisible': ~Eval('magento_archive_payloads'),
+            },
         })
 
     def validate_magento_channel(self):
@@ -154,6 +262,41 @@ class Channel:
         """
         return 'mag_'
 
+    @staticmethod
+    def default_magento_session_pool_size():
+        """
+        Sets default size of the pool of magento API sessions
+        """
+        return 4
+
+    @staticmethod
+    def default_magento_order_import_overlap():
+        """
+        Sets default overlap of order imports in minutes
+        """
+        return 10
+
+    @staticmethod
+    def default_magento_order_resync_days():
+        """
+        Sets default number of days of orders imported by a full resync
+        """
+        return 30
+
+    @staticmethod
+    def default_magento_import_workers():
+        """
+        Sets default number of workers importing orders
+        """
+        return 1
+
+    @staticmethod
+    def default_magento_full_inventory_push_interval():
+        """
+        Sets default number of hours between full inventory pushes
+        """
+        return 24
+
     @staticmethod
     def default_magento_root_category_id():
         """
@@ -173,10 +316,7 @@ class Channel:
 
         with Transaction().set_context({'current_channel': self.id}):
             # Import order states
-            with OrderConfig(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as order_config_api:
+            with self.get_magento_api(OrderConfig) as order_config_api:
                 order_states_data = order_config_api.get_states()
                 for code, name in order_states_data.iteritems():
                     self.create_order_state(code, name)
@@ -191,6 +331,24 @@ class Channel:
         """
         pass
 
+    def get_magento_api(self, api_class):
+        """
+        Return an instance of the given magento API class for this channel.
+
+        The instance is used with the `with` statement just like the API
+        class itself, but instead of logging in to magento every time, it
+        takes a logged in session from the pool of sessions of this magento
+        instance and gives it back at the end of the block. Expired sessions
+        are logged in again transparently.
+
+        :param api_class: Magento API class, e.g. magento.Order
+        :return: Instance of api_class
+        """
+        return session_pool.get_api(
+            api_class, self.magento_url, self.magento_api_user,
+            self.magento_api_key, self.magento_session_pool_size or 1
+        )
+
     def test_magento_connection(self):
         """
         Test magento connection and display appropriate message to user
@@ -234,10 +392,7 @@ class Channel:
             assert channel.source == 'magento'
 
             with Transaction().set_context({'current_channel': channel.id}):
-                with OrderConfig(
-                    channel.magento_url, channel.magento_api_user,
-                    channel.magento_api_key
-                ) as order_config_api:
+                with channel.get_magento_api(OrderConfig) as order_config_api:
                     carriers_data = order_config_api.get_shipping_methods()
 
             carriers = []
@@ -271,9 +426,7 @@ class Channel:
         self.import_category_tree()
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Product(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as product_api:
+            with self.get_magento_api(magento.Product) as product_api:
                 # TODO: Implement pagination and import each product as async
                 # task
                 magento_products = product_api.list()
@@ -292,6 +445,7 @@ class Channel:
         """
         Product = Pool().get('product.product')
         Listing = Pool().get('product.product.channel_listing')
+        Archive = Pool().get('magento.payload.archive')
 
         if self.source != 'magento':
             return super(Channel, self).import_product(sku, product_data)
@@ -313,16 +467,22 @@ class Channel:
 
         if not products or not listings:
             # Either way we need the product data from magento. Make that
-            # dreaded API call.
-            with magento.Product(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as product_api:
-                product_data = product_api.info(sku, identifierType="sku")
+            # dreaded API call, unless the data is given.
+            if product_data is None and \
+                    Transaction().context.get('magento_archive_only'):
+                product_data = Archive.load(self, 'product', [sku]).get(sku)
+                if product_data is None:
+                    self.raise_user_error(
+                        'payload_not_archived', ('product', sku)
+                    )
+            elif product_data is None:
+                with self.get_magento_api(magento.Product) as product_api:
+                    product_data = product_api.info(sku, identifierType="sku")
+                Archive.archive(self, 'product', {sku: product_data})
 
-                # XXX: sanitize product_data, sometimes product sku may
-                # contain trailing spaces
-                product_data['sku'] = product_data['sku'].strip()
+            # XXX: sanitize product_data, sometimes product sku may
+            # contain trailing spaces
+            product_data['sku'] = product_data['sku'].strip()
 
             # Create a product since there is no match for an existing
             # product with the SKU.
@@ -338,6 +498,97 @@ class Channel:
 
         return product
 
+    def import_products_using_skus(self, skus):
+        """
+        Find or import the products of the given SKUs in bulk.
+
+        The products and listings of all the SKUs are searched at once, and
+        the data of the ones missing is fetched from magento with a single
+        multicall. SKUs which could not be fetched are left out, so that
+        `get_product` raises the fault of magento for them.
+
+        :param skus: List of SKUs, like those of the items of an order
+        :return: Dictionary of active records of products by SKU
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+        Archive = Pool().get('magento.payload.archive')
+
+        skus = [
+            sku for index, sku in enumerate(skus)
+            if sku and sku not in skus[:index]
+        ]
+        if not skus:
+            return {}
+
+        # Product codes are matched case insensitively like import_product
+        products_by_code = {}
+        for product in Product.search([
+            ['OR'] + [('code', 'ilike', sku.strip()) for sku in skus],
+        ], order=[('id', 'ASC')]):
+            products_by_code.setdefault(product.code.lower(), product)
+        listed_codes = set(
+            listing.product.code for listing in Listing.search([
+                ('product.code', 'in', [sku.strip() for sku in skus]),
+                ('channel', '=', self.id),
+            ])
+        )
+
+        products = {}
+        missing = []
+        for sku in skus:
+            product = products_by_code.get(sku.strip().lower())
+            if product and sku.strip() in listed_codes:
+                products[sku] = product
+            else:
+                missing.append(sku)
+
+        if missing and Transaction().context.get('magento_archive_only'):
+            archived = Archive.load(
+                self, 'product', [sku.strip() for sku in missing]
+            )
+            for sku in missing:
+                if sku.strip() in archived:
+                    products[sku] = self.import_product(
+                        sku, archived[sku.strip()]
+                    )
+        elif missing:
+            with self.get_magento_api(magento.Product) as product_api:
+                products_data = product_api.multiCall([
+                    ['catalog_product.info', [sku.strip(), None, None, 'sku']]
+                    for sku in missing
+                ])
+            products_data = [
+                (sku, product_data)
+                for sku, product_data in zip(missing, products_data)
+                if not product_data.get('isFault')
+            ]
+            Archive.archive(self, 'product', dict(
+                (sku.strip(), product_data)
+                for sku, product_data in products_data
+            ))
+            for sku, product_data in products_data:
+                products[sku] = self.import_product(sku, product_data)
+
+        return products
+
+    def get_tax(self, name, rate):
+        """
+        Return the tax mapped to the name and rate. Taxes found during an
+        import run are cached, so that every distinct rate is searched once.
+        """
+        Tax = Pool().get('account.tax')
+
+        key = (self.id, name, rate)
+        try:
+            return Tax(import_cache.get('sale.channel.tax', key))
+        except KeyError:
+            pass
+
+        tax = super(Channel, self).get_tax(name, rate)
+        import_cache.set('sale.channel.tax', key, tax.id)
+        return tax
+
     def import_category_tree(self):
         """
         Imports the category tree and creates categories in a hierarchy same as
@@ -350,10 +601,7 @@ class Channel:
         self.validate_magento_channel()
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Category(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as category_api:
+            with self.get_magento_api(magento.Category) as category_api:
                 category_tree = category_api.tree(
                     self.magento_root_category_id
                 )
@@ -363,37 +611,70 @@ class Channel:
         """
         Downstream implementation of channel.import_orders
 
+        Only the orders updated since the last order import time (less the
+        overlap configured on the channel) are imported. The last order
+        import time is advanced to the start of this import only once every
+        page is imported.
+
+        Orders are fetched and imported one page at a time, so only the
+        current page of order summaries is held in memory. If streaming is
+        enabled on the channel, the transaction is committed after each page
+        and an interrupted import resumes from the last completed page.
+
+        Pages of the search have no guaranteed order and move when orders
+        leave the search meanwhile, so a resumed import may miss orders. It
+        does not advance the last order import time, and the next import
+        searches from the same time again.
+
+        If queuing is enabled on the channel, the orders found are queued and
+        the queue is processed once every page is fetched.
+
         :return: List of active record of sale imported
         """
+        Sale = Pool().get('sale.sale')
+        OrderQueue = Pool().get('magento.order.queue')
+
         if self.source != 'magento':
             return super(Channel, self).import_orders()
 
-        # Last one month order
-        updated_at_min = datetime.now() - relativedelta(days=30)
-        new_sales = []
-        with Transaction().set_context({'current_channel': self.id}):
+        resumed = bool(self.magento_order_import_checkpoint)
+        if resumed:
+            # Resume the unfinished import
+            import_started = self.magento_order_import_checkpoint
+            page = (self.magento_order_import_page or 0) + 1
+        else:
+            import_started = datetime.utcnow()
+            page = 1
+
+        if self.last_order_import_time:
+            updated_at_min = self.last_order_import_time - relativedelta(
+                minutes=self.magento_order_import_overlap or 0
+            )
+        else:
+            updated_at_min = import_started - relativedelta(
+                days=self.magento_order_resync_days
+            )
+
+        sale_ids = []
+        with Transaction().set_context({'current_channel': self.id}), \
+                import_cache.activate():
             order_states = self.get_order_states_to_import()
             order_states_to_import_in = map(
                 lambda state: state.code, order_states
             )
 
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
-                # Filter orders store_id using list()
+            with self.get_magento_api(magento.Order) as order_api:
+                # Filter orders store_id using search()
                 # then get info of each order using info()
                 # and call find_or_create_using_magento_data on sale
                 filter = {
                     'store_id': {'=': self.magento_store_id},
                     'state': {'in': order_states_to_import_in},
-                    'updated_at': {'gteq': updated_at_min.isoformat(' ')},
+                    'updated_at': {
+                        'gteq': updated_at_min.strftime('%Y-%m-%d %H:%M:%S')
+                    },
                 }
-                self.write([self], {
-                    'last_order_import_time': datetime.utcnow()
-                })
-                page = 1
                 has_next = True
-                orders_summaries = []
                 while has_next:
                     # XXX: Pagination is only available in
                     # magento extension >= 1.6.1
@@ -401,12 +682,71 @@ class Channel:
                         filters=filter, limit=3000, page=page
                     )
                     has_next = api_res['hasNext']
+
+                    if self.magento_queue_order_import:
+                        OrderQueue.enqueue(self, api_res['items'])
+                    else:
+                        sale_ids.extend(map(int, self.import_bulk_orders(
+                            api_res['items'], order_api
+                        )))
+
+                    if has_next and self.magento_stream_order_import:
+                        self.checkpoint_order_import(page, import_started)
                     page += 1
-                    orders_summaries.extend(api_res['items'])
 
-                for order_summary in orders_summaries:
-                    new_sales.append(self.import_order(order_summary))
-        return new_sales
+        self.checkpoint_order_import(None, import_started, resumed)
+
+        if self.magento_queue_order_import:
+            sale_ids.extend(map(int, self.process_magento_order_queue(None)))
+
+        return Sale.browse(sale_ids)
+
+    def resync_orders(self, days=None):
+        """
+        Import all the orders updated in the last given number of days,
+        whatever the last order import time is.
+
+        :param days: Number of days, defaults to the resync window of the
+                     channel
+        :return: List of active record of sale imported
+        """
+        if days is None:
+            days = self.magento_order_resync_days
+
+        self.write([self], {
+            'last_order_import_time':
+                datetime.utcnow() - relativedelta(days=days),
+            'magento_order_import_page': None,
+            'magento_order_import_checkpoint': None,
+        })
+        return self.import_orders()
+
+    def checkpoint_order_import(self, page, import_started, resumed=False):
+        """
+        Record the progress of an order import. When streaming is enabled on
+        the channel, the transaction is committed so that the orders imported
+        so far survive a crash of the current run.
+
+        :param page: Number of the last imported page, or None when all the
+                     pages are imported, in which case the last order import
+                     time is advanced to the start of the import
+        :param import_started: Time at which the import started
+        :param resumed: True if the import resumed an unfinished one, in
+                        which case the last order import time is left as it
+                        is once all the pages are imported
+        """
+        values = {
+            'magento_order_import_page': page,
+            'magento_order_import_checkpoint': import_started,
+        }
+        if page is None:
+            values['magento_order_import_checkpoint'] = None
+            if not resumed:
+                values['last_order_import_time'] = import_started
+        self.write([self], values)
+
+        if self.magento_stream_order_import:
+            Transaction().cursor.commit()
 
     def import_order(self, order_info):
         "Downstream implementation to import sale order from magento"
@@ -420,42 +760,504 @@ class Channel:
             return sale
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+            with self.get_magento_api(magento.Order) as order_api:
                 order_data = order_api.info(order_info['increment_id'])
                 return Sale.create_using_magento_data(order_data)
 
-    def export_order_status(self):
+    def import_bulk_orders(self, order_infos, order_api=None):
+        """
+        Import orders from magento in bulk.
+
+        Orders which are already imported are filtered out with a single
+        search and the rest are fetched in batches using info_multi over one
+        session, instead of a login and a call for every order. The
+        customers of the orders are then found or created all at once,
+        before the sales are created.
+
+        Orders which magento fails to send are queued in the order queue, so
+        that they are retried later even though the last order import time
+        moves past them.
+
+        :param order_infos: List of order summaries from magento, each having
+                            the order_id and increment_id of the order
+        :param order_api: Open magento.Order API to reuse, if any
+        :return: List of active records of sales found or created
+        """
+        Sale = Pool().get('sale.sale')
+        Party = Pool().get('party.party')
+        OrderQueue = Pool().get('magento.order.queue')
+
+        if not order_infos:
+            return []
+
+        if order_api is None:
+            with self.get_magento_api(magento.Order) as order_api:
+                return self.import_bulk_orders(order_infos, order_api)
+
+        sales_by_magento_id = dict(
+            (sale.magento_id, sale) for sale in Sale.search([
+                ('magento_id', 'in', [
+                    int(order_info['order_id']) for order_info in order_infos
+                ]),
+                ('channel', '=', self.id),
+            ])
+        )
+
+        increment_ids = []
+        for order_info in order_infos:
+            if int(order_info['order_id']) in sales_by_magento_id or \
+                    order_info['increment_id'] in increment_ids:
+                continue
+            increment_ids.append(order_info['increment_id'])
+
+        orders_data = []
+        faults = {}
+        for increment_ids_batch in batch(increment_ids, 50):
+            for i, order_data in enumerate(
+                    order_api.info_multi(increment_ids_batch)):
+                if order_data.get('isFault'):
+                    faults[increment_ids_batch[i]] = "%s %s" % (
+                        order_data['faultCode'], order_data['faultMessage']
+                    )
+                    continue
+                orders_data.append(order_data)
+
+        if faults:
+            # Retried by the cron processing the order queue
+            for entry in OrderQueue.enqueue(self, [
+                {'increment_id': increment_id} for increment_id in faults
+            ]):
+                logger.warning("Order %s: %s, queued for a retry" % (
+                    entry.increment_id, faults[entry.increment_id]
+                ))
+                OrderQueue.write([entry], {
+                    'error': faults[entry.increment_id],
+                })
+
+        with Transaction().set_context({'current_channel': self.id}), \
+                import_cache.activate():
+            # Create the customers of all the orders before any sale
+            Party.find_or_create_all_using_magento_ids([
+                order_data['customer_id'] for order_data in orders_data
+            ])
+
+            if self.magento_import_workers > 1 and \
+                    backend.name() != 'sqlite' and \
+                    self.may_commit_order_import():
+                sales = self.import_orders_in_parallel(orders_data)
+            else:
+                sales = []
+                for orders_batch in batch(orders_data, 50):
+                    sales.extend(
+                        Sale.create_bulk_using_magento_data(orders_batch)
+                    )
+        for sale in sales:
+            sales_by_magento_id[sale.magento_id] = sale
+
+        sales = []
+        for order_info in order_infos:
+            sale = sales_by_magento_id.pop(int(order_info['order_id']), None)
+            if sale:
+                sales.append(sale)
+        return sales
+
+    @classmethod
+    def import_orders_using_cron(cls):
+        """
+        Import orders using cron. The import runs in its own transaction, so
+        it may commit the orders as they are imported.
+        """
+        with Transaction().set_context(magento_commit_order_import=True):
+            return super(Channel, cls).import_orders_using_cron()
+
+    def may_commit_order_import(self):
+        """
+        Return True if the order import may commit the current transaction
+        before it is over, which is the case when streaming is enabled on
+        the channel or when the import is run by the cron.
+        """
+        return bool(
+            self.magento_stream_order_import or
+            Transaction().context.get('magento_commit_order_import')
+        )
+
+    def prepare_orders_for_parallel_import(self, orders_data):
+        """
+        Find or create the records shared between orders, like customers,
+        addresses, products and BoMs, before the orders are fanned out to
+        the import workers. Nothing prevents concurrent workers from
+        creating them twice.
+
+        Parties of guests are only prepared when guests are merged, as every
+        guest order gets its own party otherwise.
+
+        :param orders_data: List of order data from magento
+        """
+        Sale = Pool().get('sale.sale')
+        Address = Pool().get('party.address')
+        Bom = Pool().get('production.bom')
+
+        products = self.import_products_using_skus(sum([
+            Sale.get_skus_using_magento_data(order_data)
+            for order_data in orders_data
+        ], []))
+        for order_data in orders_data:
+            if order_data['customer_id'] or \
+                    self.magento_merge_guest_customers:
+                party = Sale.get_party_using_magento_data(order_data)
+                for address_data in (
+                        order_data['billing_address'],
+                        order_data['shipping_address']):
+                    if address_data:
+                        Address.find_or_create_for_party_using_magento_data(
+                            party, address_data
+                        )
+            Bom.find_or_create_bom_for_magento_bundle(order_data, products)
+
+    def import_orders_in_parallel(self, orders_data):
+        """
+        Create sales for the given orders using a pool of worker threads.
+
+        Every worker has its own transaction and cursor, and commits each
+        sale as soon as it is created, so a bad order or a lock wait only
+        holds up the worker processing it. The records shared between orders
+        are created beforehand, and orders imported meanwhile by another run
+        are caught by the unique constraint on the magento id of sales.
+        Orders failing on a lock timeout or a deadlock are tried once more,
+        and orders which still fail are recorded as channel exceptions.
+
+        The current transaction is committed before and after the import, so
+        this must only be used when `may_commit_order_import` allows it.
+
+        :param orders_data: List of order data from magento
+        :return: List of active records of sales created
+        """
+        Sale = Pool().get('sale.sale')
+
+        transaction = Transaction()
+        context = transaction.context.copy()
+        context['current_channel'] = self.id
+
+        self.prepare_orders_for_parallel_import(orders_data)
+
+        orders_queue = Queue.Queue()
+        for order_data in orders_data:
+            orders_queue.put((order_data, 1))
+
+        # Workers only see committed data, and this transaction only sees
+        # the sales committed by workers once it starts a new snapshot
+        transaction.cursor.commit()
+
+        sale_ids = []
+        workers = [
+            threading.Thread(
+                target=self.import_orders_worker, args=(
+                    transaction.cursor.database_name, transaction.user,
+                    context, orders_queue, sale_ids
+                )
+            ) for _ in range(min(self.magento_import_workers,
+                                 len(orders_data)))
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        transaction.cursor.commit()
+
+        return Sale.browse(sale_ids)
+
+    @classmethod
+    def import_orders_worker(
+        cls, database_name, user, context, orders_queue, sale_ids
+    ):
+        """
+        Create sales for the orders in the queue until it is empty, each one
+        in its own committed transaction.
+
+        :param database_name: Name of the database to connect to
+        :param user: ID of the user to run the import as
+        :param context: Context of the transaction, with the current_channel
+        :param orders_queue: Queue of (order data, attempt) pairs
+        :param sale_ids: List to which the ids of created sales are appended
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        with Transaction().start(database_name, user, context=context), \
+                import_cache.activate():
+            Sale = Pool().get('sale.sale')
+            ChannelException = Pool().get('channel.exception')
+
+            cursor = Transaction().cursor
+            while True:
+                try:
+                    order_data, attempt = orders_queue.get_nowait()
+                except Queue.Empty:
+                    break
+
+                try:
+                    sale = Sale.create_using_magento_data(order_data)
+                    cursor.commit()
+                except Exception, exception:
+                    error = traceback.format_exc()
+                    cursor.rollback()
+                    # Records cached since the last commit are gone
+                    import_cache.invalidate()
+                    try:
+                        # The order may have been imported by another worker
+                        # or run, which is refused by the unique constraint
+                        sale = Sale.find_using_magento_data(order_data)
+                        if not sale and attempt < 2 and isinstance(
+                                exception, DatabaseOperationalError):
+                            # Give a lock timeout or a deadlock another go
+                            orders_queue.put((order_data, attempt + 1))
+                            continue
+                        if not sale:
+                            ChannelException.create([{
+                                'log': "Error occurred on importing order "
+                                    "%s.\nError Message: %s" % (
+                                        order_data['increment_id'], error
+                                    ),
+                                'channel': context['current_channel'],
+                            }])
+                            cursor.commit()
+                            continue
+                    except Exception:
+                        # The worker must go on with the other orders
+                        cursor.rollback()
+                        import_cache.invalidate()
+                        logger.exception(
+                            "Order %s: import failure could not be "
+                            "recorded" % order_data['increment_id']
+                        )
+                        continue
+                if sale:
+                    sale_ids.append(sale.id)
+
+    @classmethod
+    @ModelView.button
+    def reimport_from_magento_archive(cls, channels):
+        """
+        Import again the products and orders archived for the channels
+
+        :param channels: List of active records of channels
+        """
+        for channel in channels:
+            channel.reimport_products_from_magento_archive()
+            channel.reimport_orders_from_magento_archive()
+
+    def reimport_orders_from_magento_archive(self, increment_ids=None):
+        """
+        Create the sales of the archived orders which are not imported, from
+        their archived data. The products, customers and categories of the
+        orders are also taken from the archive, so that no call is made to
+        magento for them.
+
+        :param increment_ids: List of increment ids of the orders, all the
+                              archived orders if None
+        :return: List of active records of sales created
+        """
+        Sale = Pool().get('sale.sale')
+        Archive = Pool().get('magento.payload.archive')
+
+        self.validate_magento_channel()
+
+        orders_data = sorted(
+            Archive.load(self, 'order', increment_ids).values(),
+            key=lambda order_data: order_data['increment_id']
+        )
+        imported_ids = set(
+            sale.magento_id for sale in Sale.search([
+                ('magento_id', 'in', [
+                    int(order_data['order_id']) for order_data in orders_data
+                ]),
+                ('channel', '=', self.id),
+            ])
+        )
+        orders_data = [
+            order_data for order_data in orders_data
+            if int(order_data['order_id']) not in imported_ids
+        ]
+
+        sales = []
+        with Transaction().set_context({
+            'current_channel': self.id,
+            'magento_archive_only': True,
+        }), import_cache.activate():
+            for orders_batch in batch(orders_data, 50):
+                sales.extend(Sale.create_bulk_using_magento_data(orders_batch))
+        return sales
+
+    def reimport_products_from_magento_archive(self, skus=None):
+        """
+        Create the archived products which are missing and update the others
+        from their archived data
+
+        :param skus: List of SKUs of the products, all the archived products
+                     if None
+        :return: List of active records of products created or updated
+        """
+        Product = Pool().get('product.product')
+        Archive = Pool().get('magento.payload.archive')
+
+        self.validate_magento_channel()
+
+        products_data = Archive.load(self, 'product', skus)
+        existing_codes = set(
+            product.code for product in Product.search([
+                ('code', 'in', products_data.keys()),
+            ])
+        )
+
+        products = []
+        with Transaction().set_context({
+            'current_channel': self.id,
+            'magento_archive_only': True,
+        }):
+            for sku in sorted(products_data):
+                product = self.import_product(sku, products_data[sku])
+                if sku in existing_codes:
+                    product.update_from_magento_using_data(products_data[sku])
+                products.append(product)
+        return products
+
+    @classmethod
+    def push_magento_orders(cls, channels, orders):
+        """
+        Queue the orders pushed by magento and import them right away.
+
+        This method is exposed over JSON-RPC, so that magento can push new
+        orders to the channel as soon as they are placed, instead of waiting
+        for the next order import. Orders failing to import stay in the queue
+        and are retried by the cron processing the order queue.
+
+        :param channels: List containing the active record of the channel
+        :param orders: List of dictionaries having the increment_id of the
+                       order, and optionally the rest of the order data
+        :return: List of ids of the queue entries of the orders
+        """
+        OrderQueue = Pool().get('magento.order.queue')
+
+        if len(channels) > 1:
+            cls.raise_user_error('multiple_channels')
+
+        channel, = channels
+        channel.validate_magento_channel()
+
+        entries = OrderQueue.enqueue(channel, orders, origin='push')
+        OrderQueue.process(entries)
+
+        return map(int, entries)
+
+    @classmethod
+    def process_magento_order_queue_using_cron(cls):
         """
-        Export sale order status to magento for the current store view.
-        If last export time is defined, export only those orders which are
-        updated after last export time.
+        Import the queued orders which are due using cron
+        """
+        channels = cls.search([('source', '=', 'magento')])
+
+        for channel in channels:
+            channel.process_magento_order_queue()
+
+    def process_magento_order_queue(self, limit=500):
+        """
+        Import the queued orders of this channel which are due, oldest first
+
+        :param limit: Maximum number of orders imported, None for all
+        :return: List of active records of sales found or created
+        """
+        OrderQueue = Pool().get('magento.order.queue')
+
+        self.validate_magento_channel()
 
+        entries = OrderQueue.search([
+            ('channel', '=', self.id),
+            ('state', '=', 'pending'),
+            ('next_attempt', '<=', datetime.utcnow()),
+        ], order=[('next_attempt', 'ASC'), ('id', 'ASC')], limit=limit)
+
+        return OrderQueue.process(entries)
+
+    def export_order_status(self, batch_size=100):
+        """
+        Export the state of the sales of this channel cancelled or done since
+        the last export to magento.
+
+        The state changes are taken from the state journal of the channel in
+        batches, and exported over one session. Sales whose state was already
+        exported are skipped, and the entries are deleted once exported.
+
+        :param batch_size: Number of journal entries exported at once
         :return: List of active records of sales exported
         """
         Sale = Pool().get('sale.sale')
+        Journal = Pool().get('magento.order.state_journal')
 
         if self.source != 'magento':
             return super(Channel, self).export_order_status()
 
+        self.last_order_export_time = datetime.utcnow()
+        self.save()
+
         exported_sales = []
-        domain = [('channel', '=', self.id)]
+        with self.get_magento_api(magento.Order) as order_api:
+            while True:
+                entries = Journal.search([
+                    ('channel', '=', self.id),
+                ], order=[('id', 'ASC')], limit=batch_size)
+                if not entries:
+                    break
+
+                # Only the last change of a sale matters
+                states = {}
+                for entry in entries:
+                    states[entry.sale] = entry.state
+
+                to_write = []
+                for sale in sorted(states, key=lambda sale: sale.id):
+                    state = states[sale]
+                    if sale.state != state or \
+                            sale.magento_exported_state == state:
+                        continue
+                    exported_sales.append(
+                        sale.export_order_status_to_magento(order_api)
+                    )
+                    to_write.extend([[sale], {
+                        'magento_exported_state': state,
+                    }])
+                if to_write:
+                    Sale.write(*to_write)
+                Journal.delete(entries)
 
-        if self.last_order_export_time:
-            domain = [
-                ('write_date', '>=', self.last_order_export_time)
-            ]
+        return exported_sales
 
-        sales = Sale.search(domain)
+    @classmethod
+    def process_magento_orders_using_cron(cls):
+        """
+        Process the orders imported with deferred processing using cron
+        """
+        channels = cls.search([('source', '=', 'magento')])
 
-        self.last_order_export_time = datetime.utcnow()
-        self.save()
+        for channel in channels:
+            channel.process_magento_orders()
 
-        for sale in sales:
-            exported_sales.append(sale.export_order_status_to_magento())
+    def process_magento_orders(self):
+        """
+        Process the sales of this channel imported with deferred processing
+        to the state of their order on magento
 
-        return exported_sales
+        :return: List of active records of sales processed
+        """
+        Sale = Pool().get('sale.sale')
+
+        self.validate_magento_channel()
+
+        sales = Sale.search([
+            ('channel', '=', self.id),
+            ('magento_pending_state', '!=', None),
+        ])
+        Sale.process_magento_pending_state(sales)
+
+        return sales
 
     @classmethod
     def export_shipment_status_to_magento_using_cron(cls):
@@ -467,83 +1269,146 @@ class Channel:
         for channel in channels:
             channel.export_shipment_status_to_magento()
 
-    def export_shipment_status_to_magento(self):
+    def get_magento_shipments_to_export(self):
         """
-        Exports shipment status for shipments to magento, if they are shipped
+        Return the shipments of this channel to export to magento, with the
+        quantities to ship of every order item, using a single query. Only
+        the outgoing moves of the shipments are counted.
 
-        :return: List of active record of shipment
+        Shipments are exported once they are done, if they are not exported
+        yet and their sale is sent. If a last shipment export time is set,
+        only the sales written since then are considered.
+
+        :return: List of tuples of the shipment id, the sale id, the order
+                 increment id and a dictionary of quantities by order item id
         """
         Shipment = Pool().get('stock.shipment.out')
-        Sale = Pool().get('sale.sale')
+        Location = Pool().get('stock.location')
+        Move = Pool().get('stock.move')
         SaleLine = Pool().get('sale.line')
+        Sale = Pool().get('sale.sale')
 
-        self.validate_magento_channel()
+        cursor = Transaction().cursor
+        shipment = Shipment.__table__()
+        warehouse = Location.__table__()
+        move = Move.__table__()
+        line = SaleLine.__table__()
+        sale = Sale.__table__()
+
+        where = (
+            (sale.channel == self.id) &
+            (sale.magento_id != Null) &
+            (sale.shipment_state == 'sent') &
+            (shipment.state == 'done') &
+            (shipment.magento_increment_id == Null) &
+            (Coalesce(shipment.is_tracking_exported_to_magento, False) ==
+                Literal(False))
+        )
+        if self.last_shipment_export_time:
+            where &= (sale.write_date >= self.last_shipment_export_time)
+
+        # Only the outgoing moves, which leave the output location of the
+        # warehouse, are shipped to the customer
+        cursor.execute(*shipment.join(
+            warehouse, condition=(shipment.warehouse == warehouse.id)
+        ).join(
+            move, condition=(
+                (move.shipment == Concat('stock.shipment.out,', shipment.id)) &
+                (move.from_location == warehouse.output_location)
+            )
+        ).join(
+            line, condition=(move.origin == Concat('sale.line,', line.id))
+        ).join(
+            sale, condition=(line.sale == sale.id)
+        ).select(
+            shipment.id, sale.id, sale.reference, line.magento_id,
+            move.quantity,
+            where=where, order_by=[shipment.id.asc, move.id.asc]
+        ))
+
+        shipments = []
+        for row in cursor.fetchall():
+            shipment_id, sale_id, reference, item_id, quantity = row
+            if not shipments or shipments[-1][0] != shipment_id:
+                shipments.append((
+                    shipment_id, sale_id,
+                    reference[len(self.magento_order_prefix):], {}
+                ))
+            if item_id:
+                # There can be multiple lines with the same product and they
+                # need to be send as a sum of quantities
+                items_qty = shipments[-1][3]
+                items_qty.setdefault(str(item_id), 0)
+                items_qty[str(item_id)] += quantity
+        return shipments
+
+    def is_full_magento_inventory_push_due(self):
+        """
+        Return True if the inventory of every listing of the channel must be
+        pushed, whether it changed since the last push or not. This is the
+        case when forced with `magento_force_inventory_export` in the context
+        or when the full push interval has elapsed.
+        """
+        if Transaction().context.get('magento_force_inventory_export'):
+            return True
+        if not self.magento_full_inventory_push_interval:
+            return False
+        return not self.magento_last_full_inventory_push or \
+            self.magento_last_full_inventory_push + relativedelta(
+                hours=self.magento_full_inventory_push_interval
+            ) <= datetime.utcnow()
+
+    def get_magento_carrier_mapping(self):
+        """
+        Return the magento code and title of the carriers mapped on this
+        channel
 
-        sale_domain = [
-            ('channel', '=', self.id),
-            ('shipment_state', '=', 'sent'),
-            ('magento_id', '!=', None),
-            ('shipments', '!=', None),
-        ]
+        :return: Dictionary of (`code`, `title`) by carrier id
+        """
+        SaleChannelCarrier = Pool().get('sale.channel.carrier')
 
-        if self.last_shipment_export_time:
-            sale_domain.append(
-                ('write_date', '>=', self.last_shipment_export_time)
+        mapping = {}
+        for channel_carrier in SaleChannelCarrier.search([
+            ('channel', '=', self.id),
+            ('carrier', '!=', None),
+        ], order=[('id', 'ASC')]):
+            mapping.setdefault(
+                channel_carrier.carrier.id,
+                channel_carrier.get_magento_mapping()
             )
+        return mapping
+
+    def export_shipment_status_to_magento(self):
+        """
+        Exports shipment status for shipments to magento, if they are shipped
+
+        The shipments to export are selected with a single query and created
+        on magento over one session. Only the exported shipments are written
+        back, with one write.
+
+        :return: List of active records of sales whose shipments are exported
+        """
+        Shipment = Pool().get('stock.shipment.out')
+        Sale = Pool().get('sale.sale')
 
-        sales = Sale.search(sale_domain)
+        self.validate_magento_channel()
+
+        shipments_to_export = self.get_magento_shipments_to_export()
 
         self.last_shipment_export_time = datetime.utcnow()
         self.save()
 
-        updated_sales = set([])
-        for sale in sales:
-            # Get the increment id from the sale reference
-            increment_id = sale.reference[
-                len(self.magento_order_prefix): len(sale.reference)
-            ]
-
-            for shipment in sale.shipments:
+        to_write = []
+        sale_ids = set()
+        with self.get_magento_api(magento.Shipment) as shipment_api:
+            for shipment_id, sale_id, increment_id, items_qty in \
+                    shipments_to_export:
+                sale_ids.add(sale_id)
                 try:
-                    # Some checks to make sure that only valid shipments are
-                    # being exported
-                    if shipment.is_tracking_exported_to_magento or \
-                            shipment.state != 'done' or \
-                            shipment.magento_increment_id:
-                        continue
-                    updated_sales.add(sale)
-                    with magento.Shipment(
-                        self.magento_url, self.magento_api_user,
-                        self.magento_api_key
-                    ) as shipment_api:
-                        item_qty_map = {}
-                        for move in shipment.outgoing_moves:
-                            if isinstance(move.origin, SaleLine) \
-                                    and move.origin.magento_id:
-                                # This is done because there can be multiple
-                                # lines with the same product and they need
-                                # to be send as a sum of quanitities
-                                item_qty_map.setdefault(
-                                    str(move.origin.magento_id), 0
-                                )
-                                item_qty_map[str(move.origin.magento_id)] += \
-                                    move.quantity
-                        shipment_increment_id = shipment_api.create(
-                            order_increment_id=increment_id,
-                            items_qty=item_qty_map
-                        )
-                        Shipment.write(list(sale.shipments), {
-                            'magento_increment_id': shipment_increment_id,
-                        })
-
-                        if self.magento_export_tracking_information and (
-                            hasattr(shipment, 'tracking_number') and
-                            hasattr(shipment, 'carrier') and
-                            shipment.tracking_number and shipment.carrier
-                        ):
-                            with Transaction().set_context(
-                                    current_channel=self.id):
-                                shipment.export_tracking_info_to_magento()
+                    shipment_increment_id = shipment_api.create(
+                        order_increment_id=increment_id,
+                        items_qty=items_qty
+                    )
                 except xmlrpclib.Fault, fault:
                     if fault.faultCode == 102:
                         # A shipment already exists for this order,
@@ -552,8 +1417,25 @@ class Channel:
                         # separately on magento
                         # Hence, just continue
                         continue
+                    logger.warning("Shipment of order %s: %s %s" % (
+                        increment_id, fault.faultCode, fault.faultString
+                    ))
+                    continue
+                to_write.extend([[Shipment(shipment_id)], {
+                    'magento_increment_id': shipment_increment_id,
+                }])
+        if to_write:
+            Shipment.write(*to_write)
+
+        if self.magento_export_tracking_information and to_write:
+            with Transaction().set_context(current_channel=self.id):
+                Shipment.export_tracking_info_to_magento_in_bulk(
+                    Shipment.browse([
+                        records[0].id for records in to_write[::2]
+                    ])
+                )
 
-        return updated_sales
+        return Sale.browse(list(sale_ids))
 
     def export_product_prices(self):
         """
@@ -614,8 +1496,8 @@ class Channel:
                 })
 
             # Update stock information to magento
-            with magento.ProductTierPrice(
-                self.magento_url, self.magento_api_user, self.magento_api_key
+            with self.get_magento_api(
+                magento.ProductTierPrice
             ) as tier_price_api:
                 tier_price_api.update(
                     listing.product_identifier, price_data,
@@ -668,39 +1550,103 @@ class Channel:
             }
 
     def update_order_status(self):
-        "Downstream implementation of order_status update"
+        """
+        Downstream implementation of order_status update
+
+        Only the open sales of the channel whose order was updated on
+        magento since the last order status update (less the overlap
+        configured on the channel) are updated. Orders are searched by
+        increment id in batches, and sales are mapped back to them by the
+        increment id in their reference. The full data of the updated orders
+        is then fetched with info_multi, and the sales are updated together
+        with `Sale.update_order_status_from_magento_in_bulk`.
+
+        The last order status update time is not advanced past the orders
+        which could not be fetched, so that the next update fetches them
+        again.
+        """
         Sale = Pool().get('sale.sale')
 
         if self.source != 'magento':
             return super(Channel, self).update_order_status()
 
-        sales = Sale.search([
-            ('channel', '=', self.id),
-            ('state', 'in', ('confirmed', 'processing')),
-        ])
-        order_ids = [sale.reference for sale in sales]
-        for order_ids_batch in batch(order_ids, 50):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+        update_started = datetime.utcnow()
+
+        # The reference of a sale is the increment id of its order with the
+        # order prefix of the channel
+        prefix = self.magento_order_prefix or ''
+        sales_by_increment_id = dict(
+            (sale.reference[len(prefix):], sale) for sale in Sale.search([
+                ('channel', '=', self.id),
+                ('state', 'in', ('confirmed', 'processing')),
+            ]) if sale.reference and sale.reference.startswith(prefix)
+        )
+
+        filters = {}
+        if self.magento_order_status_updated_at:
+            updated_at_min = self.magento_order_status_updated_at - \
+                relativedelta(minutes=self.magento_order_import_overlap or 0)
+            filters['updated_at'] = {
+                'gteq': updated_at_min.strftime('%Y-%m-%d %H:%M:%S')
+            }
+
+        updated_ids = []
+        updated_at_by_increment_id = {}
+        failed_ids = []
+        sales_data = []
+        with self.get_magento_api(magento.Order) as order_api:
+            for order_ids_batch in batch(sorted(sales_by_increment_id), 500):
+                batch_filters = dict(
+                    filters, increment_id={'in': order_ids_batch}
+                )
+                page = 1
+                has_next = True
+                while has_next:
+                    api_res = order_api.search(
+                        filters=batch_filters, limit=500, page=page
+                    )
+                    has_next = api_res['hasNext']
+                    page += 1
+
+                    for order in api_res['items']:
+                        if order['increment_id'] in sales_by_increment_id:
+                            updated_ids.append(order['increment_id'])
+                            updated_at_by_increment_id[
+                                order['increment_id']
+                            ] = order.get('updated_at')
+
+            # Summaries only carry a few fields of the orders, the sales are
+            # updated with the full data of the updated orders
+            for order_ids_batch in batch(updated_ids, 50):
                 orders_data = order_api.info_multi(order_ids_batch)
+                for increment_id, order_data in zip(
+                        order_ids_batch, orders_data):
+                    if order_data.get('isFault'):
+                        logger.warning("Order %s: %s %s" % (
+                            increment_id, order_data['faultCode'],
+                            order_data['faultMessage']
+                        ))
+                        failed_ids.append(increment_id)
+                        continue
+                    sales_data.append(
+                        (sales_by_increment_id[increment_id], order_data)
+                    )
 
-            for i, order_data in enumerate(orders_data):
-                if order_data.get('isFault'):
-                    if order_data['faultCode'] == '100':
-                        # 100: Requested order not exists.
-                        # TODO: Remove order from channel or add some
-                        # exception.
-                        pass
-                    logger.warning("Order %s: %s %s" % (
-                        order_ids_batch[i], order_data['faultCode'],
-                        order_data['faultMessage']
-                    ))
-                    continue
-                sale, = Sale.search([
-                    ('reference', '=', order_data['increment_id'])
-                ])
-                sale.update_order_status_from_magento(order_data=order_data)
+        if sales_data:
+            Sale.update_order_status_from_magento_in_bulk(sales_data)
+
+        status_updated_at = update_started
+        for increment_id in failed_ids:
+            if not updated_at_by_increment_id[increment_id]:
+                # Not known how far to go, search as much as last time
+                status_updated_at = self.magento_order_status_updated_at
+                break
+            status_updated_at = min(status_updated_at, datetime.strptime(
+                updated_at_by_increment_id[increment_id], '%Y-%m-%d %H:%M:%S'
+            ))
+        self.write([self], {
+            'magento_order_status_updated_at': status_updated_at,
+        })
 
 
 class MagentoTier(ModelSQL, ModelView):
@@ -731,3 +1677,20 @@ class MagentoTier(ModelSQL, ModelView):
                 'Quantity in price tiers must be unique for a channel'
             )
         ]
+
+
+class TaxMapping:
+    """
+    Sale Channel Tax Mapping
+    """
+    __name__ = 'sale.channel.tax'
+
+    @classmethod
+    def write(cls, *args):
+        super(TaxMapping, cls).write(*args)
+        import_cache.invalidate(cls.__name__)
+
+    @classmethod
+    def delete(cls, mappings):
+        super(TaxMapping, cls).delete(mappings)
+        import_cache.invalidate(cls.__name__)
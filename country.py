@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
 
+from .cache import import_cache
+
 
 __all__ = ['Country', 'Subdivision']
 __metaclass__ = PoolMeta
@@ -28,6 +30,11 @@ class Country:
         :param code: ISO code of country
         :return: Browse record of country if found else raises error
         """
+        try:
+            return cls(import_cache.get(cls.__name__, code))
+        except KeyError:
+            pass
+
         countries = cls.search([('code', '=', code)])
 
         if not countries:
@@ -35,8 +42,19 @@ class Country:
                 "country_not_found", error_args=(code, )
             )
 
+        import_cache.set(cls.__name__, code, countries[0].id)
         return countries[0]
 
+    @classmethod
+    def write(cls, *args):
+        super(Country, cls).write(*args)
+        import_cache.invalidate(cls.__name__)
+
+    @classmethod
+    def delete(cls, countries):
+        super(Country, cls).delete(countries)
+        import_cache.invalidate(cls.__name__)
+
 
 class Subdivision:
     "Subdivision"
@@ -54,6 +72,14 @@ class Subdivision:
         :param country: Active record of country
         :return: Active record of state if found else raises error
         """
+        key = (region.lower(), country.id)
+        try:
+            subdivision_id = import_cache.get(cls.__name__, key)
+        except KeyError:
+            pass
+        else:
+            return subdivision_id and cls(subdivision_id) or None
+
         subdivisions = cls.search([
             ('name', 'ilike', region),
             ('country', '=', country.id),
@@ -61,4 +87,23 @@ class Subdivision:
 
         # TODO: Exception need be created if subdivison does not exist.
 
-        return subdivisions and subdivisions[0] or None
+        subdivision = subdivisions and subdivisions[0] or None
+        import_cache.set(cls.__name__, key, subdivision and subdivision.id)
+        return subdivision
+
+    @classmethod
+    def create(cls, vlist):
+        # Subdivisions which were not found could exist now
+        subdivisions = super(Subdivision, cls).create(vlist)
+        import_cache.invalidate(cls.__name__)
+        return subdivisions
+
+    @classmethod
+    def write(cls, *args):
+        super(Subdivision, cls).write(*args)
+        import_cache.invalidate(cls.__name__)
+
+    @classmethod
+    def delete(cls, subdivisions):
+        super(Subdivision, cls).delete(subdivisions)
+        import_cache.invalidate(cls.__name__)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import PoolMeta
 
+from .cache import import_cache
+
 
 __all__ = ['Currency']
 __metaclass__ = PoolMeta
@@ -28,9 +30,25 @@ class Currency:
         :param currency_code: currency code given by magento
         :return: Active record of currency if found else raises error
         """
+        try:
+            return cls(import_cache.get(cls.__name__, currency_code))
+        except KeyError:
+            pass
+
         currencies = cls.search([('code', '=', currency_code)])
 
         if not currencies:
             return cls.raise_user_error('currency_not_found', (currency_code, ))
 
+        import_cache.set(cls.__name__, currency_code, currencies[0].id)
         return currencies[0]
+
+    @classmethod
+    def write(cls, *args):
+        super(Currency, cls).write(*args)
+        import_cache.invalidate(cls.__name__)
+
+    @classmethod
+    def delete(cls, currencies):
+        super(Currency, cls).delete(currencies)
+        import_cache.invalidate(cls.__name__)
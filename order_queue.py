@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import traceback
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+
+import magento
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .cache import import_cache
+
+__all__ = ['MagentoOrderQueue']
+
+logger = logging.getLogger('magento')
+
+
+class MagentoOrderQueue(ModelSQL, ModelView):
+    """
+    Queue of the magento orders to import.
+
+    Orders are queued either when magento pushes them to the channel or when
+    they are found by the order import. The data of the order is kept with
+    the entry when it is given, otherwise it is fetched when the entry is
+    processed. Entries which fail are retried later with an exponential
+    backoff, until `max_attempts` is reached.
+    """
+    __name__ = 'magento.order.queue'
+    _rec_name = 'increment_id'
+
+    #: Number of attempts after which an entry is left failed
+    max_attempts = 8
+
+    #: Delay in seconds before the first retry, doubled after every attempt
+    retry_delay = 60
+
+    #: Longest delay in seconds between two attempts
+    max_retry_delay = 6 * 60 * 60
+
+    channel = fields.Many2One(
+        'sale.channel', 'Magento Channel', required=True, readonly=True,
+        select=True, domain=[('source', '=', 'magento')]
+    )
+    increment_id = fields.Char(
+        'Order Increment ID', required=True, readonly=True, select=True
+    )
+    payload = fields.Text('Payload', readonly=True)
+    origin = fields.Selection([
+        ('push', 'Push'),
+        ('poll', 'Poll'),
+    ], 'Origin', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True, select=True)
+    error = fields.Text('Error', readonly=True)
+    sale = fields.Many2One('sale.sale', 'Sale', readonly=True)
+
+    @staticmethod
+    def default_origin():
+        return 'poll'
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @staticmethod
+    def default_next_attempt():
+        return datetime.utcnow()
+
+    @classmethod
+    def enqueue(cls, channel, orders, origin='poll'):
+        """
+        Queue the given orders of the channel for import.
+
+        Orders already waiting in the queue or already imported through it
+        are not queued again, but the data of waiting ones is updated when
+        given. Orders which failed are given another chance.
+
+        :param channel: Active record of the magento channel
+        :param orders: List of dictionaries having at least the increment_id
+                       of the order. The data of the order, as returned by
+                       sales_order.info, is kept as the payload of the entry.
+        :param origin: 'push' or 'poll'
+        :return: List of active records of the entries of the orders
+        """
+        orders_by_increment_id = {}
+        for order in orders:
+            orders_by_increment_id[str(order['increment_id'])] = order
+        if not orders_by_increment_id:
+            return []
+
+        def get_payload(order):
+            if 'items' in order:
+                return json.dumps(order)
+
+        entries = {}
+        to_write = []
+        for entry in cls.search([
+            ('channel', '=', channel.id),
+            ('increment_id', 'in', orders_by_increment_id.keys()),
+        ], order=[('id', 'ASC')]):
+            if entry.increment_id in entries:
+                continue
+            entries[entry.increment_id] = entry
+            payload = get_payload(orders_by_increment_id[entry.increment_id])
+            values = {}
+            if entry.state == 'failed':
+                values.update({
+                    'state': 'pending',
+                    'attempts': 0,
+                    'next_attempt': datetime.utcnow(),
+                })
+            if payload and entry.state != 'done':
+                values['payload'] = payload
+            if values:
+                to_write.extend([[entry], values])
+        if to_write:
+            cls.write(*to_write)
+
+        to_create = []
+        for increment_id, order in orders_by_increment_id.iteritems():
+            if increment_id in entries:
+                continue
+            to_create.append({
+                'channel': channel.id,
+                'increment_id': increment_id,
+                'payload': get_payload(order),
+                'origin': origin,
+            })
+        for entry in cls.create(to_create):
+            entries[entry.increment_id] = entry
+
+        return [
+            entries[increment_id]
+            for increment_id in orders_by_increment_id
+        ]
+
+    @classmethod
+    def process(cls, entries):
+        """
+        Import the orders of the given pending entries.
+
+        The data of entries without a payload is fetched with info_multi over
+        one session. Every order is imported and committed separately, so a
+        bad order only holds up its own entry, which is scheduled for a
+        retry. The current transaction is committed before the import.
+
+        :param entries: List of active records of entries
+        :return: List of active records of sales found or created
+        """
+        Sale = Pool().get('sale.sale')
+
+        entries = [entry for entry in entries if entry.state == 'pending']
+        if not entries:
+            return []
+
+        # Entries must survive the rollback of a failed order
+        Transaction().cursor.commit()
+
+        entries_by_channel = {}
+        for entry in entries:
+            entries_by_channel.setdefault(entry.channel, []).append(entry)
+
+        sale_ids = []
+        for channel, channel_entries in entries_by_channel.iteritems():
+            with Transaction().set_context(current_channel=channel.id), \
+                    import_cache.activate():
+                orders_data = cls.get_orders_data(channel, channel_entries)
+                for entry in channel_entries:
+                    if entry.id not in orders_data:
+                        continue
+                    sale = cls.import_entry(entry, orders_data[entry.id])
+                    if sale:
+                        sale_ids.append(sale.id)
+
+        return Sale.browse(sale_ids)
+
+    @classmethod
+    def get_orders_data(cls, channel, entries):
+        """
+        Return the data of the orders of the entries by entry id. Orders which
+        cannot be fetched from magento are scheduled for a retry.
+
+        :param channel: Active record of the channel of the entries
+        :param entries: List of active records of entries
+        :return: Dictionary of order data by entry id
+        """
+        orders_data = {}
+        to_fetch = []
+        for entry in entries:
+            if entry.payload:
+                orders_data[entry.id] = json.loads(entry.payload)
+            else:
+                to_fetch.append(entry)
+
+        with channel.get_magento_api(magento.Order) as order_api:
+            for index in range(0, len(to_fetch), 50):
+                entries_batch = to_fetch[index:index + 50]
+                try:
+                    results = order_api.info_multi([
+                        entry.increment_id for entry in entries_batch
+                    ])
+                except Exception:
+                    for entry in entries_batch:
+                        cls.retry_later(entry, traceback.format_exc())
+                    continue
+
+                for entry, order_data in zip(entries_batch, results):
+                    if order_data.get('isFault'):
+                        cls.retry_later(entry, "%s %s" % (
+                            order_data['faultCode'],
+                            order_data['faultMessage']
+                        ))
+                        continue
+                    orders_data[entry.id] = order_data
+
+        return orders_data
+
+    @classmethod
+    def import_entry(cls, entry, order_data):
+        """
+        Find or create the sale of the order of the entry and commit it
+
+        :param entry: Active record of the entry
+        :param order_data: Data of the order from magento
+        :return: Active record of the sale, or None if the order is not
+                 imported
+        """
+        Sale = Pool().get('sale.sale')
+
+        cursor = Transaction().cursor
+        try:
+            sale = Sale.find_or_create_using_magento_data(order_data)
+            cls.write([entry], {
+                'state': 'done',
+                'sale': sale and sale.id,
+                'error': None,
+            })
+            cursor.commit()
+        except Exception:
+            cursor.rollback()
+            # Records cached since the last commit are gone
+            import_cache.invalidate()
+            cls.retry_later(cls(entry.id), traceback.format_exc())
+            return
+        return sale
+
+    @classmethod
+    def retry_later(cls, entry, error):
+        """
+        Schedule the entry for a retry with an exponential backoff, or leave
+        it failed with a channel exception once it has used all its attempts.
+
+        :param entry: Active record of the entry
+        :param error: Message of the error of the last attempt
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        attempts = (entry.attempts or 0) + 1
+        values = {
+            'attempts': attempts,
+            'error': error,
+        }
+        if attempts >= cls.max_attempts:
+            values['state'] = 'failed'
+            ChannelException.create([{
+                'log': "Error occurred on importing order %s.\n"
+                    "Error Message: %s" % (entry.increment_id, error),
+                'channel': entry.channel.id,
+            }])
+        else:
+            values['next_attempt'] = datetime.utcnow() + relativedelta(
+                seconds=min(
+                    cls.retry_delay * 2 ** (attempts - 1),
+                    cls.max_retry_delay
+                )
+            )
+        logger.warning("Order %s: attempt %d failed" % (
+            entry.increment_id, attempts
+        ))
+        cls.write([entry], values)
+        Transaction().cursor.commit()
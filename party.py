@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
+import hashlib
+
 import magento
+from sql import Column
 
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 
+from .cache import import_cache
+
 
 __all__ = ['Party', 'MagentoWebsiteParty', 'Address']
 __metaclass__ = PoolMeta
 
+#: Fields of an address which make its magento fingerprint
+FINGERPRINT_FIELDS = ['name', 'street', 'zip', 'city', 'country', 'subdivision']
+
 
 class Party:
     "Party"
@@ -39,20 +48,104 @@ class Party:
         :return: Active record of record created/found
         """
         Channel = Pool().get('sale.channel')
+        Archive = Pool().get('magento.payload.archive')
 
         channel = Channel.get_current_magento_channel()
 
         party = cls.find_using_magento_id(magento_id)
         if not party:
-            with magento.Customer(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as customer_api:
-                customer_data = customer_api.info(magento_id)
+            if Transaction().context.get('magento_archive_only'):
+                customer_data = Archive.load(
+                    channel, 'customer', [str(magento_id)]
+                ).get(str(magento_id))
+                if customer_data is None:
+                    channel.raise_user_error(
+                        'payload_not_archived', ('customer', magento_id)
+                    )
+            else:
+                with channel.get_magento_api(magento.Customer) as \
+                        customer_api:
+                    customer_data = customer_api.info(magento_id)
+                Archive.archive(
+                    channel, 'customer', {str(magento_id): customer_data}
+                )
 
             party = cls.create_using_magento_data(customer_data)
         return party
 
+    @classmethod
+    def find_or_create_all_using_magento_ids(cls, magento_ids):
+        """
+        Find or create the parties of many magento customers at once. The
+        customers already imported are found with a single search, the
+        rest are fetched from magento with a single filtered list call, or
+        taken from the archive, and created with a single create. The
+        parties are kept in the import cache, so that the orders of these
+        customers find them there.
+
+        :param magento_ids: List of customer IDs sent by magento, where
+                            guests have an empty ID
+        :return: Dictionary of the active records of the parties, keyed by
+                 the customer ID as an integer
+        """
+        MagentoParty = Pool().get('sale.channel.magento.party')
+        Channel = Pool().get('sale.channel')
+        Archive = Pool().get('magento.payload.archive')
+
+        channel = Channel.get_current_magento_channel()
+
+        magento_ids = set(
+            int(magento_id) for magento_id in magento_ids
+            if int(magento_id or 0)
+        )
+        if not magento_ids:
+            return {}
+
+        parties = {}
+        for magento_party in MagentoParty.search([
+            ('magento_id', 'in', list(magento_ids)),
+            ('channel', '=', channel.id),
+        ]):
+            parties[magento_party.magento_id] = magento_party.party
+            import_cache.set(
+                MagentoParty.__name__,
+                (channel.id, magento_party.magento_id),
+                magento_party.party.id
+            )
+
+        missing_ids = sorted(magento_ids - set(parties))
+        if missing_ids and \
+                Transaction().context.get('magento_archive_only'):
+            customers_data = Archive.load(
+                channel, 'customer', map(str, missing_ids)
+            ).values()
+        elif missing_ids:
+            with channel.get_magento_api(magento.Customer) as customer_api:
+                customers_data = customer_api.list({
+                    'customer_id': {'in': missing_ids}
+                })
+            customers_data = [
+                customer_data for customer_data in customers_data
+                if int(customer_data['customer_id']) in missing_ids
+            ]
+            Archive.archive(channel, 'customer', dict(
+                (str(customer_data['customer_id']), customer_data)
+                for customer_data in customers_data
+            ))
+        if missing_ids:
+            for party, customer_data in zip(
+                    cls.create_all_using_magento_data(customers_data),
+                    customers_data):
+                parties[int(customer_data['customer_id'])] = party
+
+        # Customers not listed by magento are fetched one by one
+        for magento_id in missing_ids:
+            if magento_id not in parties:
+                parties[magento_id] = cls.find_or_create_using_magento_id(
+                    magento_id
+                )
+        return parties
+
     @classmethod
     def find_using_magento_id(cls, magento_id):
         """
@@ -63,6 +156,14 @@ class Party:
         """
         MagentoParty = Pool().get('sale.channel.magento.party')
 
+        # Guest customers all have the magento id 0 and are not cached
+        key = (Transaction().context['current_channel'], int(magento_id or 0))
+        if key[1]:
+            try:
+                return cls(import_cache.get(MagentoParty.__name__, key))
+            except KeyError:
+                pass
+
         try:
             magento_party, = MagentoParty.search([
                 ('magento_id', '=', magento_id),
@@ -71,6 +172,10 @@ class Party:
         except ValueError:
             return None
         else:
+            if key[1]:
+                import_cache.set(
+                    MagentoParty.__name__, key, magento_party.party.id
+                )
             return magento_party.party
 
     @classmethod
@@ -102,26 +207,88 @@ class Party:
         :param magento_data: Dictionary of values for customer sent by magento
         :return: Active record of record created
         """
-        values = {
-            'name': u' '.join(filter(
-                None, [magento_data['firstname'], magento_data['lastname']]
-            )),
-            'magento_ids': [
-                ('create', [{
-                    'magento_id': magento_data['customer_id'],
-                    'channel': Transaction().context['current_channel'],
-                }])
-            ],
-        }
-        if magento_data.get('email'):
-            values.update({'contact_mechanisms': [
-                ('create', [{
-                    'type': 'email',
-                    'value': magento_data['email'],
-                }])
-            ]})
-        party, = cls.create([values])
+        party, = cls.create_all_using_magento_data([magento_data])
+        return party
+
+    @classmethod
+    def create_all_using_magento_data(cls, customers_data):
+        """
+        Creates records of many customers sent by magento with a single
+        create
 
+        :param customers_data: List of dictionaries of values for customers
+                               sent by magento
+        :return: List of active records of records created
+        """
+        channel_id = Transaction().context['current_channel']
+
+        vlist = []
+        for magento_data in customers_data:
+            values = {
+                'name': u' '.join(filter(
+                    None, [magento_data['firstname'], magento_data['lastname']]
+                )),
+                'magento_ids': [
+                    ('create', [{
+                        'magento_id': magento_data['customer_id'],
+                        'channel': channel_id,
+                    }])
+                ],
+            }
+            if magento_data.get('email'):
+                values.update({'contact_mechanisms': [
+                    ('create', [{
+                        'type': 'email',
+                        'value': magento_data['email'],
+                    }])
+                ]})
+            vlist.append(values)
+        parties = cls.create(vlist)
+
+        for party, magento_data in zip(parties, customers_data):
+            if int(magento_data['customer_id'] or 0):
+                import_cache.set('sale.channel.magento.party', (
+                    channel_id, int(magento_data['customer_id'])
+                ), party.id)
+
+        return parties
+
+    @classmethod
+    def find_or_create_guest_using_magento_data(cls, magento_data):
+        """
+        Looks for the guest customer of the current channel with the email
+        sent by magento and creates one if not found. Emails are compared
+        lowercased, and guests are created with their email lowercased so
+        that the lookup uses the index on the value of contact mechanisms.
+
+        :param magento_data: Dictionary of values for the guest customer
+        :return: Active record of record created/found
+        """
+        MagentoParty = Pool().get('sale.channel.magento.party')
+
+        email = (magento_data.get('email') or '').strip().lower()
+        if not email:
+            return cls.create_using_magento_data(magento_data)
+
+        key = (Transaction().context['current_channel'], email)
+        try:
+            return cls(import_cache.get(MagentoParty.__name__, key))
+        except KeyError:
+            pass
+
+        magento_parties = MagentoParty.search([
+            ('magento_id', '=', 0),
+            ('channel', '=', Transaction().context['current_channel']),
+            ('party.contact_mechanisms.type', '=', 'email'),
+            ('party.contact_mechanisms.value', '=', email),
+        ], limit=1)
+        if magento_parties:
+            party = magento_parties[0].party
+        else:
+            magento_data = dict(magento_data, email=email)
+            party = cls.create_using_magento_data(magento_data)
+
+        import_cache.set(MagentoParty.__name__, key, party.id)
         return party
 
     @classmethod
@@ -134,17 +301,7 @@ class Party:
         :param magento_data: Dictionary of values for customer sent by magento
         :return: Active record of record found or None
         """
-        MagentoParty = Pool().get('sale.channel.magento.party')
-
-        try:
-            magento_party, = MagentoParty.search([
-                ('magento_id', '=', magento_data['customer_id']),
-                ('channel', '=', Transaction().context['current_channel'])
-            ])
-        except ValueError:
-            return None
-        else:
-            return magento_party.party
+        return cls.find_using_magento_id(magento_data['customer_id'])
 
 
 class MagentoWebsiteParty(ModelSQL, ModelView):
@@ -174,6 +331,16 @@ class MagentoWebsiteParty(ModelSQL, ModelView):
             'party_exists': 'A party must be unique in a channel'
         })
 
+    @classmethod
+    def write(cls, *args):
+        super(MagentoWebsiteParty, cls).write(*args)
+        import_cache.invalidate(cls.__name__)
+
+    @classmethod
+    def delete(cls, records):
+        super(MagentoWebsiteParty, cls).delete(records)
+        import_cache.invalidate(cls.__name__)
+
     @classmethod
     def check_unique_party(cls, records):
         """Checks thats each party should be unique in a channel if it
@@ -195,6 +362,99 @@ class Address:
     "Address"
     __name__ = 'party.address'
 
+    magento_fingerprint = fields.Char(
+        'Magento Fingerprint', readonly=True, select=True,
+        help='Hash of the normalized name, street, zip, city, country and '
+        'subdivision, used to match addresses imported from magento.'
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        sql_table = cls.__table__()
+
+        fingerprint_exists = table.column_exist('magento_fingerprint')
+
+        super(Address, cls).__register__(module_name)
+
+        # Compute the fingerprint of the existing addresses
+        if not fingerprint_exists:
+            cursor.execute(*sql_table.select(
+                sql_table.id,
+                *[Column(sql_table, name) for name in FINGERPRINT_FIELDS]
+            ))
+            for row in cursor.fetchall():
+                cursor.execute(*sql_table.update(
+                    columns=[sql_table.magento_fingerprint],
+                    values=[cls.get_magento_fingerprint(
+                        dict(zip(FINGERPRINT_FIELDS, row[1:]))
+                    )],
+                    where=sql_table.id == row[0]
+                ))
+
+    @staticmethod
+    def get_magento_fingerprint(values):
+        """
+        Return the fingerprint of an address. Values are compared ignoring
+        case and extra whitespace.
+
+        :param values: Dictionary of the values of the address, with the ids
+                       of country and subdivision
+        :return: Hexadecimal SHA1 digest
+        """
+        def normalize(value):
+            if not value:
+                return u''
+            if isinstance(value, basestring):
+                return u' '.join(value.split()).lower()
+            return unicode(value)
+
+        return hashlib.sha1(u'\x1f'.join(
+            normalize(values.get(name)) for name in FINGERPRINT_FIELDS
+        ).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_magento_fingerprint_using_magento_data(cls, address_data):
+        """
+        Return the fingerprint of the address sent by magento
+
+        :param address_data: Dictionary of address data from magento
+        :return: Hexadecimal SHA1 digest
+        """
+        Country = Pool().get('country.country')
+        Subdivision = Pool().get('country.subdivision')
+
+        country = None
+        subdivision = None
+        if address_data['country_id']:
+            country = Country.search_using_magento_code(
+                address_data['country_id']
+            )
+            if address_data['region']:
+                subdivision = Subdivision.search_using_magento_region(
+                    address_data['region'], country
+                )
+
+        return cls.get_magento_fingerprint({
+            'name': ' '.join(filter(
+                None, [address_data['firstname'], address_data['lastname']]
+            )),
+            'street': address_data['street'],
+            'zip': address_data['postcode'],
+            'city': address_data['city'],
+            'country': country and country.id,
+            'subdivision': subdivision and subdivision.id,
+        })
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [values.copy() for values in vlist]
+        for values in vlist:
+            values['magento_fingerprint'] = cls.get_magento_fingerprint(values)
+        return super(Address, cls).create(vlist)
+
     def match_with_magento_data(self, address_data):
         """
         Match the current address with the address_record.
@@ -246,17 +506,58 @@ class Address:
         :param address_data: Dictionary of address data from magento
         :return: Active record of address created/found
         """
-        for address in party.addresses:
-            if address.match_with_magento_data(address_data):
-                break
+        key = (party.id, ) + tuple(
+            address_data[field] for field in (
+                'firstname', 'lastname', 'street', 'postcode', 'city',
+                'country_id', 'region',
+            )
+        )
+        try:
+            return cls(import_cache.get(cls.__name__, key))
+        except KeyError:
+            pass
+
+        addresses = cls.search([
+            ('party', '=', party.id),
+            ('magento_fingerprint', '=',
+                cls.get_magento_fingerprint_using_magento_data(address_data)),
+        ], limit=1)
 
+        if addresses:
+            address, = addresses
         else:
             address = cls.create_for_party_using_magento_data(
                 party, address_data
             )
 
+        import_cache.set(cls.__name__, key, address.id)
         return address
 
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+
+        addresses = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if set(values) & set(FINGERPRINT_FIELDS):
+                addresses.extend(records)
+
+        if addresses:
+            to_write = []
+            for values in cls.read(map(int, addresses), FINGERPRINT_FIELDS):
+                to_write.extend([[cls(values['id'])], {
+                    'magento_fingerprint': cls.get_magento_fingerprint(values),
+                }])
+            super(Address, cls).write(*to_write)
+
+        import_cache.invalidate(cls.__name__)
+
+    @classmethod
+    def delete(cls, addresses):
+        super(Address, cls).delete(addresses)
+        import_cache.invalidate(cls.__name__)
+
     @classmethod
     def create_for_party_using_magento_data(cls, party, address_data):
         """
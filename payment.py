@@ -3,6 +3,8 @@ from trytond.pool import PoolMeta
 from trytond.model import fields, ModelSQL, ModelView
 from trytond.transaction import Transaction
 
+from .cache import import_cache
+
 __metaclass__ = PoolMeta
 __all__ = ['MagentoPaymentGateway', 'Payment']
 
@@ -61,21 +63,71 @@ class MagentoPaymentGateway(ModelSQL, ModelView):
         """
         raise NotImplementedError
 
+    @classmethod
+    def create(cls, vlist):
+        import_cache.invalidate(cls.__name__)
+        return super(MagentoPaymentGateway, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        import_cache.invalidate(cls.__name__)
+        super(MagentoPaymentGateway, cls).write(*args)
+
+    @classmethod
+    def delete(cls, gateways):
+        import_cache.invalidate(cls.__name__)
+        super(MagentoPaymentGateway, cls).delete(gateways)
+
     @classmethod
     def find_using_magento_data(cls, gateway_data):
         """
         Search for an existing gateway by matching name and channel.
         If found, return its active record else None
         """
-        try:
-            gateway, = cls.search([
-                ('name', '=', gateway_data['name']),
-                ('channel', '=', Transaction().context['current_channel']),
-            ])
-        except ValueError:
-            return None
-        else:
-            return gateway
+        return cls.find_all_using_magento_names(
+            [gateway_data['name']]
+        ).get(gateway_data['name'])
+
+    @classmethod
+    def find_all_using_magento_names(cls, names):
+        """
+        Find the gateways of the current channel for many payment method
+        names at once. The gateways found, and the names without one, are
+        kept in the import cache.
+
+        :param names: List of payment method names from magento
+        :return: Dictionary of the active records of the gateways found,
+                 keyed by name
+        """
+        channel_id = Transaction().context['current_channel']
+
+        gateway_ids = {}
+        to_search = set()
+        for name in names:
+            try:
+                gateway_ids[name] = import_cache.get(
+                    cls.__name__, (channel_id, name)
+                )
+            except KeyError:
+                to_search.add(name)
+
+        if to_search:
+            found = dict(
+                (gateway.name, gateway.id) for gateway in cls.search([
+                    ('name', 'in', list(to_search)),
+                    ('channel', '=', channel_id),
+                ])
+            )
+            for name in to_search:
+                gateway_ids[name] = found.get(name)
+                import_cache.set(
+                    cls.__name__, (channel_id, name), gateway_ids[name]
+                )
+
+        return dict(
+            (name, cls(gateway_id))
+            for name, gateway_id in gateway_ids.iteritems() if gateway_id
+        )
 
 
 class Payment:
@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 import magento
 from collections import defaultdict
+from datetime import datetime
 
 import logbook
 from trytond.model import ModelSQL, ModelView, fields
@@ -86,16 +87,27 @@ class Category:
         :returns: Active record of category found/created
         """
         Channel = Pool().get('sale.channel')
+        Archive = Pool().get('magento.payload.archive')
 
         category = cls.find_using_magento_id(magento_id)
         if not category:
             channel = Channel.get_current_magento_channel()
 
-            with magento.Category(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as category_api:
-                category_data = category_api.info(magento_id)
+            if Transaction().context.get('magento_archive_only'):
+                category_data = Archive.load(
+                    channel, 'category', [str(magento_id)]
+                ).get(str(magento_id))
+                if category_data is None:
+                    channel.raise_user_error(
+                        'payload_not_archived', ('category', magento_id)
+                    )
+            else:
+                with channel.get_magento_api(magento.Category) as \
+                        category_api:
+                    category_data = category_api.info(magento_id)
+                Archive.archive(
+                    channel, 'category', {str(magento_id): category_data}
+                )
 
             category = cls.create_using_magento_data(
                 category_data, parent
@@ -215,6 +227,24 @@ class ProductSaleChannelListing:
         }, depends=['channel_source']
     )
 
+    #: Snapshot of the inventory last pushed to magento, so that only the
+    #: listings whose inventory changed are pushed again
+    magento_pushed_quantity = fields.Float(
+        'Last Pushed Quantity', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+    magento_pushed_in_stock = fields.Boolean(
+        'Last Pushed In Stock', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+    magento_inventory_pushed_at = fields.DateTime(
+        'Inventory Pushed At', readonly=True, states={
+            "invisible": Eval('channel_source') != 'magento'
+        }, depends=['channel_source']
+    )
+
     @classmethod
     def __setup__(cls):
         super(ProductSaleChannelListing, cls).__setup__()
@@ -262,14 +292,57 @@ class ProductSaleChannelListing:
 
         return self.export_bulk_inventory([self])
 
+    @classmethod
+    def get_magento_inventory_quantities(cls, listings):
+        """
+        Return the quantities in stock of the products of the listings, like
+        the quantity of the listings, in the warehouses of their channels.
+
+        Quantities are computed with a single stock query per warehouse
+        instead of one per listing.
+
+        :param listings: List of active records of listings
+        :return: Dictionary of quantities by listing id
+        """
+        Product = Pool().get('product.product')
+        Date = Pool().get('ir.date')
+
+        listings_by_warehouse = defaultdict(list)
+        for listing in listings:
+            listings_by_warehouse[listing.channel.warehouse.id].append(
+                listing
+            )
+
+        quantities = {}
+        with Transaction().set_context(stock_date_end=Date.today()):
+            for warehouse_id, warehouse_listings in \
+                    listings_by_warehouse.iteritems():
+                quantity_by_product = Product.products_by_location(
+                    [warehouse_id], list(set(
+                        listing.product.id for listing in warehouse_listings
+                    )), with_childs=True
+                )
+                for listing in warehouse_listings:
+                    quantities[listing.id] = quantity_by_product.get(
+                        (warehouse_id, listing.product.id), 0.0
+                    )
+        return quantities
+
     @classmethod
     def export_bulk_inventory(cls, listings):
         """
         Bulk export inventory to magento.
 
+        Only the listings whose quantity or stock flag changed since the
+        last push are sent, unless a full push of the channel is due (see
+        `Channel.is_full_magento_inventory_push_due`). The inventory pushed
+        is recorded on the listings, and the full push on the channel when
+        all its active listings are given.
+
         Do not rely on the return value from this method.
         """
         SaleChannelListing = Pool().get('product.product.channel_listing')
+        Channel = Pool().get('sale.channel')
 
         if not listings:
             # Nothing to update
@@ -292,34 +365,54 @@ class ProductSaleChannelListing:
             % len(magento_listings)
         )
 
+        quantities = cls.get_magento_inventory_quantities(magento_listings)
+
+        full_push_channels = {}
         inventory_channel_map = defaultdict(list)
         for listing in magento_listings:
             channel = listing.channel
+            if channel not in full_push_channels:
+                full_push_channels[channel] = \
+                    channel.is_full_magento_inventory_push_due()
 
-            product_data = {
-                'qty': listing.quantity,
-            }
+            quantity = quantities[listing.id]
 
             # TODO: Get this from availability used
             if listing.magento_product_type == 'simple':
                 # Only send inventory for simple products
-                product_data['is_in_stock'] = '1' \
-                    if listing.quantity > 0 else '0'
+                in_stock = quantity > 0
             else:
                 # configurable, bundle and everything else
-                product_data['is_in_stock'] = '1'
+                in_stock = True
+
+            if not full_push_channels[channel] and \
+                    listing.magento_inventory_pushed_at and \
+                    listing.magento_pushed_quantity == quantity and \
+                    bool(listing.magento_pushed_in_stock) == in_stock:
+                # Unchanged since the last push
+                continue
+
+            product_data = {
+                'qty': quantity,
+                'is_in_stock': '1' if in_stock else '0',
+            }
 
             # group inventory xml by channel
-            inventory_channel_map[channel].append([
-                listing.product_identifier, product_data
-            ])
+            inventory_channel_map[channel].append(
+                (listing, quantity, in_stock, [
+                    listing.product_identifier, product_data
+                ])
+            )
 
-        for channel, product_data_list in inventory_channel_map.iteritems():
-            with magento.Inventory(
-                    channel.magento_url,
-                    channel.magento_api_user,
-                    channel.magento_api_key) as inventory_api:
-                for product_data_batch in batch(product_data_list, 50):
+        pushed_at = datetime.utcnow()
+        for channel, inventory in inventory_channel_map.iteritems():
+            to_write = []
+            with channel.get_magento_api(magento.Inventory) as inventory_api:
+                for inventory_batch in batch(inventory, 50):
+                    product_data_batch = [
+                        product_data for _, _, _, product_data
+                        in inventory_batch
+                    ]
                     log.info(
                         "Pushing inventory of %d products to magento"
                         % len(product_data_batch)
@@ -328,20 +421,47 @@ class ProductSaleChannelListing:
                     # Magento bulk API will not raise Faults.
                     # Instead the response contains the faults as a dict
                     for i, result in enumerate(response):
-                        if result is not True:
-                            if result.get('isFault') is True and \
-                                    result['faultCode'] == '101':
-                                listing, = SaleChannelListing.search([
-                                    ('product_identifier', '=', product_data_batch[i][0]),  # noqa
-                                    ('channel', '=', channel.id),
-                                ])
-                                listing.state = 'disabled'
-                                listing.save()
-                            else:
-                                cls.raise_user_error(
-                                    'multi_inventory_update_fail',
-                                    (result['faultCode'], result['faultMessage'])  # noqa
-                                )
+                        listing, quantity, in_stock, _ = inventory_batch[i]
+                        if result is True:
+                            to_write.extend([[listing], {
+                                'magento_pushed_quantity': quantity,
+                                'magento_pushed_in_stock': in_stock,
+                                'magento_inventory_pushed_at': pushed_at,
+                            }])
+                        elif result.get('isFault') is True and \
+                                result['faultCode'] == '101':
+                            listing, = SaleChannelListing.search([
+                                ('product_identifier', '=', product_data_batch[i][0]),  # noqa
+                                ('channel', '=', channel.id),
+                            ])
+                            listing.state = 'disabled'
+                            listing.save()
+                        else:
+                            cls.raise_user_error(
+                                'multi_inventory_update_fail',
+                                (result['faultCode'], result['faultMessage'])  # noqa
+                            )
+            if to_write:
+                cls.write(*to_write)
+
+        # A full push is only recorded once every active listing of the
+        # channel is pushed, not when a few listings are exported. Listings
+        # are counted, as they may be too many to be searched by id.
+        exported_counts = defaultdict(int)
+        for listing in cls.browse(list(set(map(int, magento_listings)))):
+            if listing.state == 'active':
+                exported_counts[listing.channel] += 1
+        full_pushed = [
+            channel for channel, full_push in full_push_channels.iteritems()
+            if full_push and exported_counts[channel] == cls.search([
+                ('channel', '=', channel.id),
+                ('state', '=', 'active'),
+            ], count=True)
+        ]
+        if full_pushed:
+            Channel.write(full_pushed, {
+                'magento_last_full_inventory_push': pushed_at,
+            })
 
 
 class Product:
@@ -487,13 +607,11 @@ class Product:
         """
         Channel = Pool().get('sale.channel')
         SaleChannelListing = Pool().get('product.product.channel_listing')
+        Archive = Pool().get('magento.payload.archive')
 
         channel = Channel.get_current_magento_channel()
 
-        with magento.Product(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as product_api:
+        with channel.get_magento_api(magento.Product) as product_api:
             channel_listing, = SaleChannelListing.search([
                 ('product', '=', self.id),
                 ('channel', '=', channel.id),
@@ -502,6 +620,9 @@ class Product:
                 channel_listing.product_identifier,
                 identifierType="productID"
             )
+        Archive.archive(channel, 'product', {
+            product_data['sku'].strip(): product_data
+        })
 
         return self.update_from_magento_using_data(product_data)
 
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 import magento
+import logging
 from decimal import Decimal
 import xmlrpclib
 from datetime import datetime
 import pytz
 
-from trytond.model import fields
+from trytond.model import ModelSQL, fields
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
@@ -13,14 +14,19 @@ from trytond.pyson import Eval
 
 
 __all__ = [
-    'StockShipmentOut', 'Sale', 'SaleLine',
+    'StockShipmentOut', 'Sale', 'SaleLine', 'MagentoOrderStateJournal',
 ]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger('magento')
+
 INVISIBLE_IF_NOT_MAGENTO = {
     'invisible': ~(Eval('channel_type') == 'magento'),
 }
 
+#: States of sales which are exported to magento
+EXPORTED_STATES = ('cancel', 'done')
+
 
 class Sale:
     "Sale"
@@ -30,6 +36,17 @@ class Sale:
         'Magento ID', readonly=True, states=INVISIBLE_IF_NOT_MAGENTO,
         depends=['channel_type']
     )
+    #: State of the order on magento which the sale is still to be processed
+    #: to, when the processing of imported orders is deferred.
+    magento_pending_state = fields.Char(
+        'Magento Pending State', readonly=True, select=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['channel_type']
+    )
+    #: Last state of the sale exported to magento
+    magento_exported_state = fields.Char(
+        'Magento Exported State', readonly=True,
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['channel_type']
+    )
 
     @classmethod
     def __setup__(cls):
@@ -81,13 +98,53 @@ class Sale:
 
         return sales and sales[0] or None
 
+    @classmethod
+    def get_party_using_magento_data(cls, order_data):
+        """
+        Find or create the party of the customer of the order. Guests are
+        given a new party, unless guests are merged on the channel.
+
+        :param order_data: Order data from magento
+        :return: Active record of the party
+        """
+        Party = Pool().get('party.party')
+        Channel = Pool().get('sale.channel')
+
+        if order_data['customer_id']:
+            return Party.find_or_create_using_magento_id(
+                order_data['customer_id']
+            )
+
+        firstname = order_data['customer_firstname'] or (
+            order_data['billing_address'] and
+            order_data['billing_address']['firstname']
+        ) or (
+            order_data['shipping_address'] and
+            order_data['shipping_address']['firstname']
+        )
+        lastname = order_data['customer_lastname'] or (
+            order_data['billing_address'] and
+            order_data['billing_address']['lastname']
+        ) or (
+            order_data['shipping_address'] and
+            order_data['shipping_address']['lastname']
+        )
+        guest_data = {
+            'firstname': firstname,
+            'lastname': lastname,
+            'email': order_data['customer_email'],
+            'customer_id': 0
+        }
+        if Channel.get_current_magento_channel().magento_merge_guest_customers:
+            return Party.find_or_create_guest_using_magento_data(guest_data)
+        return Party.create_using_magento_data(guest_data)
+
     @classmethod
     def get_sale_using_magento_data(cls, order_data):
         """
         Return an active record of the sale from magento data
         """
         Sale = Pool().get('sale.sale')
-        Party = Pool().get('party.party')
         Address = Pool().get('party.address')
         Currency = Pool().get('currency.currency')
         Channel = Pool().get('sale.channel')
@@ -98,31 +155,7 @@ class Sale:
             order_data['order_currency_code']
         )
 
-        if order_data['customer_id']:
-            party = Party.find_or_create_using_magento_id(
-                order_data['customer_id']
-            )
-        else:
-            firstname = order_data['customer_firstname'] or (
-                order_data['billing_address'] and
-                order_data['billing_address']['firstname']
-            ) or (
-                order_data['shipping_address'] and
-                order_data['shipping_address']['firstname']
-            )
-            lastname = order_data['customer_lastname'] or (
-                order_data['billing_address'] and
-                order_data['billing_address']['lastname']
-            ) or (
-                order_data['shipping_address'] and
-                order_data['shipping_address']['lastname']
-            )
-            party = Party.create_using_magento_data({
-                'firstname': firstname,
-                'lastname': lastname,
-                'email': order_data['customer_email'],
-                'customer_id': 0
-            })
+        party = cls.get_party_using_magento_data(order_data)
 
         party_invoice_address = None
         if order_data['billing_address']:
@@ -181,79 +214,330 @@ class Sale:
         :param order_data: Order data from magento
         :return: Active record of record created
         """
-        ChannelException = Pool().get('channel.exception')
+        sales = cls.create_bulk_using_magento_data([order_data])
+        return sales and sales[0] or None
+
+    @classmethod
+    def create_bulk_using_magento_data(cls, orders_data):
+        """
+        Create sales from the data of many magento orders. The sales are
+        created with a single create, and so are the lines of all of them.
+        Orders in a state which is not to be imported are skipped. The data
+        of the orders is archived if archiving is enabled on the channel.
 
+        :param orders_data: List of order data from magento
+        :return: List of active records of sales created
+        """
         Channel = Pool().get('sale.channel')
+        Archive = Pool().get('magento.payload.archive')
 
         channel = Channel.get_current_magento_channel()
 
-        state_data = channel.get_tryton_action(order_data['state'])
+        Archive.archive(channel, 'order', dict(
+            (order_data['increment_id'], order_data)
+            for order_data in orders_data
+        ))
 
         # Do not import if order is in cancelled or draft state
-        if state_data['action'] == 'do_not_import':
-            return
+        orders_data = [
+            order_data for order_data in orders_data
+            if channel.get_tryton_action(order_data['state'])['action'] !=
+            'do_not_import'
+        ]
+        if not orders_data:
+            return []
+
+        sales = cls.create([
+            cls.get_sale_using_magento_data(order_data)._save_values
+            for order_data in orders_data
+        ])
 
-        sale = cls.get_sale_using_magento_data(order_data)
-        sale.save()
+        # Sales are processed one by one, so they are instantiated separately
+        # to not read the fields of all the sales on every access
+        sales = [cls(sale.id) for sale in sales]
+        cls.create_lines_using_magento_data(zip(sales, orders_data))
+        sales = [cls(sale.id) for sale in sales]
 
-        sale.lines = list(sale.lines)
-        sale.add_lines_using_magento_data(order_data)
-        sale.save()
+        cls.create_payments_using_magento_data([
+            (sale, order_data['payment'])
+            for sale, order_data in zip(sales, orders_data)
+        ])
 
-        sale.create_payment_using_magento_data(order_data['payment'])
+        if not channel.magento_defer_order_processing:
+            # Process sales now
+            for sale, order_data in zip(sales, orders_data):
+                sale.process_to_magento_state(order_data['state'])
+        else:
+            # Processed later in bulk by process_magento_pending_state
+            to_write = []
+            for sale, order_data in zip(sales, orders_data):
+                to_write.extend([
+                    [sale], {'magento_pending_state': order_data['state']}
+                ])
+            cls.write(*to_write)
 
-        # Process sale now
-        tryton_action = channel.get_tryton_action(order_data['state'])
+        return sales
+
+    def process_to_magento_state(self, magento_state):
+        """
+        Process the sale to the state of the order on magento. If the
+        transition fails, a channel exception is recorded on the sale.
+
+        :param magento_state: State of the order on magento
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        tryton_action = self.channel.get_tryton_action(magento_state)
         try:
-            sale.process_to_channel_state(order_data['state'])
+            # The state reached is the one of the order on magento
+            with Transaction().set_context(magento_state_from_channel=True):
+                self.process_to_channel_state(magento_state)
         except UserError, e:
             # Expecting UserError will only come when sale order has
             # channel exception.
             # Just ignore the error and leave this order in draft state
             # and let the user fix this manually.
             ChannelException.create([{
-                'origin': '%s,%s' % (sale.__name__, sale.id),
-                'log': "Error occurred on transitioning to state %s.\nError "
-                    "Message: %s" % (tryton_action['action'], e.message),
-                'channel': sale.channel.id,
+                'origin': '%s,%s' % (self.__name__, self.id),
+                'log': "Error occurred on transitioning to state %s.\n"
+                    "Error Message: %s" % (
+                        tryton_action['action'], e.message
+                    ),
+                'channel': self.channel.id,
             }])
 
-        return sale
+    @classmethod
+    def process_magento_pending_state(cls, sales, batch_size=200):
+        """
+        Process sales imported with deferred processing to their pending
+        magento state.
+
+        Sales are grouped by channel and pending state, and every workflow
+        transition is called on up to `batch_size` sales at once. If a
+        transition fails for a batch, its sales are processed one by one and
+        the failures are recorded as channel exceptions. The states reached
+        come from magento, so they are not exported back to it.
+
+        :param sales: List of active records of sales
+        :param batch_size: Number of sales transitioned at once
+        """
+        groups = {}
+        for sale in sales:
+            if sale.magento_pending_state:
+                groups.setdefault(
+                    (sale.channel, sale.magento_pending_state), []
+                ).append(sale.id)
+
+        for (channel, magento_state), sale_ids in groups.iteritems():
+            for index in range(0, len(sale_ids), batch_size):
+                batch = cls.browse(sale_ids[index:index + batch_size])
+                try:
+                    with Transaction().set_context(
+                            magento_state_from_channel=True):
+                        cls.process_to_channel_state_in_bulk(
+                            channel, batch, magento_state
+                        )
+                except UserError:
+                    # Retry one by one to know which sales fail. Sales
+                    # already processed are left as they are.
+                    for sale_id in sale_ids[index:index + batch_size]:
+                        cls(sale_id).process_to_magento_state(magento_state)
+                cls.write(batch, {'magento_pending_state': None})
+
+    @classmethod
+    def process_to_channel_state_in_bulk(cls, channel, sales, channel_state):
+        """
+        Process many sales at once to the state of their orders on the
+        channel, like process_to_channel_state does for a single sale.
+
+        :param channel: Active record of the channel of the sales
+        :param sales: List of active records of sales
+        :param channel_state: State of the orders on the channel
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        data = channel.get_tryton_action(channel_state)
+
+        def in_state(state):
+            return [
+                sale for sale in cls.browse(map(int, sales))
+                if sale.state == state
+            ]
+
+        drafts = in_state('draft')
+        if drafts:
+            cls.write(drafts, {
+                'invoice_method': data['invoice_method'],
+                'shipment_method': data['shipment_method'],
+            })
+
+        if data['action'] in ['process_manually', 'process_automatically']:
+            if drafts:
+                cls.quote(drafts)
+            quotations = in_state('quotation')
+            if quotations:
+                cls.confirm(quotations)
+
+        if data['action'] == 'process_automatically':
+            confirmed = in_state('confirmed')
+            if confirmed:
+                cls.process(confirmed)
+                shipments = [
+                    shipment for sale in cls.browse(map(int, confirmed))
+                    for shipment in sale.shipments
+                ]
+                draft_shipments = [
+                    shipment for shipment in shipments
+                    if shipment.state == 'draft'
+                ]
+                if draft_shipments:
+                    Shipment.wait(draft_shipments)
+                waiting_shipments = [
+                    shipment for shipment in Shipment.browse(
+                        map(int, shipments)
+                    ) if shipment.state == 'waiting'
+                ]
+                if waiting_shipments:
+                    Shipment.assign_try(waiting_shipments)
+
+        if data['action'] == 'import_as_past' and drafts:
+            # XXX: mark past orders as completed, which they are on magento
+            cls.write(drafts, {
+                'state': 'done',
+                'magento_exported_state': 'done',
+            })
+            # Update cached values
+            cls.store_cache(drafts)
+
+    @classmethod
+    def create_lines_using_magento_data(cls, sales_data):
+        """
+        Create the lines of many sales from magento data with a single
+        create, instead of saving every sale with its lines.
+
+        :param sales_data: List of tuples of a saved sale and the order data
+                           from magento it was created from
+        :return: List of active records of sale lines created
+        """
+        SaleLine = Pool().get('sale.line')
+
+        lines = []
+        carriers = []
+        for sale, order_data in sales_data:
+            sale.lines = []
+            sale.add_lines_using_magento_data(order_data)
+            lines.extend(sale.lines)
+            if 'carrier' in cls._fields and sale.carrier:
+                # Set by the shipping line
+                carriers.extend([[sale], {'carrier': sale.carrier.id}])
+
+        lines = SaleLine.create([line._save_values for line in lines])
+        if carriers:
+            cls.write(*carriers)
+        return lines
 
     def create_payment_using_magento_data(self, payment_data):
         """
         Create sale payment using data magento sent payment data.
         """
+        self.create_payments_using_magento_data([(self, payment_data)])
+
+    @classmethod
+    def create_payments_using_magento_data(cls, sales_data):
+        """
+        Create the payments of many sales from the payment data sent by
+        magento. The gateways are resolved by the name of the payment
+        method, the payments are created with a single create and their
+        transactions are posted together.
+
+        :param sales_data: List of tuples of the sale and its payment data
+        :return: List of active records of payments created
+        """
         Payment = Pool().get('sale.payment')
         MagentoPaymentGateway = Pool().get('magento.instance.payment_gateway')
 
-        magento_gateway = MagentoPaymentGateway.find_using_magento_data({
-            'name': payment_data['method']
-        })
+        gateways = MagentoPaymentGateway.find_all_using_magento_names(
+            list(set(
+                payment_data['method'] for _, payment_data in sales_data
+            ))
+        )
 
-        if magento_gateway is None:
-            return
+        payments = []
+        for sale, payment_data in sales_data:
+            magento_gateway = gateways.get(payment_data['method'])
+            if magento_gateway is None or not payment_data['amount_paid']:
+                continue
 
-        if payment_data['amount_paid']:
-            payment, = Payment.create([{
-                'sale': self.id,
+            payments.append({
+                'sale': sale.id,
                 'gateway': magento_gateway.gateway.id,
                 'magento_id': payment_data['payment_id'],
                 'amount': Decimal(payment_data['amount_paid']),
-                'credit_account': self.party.account_receivable.id,
+                'credit_account': sale.party.account_receivable.id,
                 'payment_transactions': [('create', [{
-                    'party': self.party.id,
-                    'address': self.invoice_address.id,
+                    'party': sale.party.id,
+                    'address': sale.invoice_address.id,
                     'state': 'completed',
                     'gateway': magento_gateway.gateway.id,
                     'amount': Decimal(payment_data['amount_paid']),
-                    'credit_account': self.party.account_receivable.id,
+                    'credit_account': sale.party.account_receivable.id,
                 }])]
-            }])
+            })
+        if not payments:
+            return []
+
+        payments = Payment.create(payments)
+        cls.post_magento_payment_transactions([
+            transaction for payment in payments
+            for transaction in payment.payment_transactions
+        ])
+        return payments
+
+    @classmethod
+    def post_magento_payment_transactions(cls, transactions):
+        """
+        Post the transactions of imported payments together. If posting
+        fails, like when the fiscal period is missing, the account moves
+        left by the attempt on the transactions which are not posted are
+        deleted and these transactions are posted one by one with
+        `safe_post`, which leaves the failing ones completed with a log of
+        the error.
+
+        :param transactions: List of active records of payment transactions
+        """
+        PaymentTransaction = Pool().get('payment_gateway.transaction')
 
-            for transaction in payment.payment_transactions:
+        try:
+            PaymentTransaction.post(transactions)
+        except UserError:
+            transactions = [
+                transaction for transaction in PaymentTransaction.browse(
+                    map(int, transactions)
+                ) if transaction.state != 'posted'
+            ]
+            for transaction in transactions:
+                transaction.delete_move_if_exists()
+            for transaction in PaymentTransaction.browse(
+                    map(int, transactions)):
                 transaction.safe_post()
 
+    @staticmethod
+    def get_skus_using_magento_data(order_data):
+        """
+        Return the SKUs of the products of the lines and bundle components
+        of the order
+
+        :param order_data: Order Data from magento
+        """
+        return [
+            item['sku'] for item in order_data['items']
+            if not item['parent_item_id'] or (
+                item['product_options'] and
+                'bundle_option' in item['product_options'] and
+                item['product_type'] not in ('virtual', 'downloadable')
+            )
+        ]
+
     def add_lines_using_magento_data(self, order_data):
         """
         Create sale lines from the magento data and associate them with
@@ -264,6 +548,11 @@ class Sale:
         """
         Bom = Pool().get('production.bom')
 
+        # Resolve the products of all the lines and bundle components at once
+        products = self.channel.import_products_using_skus(
+            self.get_skus_using_magento_data(order_data)
+        )
+
         for item in order_data['items']:
 
             # If the product is a child product of a bundle product, do not
@@ -273,14 +562,14 @@ class Sale:
                     item['parent_item_id']:
                 continue
 
-            sale_line = self.get_sale_line_using_magento_data(item)
+            sale_line = self.get_sale_line_using_magento_data(item, products)
             if sale_line is not None:
                 self.lines.append(sale_line)
 
         # Handle bundle products.
         # Find/Create BoMs for bundle products
         # If no bundle products exist in sale, nothing extra will happen
-        Bom.find_or_create_bom_for_magento_bundle(order_data)
+        Bom.find_or_create_bom_for_magento_bundle(order_data, products)
 
         if order_data.get('shipping_method'):
             self.lines.append(
@@ -292,9 +581,12 @@ class Sale:
                 self.get_discount_line_data_using_magento_data(order_data)
             )
 
-    def get_sale_line_using_magento_data(self, item):
+    def get_sale_line_using_magento_data(self, item, products=None):
         """
         Get sale.line data from magento data.
+
+        :param item: Item data from magento
+        :param products: Dictionary of products already resolved by SKU
         """
         SaleLine = Pool().get('sale.line')
         ChannelException = Pool().get('channel.exception')
@@ -306,7 +598,8 @@ class Sale:
         if not item['parent_item_id']:
             # If its a top level product, create it
             try:
-                product = channel.get_product(item['sku'])
+                product = (products or {}).get(item['sku']) or \
+                    channel.get_product(item['sku'])
             except xmlrpclib.Fault, exception:
                 if exception.faultCode == 101:
                     # Case when product doesnot exist on magento
@@ -357,10 +650,7 @@ class Sale:
         sale = cls.find_using_magento_increment_id(order_increment_id)
 
         if not sale:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.get_magento_api(magento.Order) as order_api:
                 order_data = order_api.info(order_increment_id)
 
             sale = cls.create_using_magento_data(order_data)
@@ -482,10 +772,52 @@ class Sale:
             'quantity': 1,
         })
 
-    def export_order_status_to_magento(self):
+    @classmethod
+    def write(cls, *args):
+        """
+        Record the transitions of magento sales to the states exported to
+        magento in the state journal.
+
+        States which come from magento, either written with the same
+        `magento_exported_state` or with `magento_state_from_channel` in the
+        context, are marked as exported instead, so that they are not sent
+        back to magento.
+        """
+        Journal = Pool().get('magento.order.state_journal')
+
+        from_channel = Transaction().context.get('magento_state_from_channel')
+
+        args = list(args)
+        actions = iter(args)
+        to_journal = []
+        for index, (sales, values) in enumerate(zip(actions, actions)):
+            if values.get('state') not in EXPORTED_STATES:
+                continue
+            if from_channel and 'magento_exported_state' not in values:
+                values = args[index * 2 + 1] = dict(
+                    values, magento_exported_state=values['state']
+                )
+            if values.get('magento_exported_state') == values['state']:
+                continue
+            for sale in cls.browse(map(int, sales)):
+                if sale.magento_id and sale.state != values['state'] and \
+                        sale.channel.source == 'magento':
+                    to_journal.append({
+                        'sale': sale.id,
+                        'channel': sale.channel.id,
+                        'state': values['state'],
+                    })
+
+        super(Sale, cls).write(*args)
+
+        if to_journal:
+            Journal.create(to_journal)
+
+    def export_order_status_to_magento(self, order_api=None):
         """
         Export order status to magento.
 
+        :param order_api: Open magento.Order API to reuse, if any
         :return: Active record of sale
         """
         if not self.magento_id:
@@ -495,6 +827,10 @@ class Sale:
 
         channel.validate_magento_channel()
 
+        if order_api is None:
+            with channel.get_magento_api(magento.Order) as order_api:
+                return self.export_order_status_to_magento(order_api)
+
         if channel.magento_order_prefix:
             # TODO: Use channel_identifier
             increment_id = self.reference.split(channel.magento_order_prefix)[1]
@@ -504,15 +840,11 @@ class Sale:
         # order status change due to its workflow constraints.
         # TODO: Find a better way to do it
         try:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
-                if self.state == 'cancel':
-                    order_api.cancel(increment_id)
-                elif self.state == 'done':
-                    # TODO: update shipping and invoice
-                    order_api.addcomment(increment_id, 'complete')
+            if self.state == 'cancel':
+                order_api.cancel(increment_id)
+            elif self.state == 'done':
+                # TODO: update shipping and invoice
+                order_api.addcomment(increment_id, 'complete')
         except xmlrpclib.Fault, exception:
             if exception.faultCode == 103:
                 return self
@@ -525,39 +857,118 @@ class Sale:
             default = {}
         default = default.copy()
         default['magento_id'] = None
+        default['magento_exported_state'] = None
+        default['magento_pending_state'] = None
         return super(Sale, cls).copy(sales, default=default)
 
-    def update_order_status_from_magento(self, order_data=None):
+    def update_order_status_from_magento(
+            self, order_data=None, complete_shipments=True):
         """Update order status from magento.
 
+        This is the hook to extend to handle the status of a single order,
+        it is called for every sale by the bulk update.
+
         :TODO: this only handles complete orders of magento. Should handle
         other states too?
-        """
-        Shipment = Pool().get('stock.shipment.out')
 
+        :param order_data: Data of the order as returned by sales_order.info,
+                           fetched from magento if not given
+        :param complete_shipments: If False, the shipments of a complete
+                                   order are not processed, it is left to
+                                   the caller completing the shipments of
+                                   many sales at once
+        :return: True if the shipments of the sale are to be completed
+        """
         if order_data is None:
             # XXX: Magento order_data is already there, so need not to
             # fetch again
-            with magento.Order(
-                self.channel.magento_url, self.channel.magento_api_user,
-                self.channel.magento_api_key
-            ) as order_api:
-                order_data = order_api.info(self.reference)
-
-        if order_data['status'] == 'complete':
-            # Order is completed on magento, process shipments and
-            # invoices.
-            for shipment in self.shipments:
-                if shipment.state == 'draft':
-                    Shipment.wait([shipment])
-                if shipment.state == 'waiting':
-                    Shipment.assign([shipment])
-                if shipment.state == 'assigned':
-                    Shipment.pack([shipment])
-                if shipment.state == 'packed':
-                    Shipment.done([shipment])
-
-            # TODO: handle invoices?
+            increment_id = self.reference[
+                len(self.channel.magento_order_prefix or ''):
+            ]
+            with self.channel.get_magento_api(magento.Order) as order_api:
+                order_data = order_api.info(increment_id)
+
+        if order_data['status'] != 'complete':
+            return False
+
+        # Order is completed on magento, process shipments and
+        # invoices.
+        if complete_shipments:
+            self.complete_shipments_from_magento([self])
+        return True
+
+    @classmethod
+    def update_order_status_from_magento_in_bulk(cls, sales_data):
+        """
+        Update the status of many sales from magento at once.
+
+        `update_order_status_from_magento` is called for every sale, and the
+        shipments of all the complete orders are then processed together.
+
+        :param sales_data: List of tuples of the active record of a sale and
+                           the data of its order as returned by
+                           sales_order.info
+        """
+        cls.complete_shipments_from_magento([
+            sale for sale, order_data in sales_data
+            if sale.update_order_status_from_magento(
+                order_data=order_data, complete_shipments=False
+            )
+        ])
+
+    @classmethod
+    def complete_shipments_from_magento(cls, sales):
+        """
+        Process the shipments of sales completed on magento to done.
+
+        The shipments of all the sales are moved through every transition
+        with a single call, instead of one call per shipment and transition.
+
+        :param sales: List of active records of sales
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        shipment_ids = [
+            shipment.id for sale in sales for shipment in sale.shipments
+        ]
+        for state, transition in [
+            ('draft', Shipment.wait),
+            ('waiting', Shipment.assign),
+            ('assigned', Shipment.pack),
+            ('packed', Shipment.done),
+        ]:
+            # States changed by the previous transition are read again
+            shipments = [
+                shipment for shipment in Shipment.browse(shipment_ids)
+                if shipment.state == state
+            ]
+            if shipments:
+                transition(shipments)
+
+        # TODO: handle invoices?
+
+
+class MagentoOrderStateJournal(ModelSQL):
+    """
+    Journal of the state changes of sales to export to magento.
+
+    An entry is recorded whenever a sale imported from magento is cancelled
+    or done, and deleted once the state is exported.
+    """
+    __name__ = 'magento.order.state_journal'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, readonly=True, select=True,
+        ondelete='CASCADE'
+    )
+    channel = fields.Many2One(
+        'sale.channel', 'Magento Channel', required=True, readonly=True,
+        select=True
+    )
+    state = fields.Selection([
+        ('cancel', 'Canceled'),
+        ('done', 'Done'),
+    ], 'State', required=True, readonly=True)
 
 
 class SaleLine:
@@ -608,22 +1019,20 @@ class StockShipmentOut:
         assert self.tracking_number
         assert self.carrier
 
-        try:
-            carrier, = SaleChannelCarrier.search([
-                ('channel', '=', channel.id),
-                ('carrier', '=', self.carrier.id)
-            ])
-        except ValueError:
+        # Only the mapping of this carrier is needed, the whole mapping of
+        # the channel is for exports in bulk
+        carriers = SaleChannelCarrier.search([
+            ('channel', '=', channel.id),
+            ('carrier', '=', self.carrier.id),
+        ], order=[('id', 'ASC')], limit=1)
+        if carriers:
+            code, title = carriers[0].get_magento_mapping()
+        else:
             # No mapping carrier found use custom
             code, title = 'custom', self.carrier.rec_name
-        else:
-            code, title = carrier.get_magento_mapping()
 
         # Add tracking info to the shipment on magento
-        with magento.Shipment(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as shipment_api:
+        with channel.get_magento_api(magento.Shipment) as shipment_api:
             shipment_increment_id = shipment_api.addtrack(
                 self.magento_increment_id, code, title, self.tracking_number
             )
@@ -633,3 +1042,63 @@ class StockShipmentOut:
             })
 
         return shipment_increment_id
+
+    @classmethod
+    def export_tracking_info_to_magento_in_bulk(cls, shipments, batch_size=50):
+        """
+        Export the tracking info of the shipments to the current magento
+        channel.
+
+        Carrier codes are resolved once from the carrier mapping of the
+        channel. The tracks are added with multicalls of `batch_size` calls
+        over one session, and the shipments whose tracks are added are
+        flagged with a single write. Shipments without a tracking number, a
+        carrier or a magento shipment are left out.
+
+        :param shipments: List of active records of shipments
+        :param batch_size: Number of tracks added by a multicall
+        :return: Dictionary of the results of magento by shipment id
+        """
+        Channel = Pool().get('sale.channel')
+
+        channel = Channel.get_current_magento_channel()
+        carrier_mapping = channel.get_magento_carrier_mapping()
+
+        shipments = [
+            shipment for shipment in shipments
+            if getattr(shipment, 'tracking_number', None) and
+            getattr(shipment, 'carrier', None) and
+            shipment.magento_increment_id
+        ]
+
+        results = {}
+        with channel.get_magento_api(magento.Shipment) as shipment_api:
+            for index in range(0, len(shipments), batch_size):
+                batch = shipments[index:index + batch_size]
+                calls = []
+                for shipment in batch:
+                    # Use custom when there is no mapping for the carrier
+                    code, title = carrier_mapping.get(
+                        shipment.carrier.id,
+                        ('custom', shipment.carrier.rec_name)
+                    )
+                    calls.append(['sales_order_shipment.addTrack', [
+                        shipment.magento_increment_id, code, title,
+                        shipment.tracking_number
+                    ]])
+                for shipment, result in zip(
+                        batch, shipment_api.multiCall(calls)):
+                    if isinstance(result, dict) and result.get('isFault'):
+                        logger.warning("Tracking of shipment %s: %s %s" % (
+                            shipment.magento_increment_id,
+                            result['faultCode'], result['faultMessage']
+                        ))
+                        continue
+                    results[shipment.id] = result
+
+        if results:
+            cls.write(cls.browse(results.keys()), {
+                'is_tracking_exported_to_magento': True
+            })
+
+        return results
@@ -8,6 +8,8 @@ from tests.test_party import TestParty
 from tests.test_product import TestProduct
 from tests.test_sale import TestSale
 from tests.test_currency import TestCurrency
+from tests.test_channel import TestChannel
+from tests.test_api import TestSessionPool, TestMagentoServer
 
 
 def suite():
@@ -22,6 +24,9 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestSale),
         unittest.TestLoader().loadTestsFromTestCase(TestCurrency),
+        unittest.TestLoader().loadTestsFromTestCase(TestChannel),
+        unittest.TestLoader().loadTestsFromTestCase(TestSessionPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestMagentoServer),
     ])
     return test_suite
 
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the import of orders from magento.
+
+Orders are synthesized from the json_mock fixtures and served by the local
+magento stand-in server of magento_server.py, with the given latency added
+to every request. They are then imported end to end with
+`Channel.import_orders`, and the following are reported for every run:
+
+    * orders imported per second
+    * SQL queries per order
+    * magento API calls per order (a multicall counts as one call)
+    * peak RSS of the process
+
+Usage::
+
+    python tests/benchmark.py -n 1000 -n 10000 --latency 0.05 -o benchmark.json
+
+The results are appended to the JSON output file, so that it keeps a history
+of the runs which can be compared between releases.
+"""
+import sys
+import os
+import json
+import time
+import resource
+import ConfigParser
+from datetime import datetime
+from optparse import OptionParser
+
+from mock import patch
+
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__, '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+# Run on SQLite unless another database is given, like the tests
+os.environ.setdefault('TRYTOND_DATABASE_URI', 'sqlite://')
+os.environ.setdefault('DB_NAME', ':memory:')
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT  # noqa
+from trytond.transaction import Transaction  # noqa
+from test_base import TestBase, load_json  # noqa
+from magento_server import MagentoData, MagentoStandIn, MagentoServer  # noqa
+
+
+class QueryCounter(object):
+    """
+    Wraps the execute method of a cursor to count the queries executed
+    """
+
+    def __init__(self, cursor):
+        self.execute = cursor.execute
+        self.queries = 0
+
+    def __call__(self, *args, **kwargs):
+        self.queries += 1
+        return self.execute(*args, **kwargs)
+
+
+class OrderImportBenchmark(TestBase):
+    """
+    Benchmark of the import of orders
+    """
+    #: Seconds the magento stand-in waits before answering every request
+    latency = 0
+
+    def import_order_states(self):
+        """
+        Import the order states of magento
+        """
+        with Transaction().set_context(current_channel=self.channel1.id):
+            for code, name in load_json('order-states', 'all').iteritems():
+                self.channel1.create_order_state(code, name)
+
+    def run_import(self, order_count):
+        """
+        Import the given number of orders and return the measurements
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states()
+
+            with Transaction().set_context(
+                current_channel=self.channel1.id, company=self.company.id
+            ):
+                Category.create_tree_using_magento_data(
+                    load_json('categories', 'category_tree')
+                )
+
+                data = MagentoData.from_fixtures()
+                data.generate_orders(order_count)
+                stand_in = MagentoStandIn(data, latency=self.latency)
+                server = MagentoServer(stand_in).start()
+                self.Channel.write([self.channel1], {
+                    'magento_url': server.url,
+                })
+                channel = self.Channel(self.channel1.id)
+
+                cursor = Transaction().cursor
+                counter = QueryCounter(cursor)
+                try:
+                    with patch.object(cursor, 'execute', counter):
+                        start = time.time()
+                        sales = channel.import_orders()
+                        seconds = time.time() - start
+                finally:
+                    server.stop()
+
+            self.assertEqual(len(sales), order_count)
+
+        return {
+            'orders': order_count,
+            'latency': self.latency,
+            'seconds': round(seconds, 3),
+            'orders_per_second': round(order_count / seconds, 2),
+            'queries_per_order': round(
+                counter.queries / float(order_count), 2
+            ),
+            'api_calls_per_order': round(
+                stand_in.requests / float(order_count), 3
+            ),
+            'peak_rss_kb': resource.getrusage(
+                resource.RUSAGE_SELF
+            ).ru_maxrss,
+        }
+
+    def run_isolated(self, order_count):
+        """
+        Run the import in a forked process, so that every run starts from the
+        same database and the peak RSS is not raised by the previous runs
+        """
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if not pid:
+            os.close(read_end)
+            try:
+                with os.fdopen(write_end, 'w') as output:
+                    json.dump(self.run_import(order_count), output)
+            finally:
+                os._exit(0)
+
+        os.close(write_end)
+        with os.fdopen(read_end) as output:
+            result = output.read()
+        os.waitpid(pid, 0)
+        if not result:
+            raise RuntimeError('Import of %d orders failed' % order_count)
+        return json.loads(result)
+
+    def runTest(self):
+        self.results = [
+            self.run_isolated(order_count)
+            for order_count in self.order_counts
+        ]
+
+
+def get_module_version():
+    """
+    Return the version of the module from tryton.cfg
+    """
+    config = ConfigParser.ConfigParser()
+    config.read(os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        'tryton.cfg'
+    ))
+    return config.get('tryton', 'version')
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '-n', '--orders', dest='order_counts', action='append', type='int',
+        help='Number of orders to import, can be given more than once. '
+        'Defaults to 1000.'
+    )
+    parser.add_option(
+        '--latency', dest='latency', type='float', default=0,
+        help='Seconds the magento stand-in waits before answering every '
+        'request. Defaults to 0.'
+    )
+    parser.add_option(
+        '-o', '--output', dest='output', default='benchmark.json',
+        help='JSON file to which the results are appended'
+    )
+    options, _ = parser.parse_args()
+
+    benchmark = OrderImportBenchmark()
+    benchmark.order_counts = options.order_counts or [1000]
+    benchmark.latency = options.latency
+    benchmark.setUp()
+    benchmark.runTest()
+
+    run = {
+        'date': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'version': get_module_version(),
+        'results': benchmark.results,
+    }
+    history = []
+    if os.path.isfile(options.output):
+        with open(options.output) as output:
+            history = json.load(output)
+    history.append(run)
+    with open(options.output, 'w') as output:
+        json.dump(history, output, indent=4)
+
+    print json.dumps(run, indent=4)
+
+
+if __name__ == '__main__':
+    main()
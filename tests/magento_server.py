@@ -0,0 +1,677 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the XML-RPC API of magento.
+
+The server implements the API resources used by the module, serving data
+seeded from the json_mock fixtures and orders synthesized from them. Calls
+go through a real HTTP connection, so that the cost of network round trips
+shows up when measuring imports and exports. The following can be
+configured:
+
+    * latency added to every request
+    * rate of calls failing with a fault, and faults injected for a method
+    * lifetime of sessions, after which magento asks to login again
+
+Usage::
+
+    python tests/magento_server.py --port 9000 --orders 1000 --latency 0.05
+
+The magento URL of the channel is then set to http://127.0.0.1:9000/, with
+any API user and key unless --user and --key are given.
+"""
+import os
+import copy
+import json
+import time
+import uuid
+import random
+import threading
+import xmlrpclib
+from collections import Counter
+from datetime import datetime
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+ROOT_JSON_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'json_mock'
+)
+
+#: Orders from the fixtures used as templates of the synthesized orders
+ORDER_TEMPLATES = ['100000001', '300000001']
+
+#: Customers from the fixtures the synthesized orders are spread over.
+#: Every fifth order is placed by a guest.
+CUSTOMER_IDS = ['1', '2']
+
+#: Fault codes sent by magento
+ACCESS_DENIED = 2
+INVALID_API_PATH = 3
+SESSION_EXPIRED = 5
+ORDER_NOT_EXISTS = 100
+PRODUCT_NOT_EXISTS = 101
+CANNOT_SHIP = 102
+
+#: Fields of an order returned by a search of orders
+ORDER_SUMMARY_FIELDS = [
+    'order_id', 'increment_id', 'store_id', 'state', 'status', 'created_at',
+    'updated_at',
+]
+
+
+def load_json(resource, filename):
+    """
+    Return the content of a json_mock fixture, like test_base.load_json
+    """
+    file_path = os.path.join(
+        ROOT_JSON_FOLDER, resource, str(filename)
+    ) + '.json'
+    with open(file_path) as fixture:
+        return json.load(fixture)
+
+
+def compare(value, operand):
+    """
+    Compare two values as numbers if both are, else as strings
+    """
+    try:
+        return cmp(float(value), float(operand))
+    except (TypeError, ValueError):
+        return cmp(unicode(value), unicode(operand))
+
+
+OPERATORS = {
+    'eq': lambda value, operand: compare(value, operand) == 0,
+    'neq': lambda value, operand: compare(value, operand) != 0,
+    'gt': lambda value, operand: compare(value, operand) > 0,
+    'lt': lambda value, operand: compare(value, operand) < 0,
+    'gteq': lambda value, operand: compare(value, operand) >= 0,
+    'lteq': lambda value, operand: compare(value, operand) <= 0,
+    'in': lambda value, operand: any(
+        compare(value, item) == 0 for item in operand
+    ),
+    'nin': lambda value, operand: all(
+        compare(value, item) != 0 for item in operand
+    ),
+    'null': lambda value, operand: value is None,
+    'notnull': lambda value, operand: value is not None,
+}
+OPERATORS['='] = OPERATORS['eq']
+OPERATORS['from'] = OPERATORS['gteq']
+OPERATORS['to'] = OPERATORS['lteq']
+
+
+def match(record, filters):
+    """
+    Return True if the record matches the filters of a magento list or
+    search call, like {'store_id': {'=': 1}, 'state': {'in': ['new']}}
+    """
+    for field, condition in (filters or {}).iteritems():
+        if not isinstance(condition, dict):
+            condition = {'eq': condition}
+        for operator, operand in condition.iteritems():
+            if not OPERATORS[operator](record.get(field), operand):
+                return False
+    return True
+
+
+class MagentoData(object):
+    """
+    Data of the magento instance served by the stand-in
+    """
+
+    def __init__(self):
+        self.orders = {}
+        self.products = {}
+        self.customers = {}
+        self.categories = {}
+        self.category_tree = None
+        self.order_states = {}
+        self.shipping_methods = []
+        self.websites = []
+        self.stores = []
+        self.store_views = []
+        self.shipments = {}
+        self.stock_items = {}
+        self.tier_prices = {}
+
+    @classmethod
+    def from_fixtures(cls):
+        """
+        Return the data of the json_mock fixtures
+        """
+        def fixtures(resource):
+            # Variants of a fixture, like 100000001-draft, come after it
+            return sorted(
+                (name[:-len('.json')] for name in os.listdir(
+                    os.path.join(ROOT_JSON_FOLDER, resource)
+                )), key=lambda name: ('-' in name, name)
+            )
+
+        data = cls()
+        for name in fixtures('orders'):
+            order_data = load_json('orders', name)
+            data.orders.setdefault(order_data['increment_id'], order_data)
+        for name in fixtures('products'):
+            product_data = load_json('products', name)
+            data.products.setdefault(product_data['sku'], product_data)
+        for customer_id in CUSTOMER_IDS:
+            data.customers[customer_id] = load_json('customers', customer_id)
+        for name in os.listdir(os.path.join(ROOT_JSON_FOLDER, 'categories')):
+            if name != 'category_tree.json':
+                category_data = load_json('categories', name[:-len('.json')])
+                data.categories[category_data['category_id']] = category_data
+        data.category_tree = load_json('categories', 'category_tree')
+        data.order_states = load_json('order-states', 'all')
+        data.shipping_methods = load_json('carriers', 'shipping_methods')
+        data.websites = [load_json('core', 'website')]
+        data.stores = [load_json('core', 'store')]
+        data.store_views = [load_json('core', 'store_view')]
+        return data
+
+    def generate_orders(self, count, start=0, store_id='1'):
+        """
+        Replace the orders with the given number of orders synthesized from
+        the fixtures. Orders are spread over the customers of the fixtures
+        and every fifth order is placed by a guest.
+
+        :param count: Number of orders
+        :param start: Index of the first order, which gives its ids
+        :param store_id: ID of the store view of the orders
+        """
+        templates = [load_json('orders', name) for name in ORDER_TEMPLATES]
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+        self.orders = {}
+        for index in xrange(start, start + count):
+            order_data = copy.deepcopy(templates[index % len(templates)])
+            order_data.update({
+                'order_id': str(index + 1),
+                'increment_id': str(100000000 + index),
+                'store_id': store_id,
+                'updated_at': now,
+            })
+            if index % 5 == 4:
+                order_data['customer_id'] = None
+            else:
+                order_data['customer_id'] = CUSTOMER_IDS[
+                    index % len(CUSTOMER_IDS)
+                ]
+            self.orders[order_data['increment_id']] = order_data
+
+
+class MagentoStandIn(object):
+    """
+    Dispatcher of the XML-RPC calls made to the stand-in server.
+
+    Every method of the API is implemented by a method of this class, given
+    by its path in API_METHODS. Other paths fail like in magento.
+
+    :param data: MagentoData served
+    :param latency: Seconds waited before answering every request
+    :param fault_rate: Probability for a call to fail with a fault
+    :param session_lifetime: Seconds after which a session expires
+    :param username: API user accepted, any if None
+    :param password: API key accepted, any if None
+    :param seed: Seed of the random faults, to repeat a run
+    """
+
+    #: Methods of the stand-in implementing the paths of the API
+    API_METHODS = {
+        'ol_websites.list': 'ol_websites_list',
+        'ol_groups.list': 'ol_groups_list',
+        'ol_storeviews.list': 'ol_storeviews_list',
+        'sales_order.get_order_states': 'sales_order_get_order_states',
+        'sales_order.shipping_methods': 'sales_order_shipping_methods',
+        'sales_order.list': 'sales_order_list',
+        'sales_order.search': 'sales_order_search',
+        'sales_order.info': 'sales_order_info',
+        'sales_order.addComment': 'sales_order_addComment',
+        'sales_order.cancel': 'sales_order_cancel',
+        'sales_order.hold': 'sales_order_hold',
+        'sales_order.unhold': 'sales_order_unhold',
+        'sales_order_shipment.create': 'sales_order_shipment_create',
+        'sales_order_shipment.addTrack': 'sales_order_shipment_addTrack',
+        'sales_order_shipment.info': 'sales_order_shipment_info',
+        'catalog_product.list': 'catalog_product_list',
+        'catalog_product.info': 'catalog_product_info',
+        'product_tier_price.info': 'product_tier_price_info',
+        'product_tier_price.update': 'product_tier_price_update',
+        'cataloginventory_stock_item.list':
+            'cataloginventory_stock_item_list',
+        'cataloginventory_stock_item.update':
+            'cataloginventory_stock_item_update',
+        'catalog_category.tree': 'catalog_category_tree',
+        'catalog_category.info': 'catalog_category_info',
+        'customer.info': 'customer_info',
+        'customer.list': 'customer_list',
+    }
+
+    def __init__(
+        self, data, latency=0, fault_rate=0, session_lifetime=None,
+        username=None, password=None, seed=None
+    ):
+        self.data = data
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.session_lifetime = session_lifetime
+        self.username = username
+        self.password = password
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.sessions = {}
+        self.injected_faults = {}
+        #: Number of HTTP requests, a multicall counts as one
+        self.requests = 0
+        #: Number of calls by method, including the calls of multicalls
+        self.calls = Counter()
+
+    def inject_fault(self, path, code, message, count=1):
+        """
+        Make the next calls of the method fail with the given fault
+
+        :param path: Path of the method, like sales_order.info
+        :param count: Number of calls failing
+        """
+        with self.lock:
+            self.injected_faults.setdefault(path, []).extend(
+                [xmlrpclib.Fault(code, message)] * count
+            )
+
+    def expire_sessions(self):
+        """
+        Expire every session, like magento does after a while
+        """
+        with self.lock:
+            self.sessions.clear()
+
+    def _dispatch(self, method, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            self.calls[method] += 1
+
+            if method == 'login':
+                return self.login(*params)
+            if method == 'endSession':
+                self.sessions.pop(params[0], None)
+                return True
+            if method == 'call':
+                session_id, path, arguments = params
+                self.check_session(session_id)
+                return self.call(path, arguments or [])
+            if method == 'multiCall':
+                session_id, calls = params
+                self.check_session(session_id)
+                return [
+                    self.call_in_multicall(path, arguments or [])
+                    for path, arguments in calls
+                ]
+        raise xmlrpclib.Fault(
+            INVALID_API_PATH, 'Invalid api path: %s' % method
+        )
+
+    def login(self, username, password):
+        if (self.username is not None and username != self.username) or \
+                (self.password is not None and password != self.password):
+            raise xmlrpclib.Fault(ACCESS_DENIED, 'Access denied.')
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = time.time()
+        return session_id
+
+    def check_session(self, session_id):
+        logged_in = self.sessions.get(session_id)
+        if logged_in is None or (
+            self.session_lifetime is not None and
+            time.time() - logged_in > self.session_lifetime
+        ):
+            self.sessions.pop(session_id, None)
+            raise xmlrpclib.Fault(
+                SESSION_EXPIRED, 'Session expired. Try to relogin.'
+            )
+
+    def call(self, path, arguments):
+        """
+        Return the result of the method of the API or raise its fault
+        """
+        self.calls[path] += 1
+        faults = self.injected_faults.get(path)
+        if faults:
+            raise faults.pop(0)
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            raise xmlrpclib.Fault(1, 'Internal Error. Please see log.')
+
+        if path not in self.API_METHODS:
+            raise xmlrpclib.Fault(
+                INVALID_API_PATH, 'Invalid api path: %s' % path
+            )
+        return getattr(self, self.API_METHODS[path])(*arguments)
+
+    def call_in_multicall(self, path, arguments):
+        """
+        Return the result of a call of a multicall, faults being returned
+        the way magento does
+        """
+        try:
+            return self.call(path, arguments)
+        except xmlrpclib.Fault, fault:
+            return {
+                'isFault': True,
+                'faultCode': fault.faultCode,
+                'faultMessage': fault.faultString,
+            }
+
+    def get_order(self, increment_id):
+        order_data = self.data.orders.get(str(increment_id))
+        if order_data is None:
+            raise xmlrpclib.Fault(
+                ORDER_NOT_EXISTS, 'Requested order not exists.'
+            )
+        return order_data
+
+    def get_product(self, product, identifier_type=None):
+        if identifier_type != 'productID':
+            product_data = self.data.products.get(product)
+            if product_data is not None:
+                return product_data
+        for product_data in self.data.products.itervalues():
+            if str(product_data.get('product_id')) == str(product):
+                return product_data
+        raise xmlrpclib.Fault(PRODUCT_NOT_EXISTS, 'Product not exists.')
+
+    def touch_order(self, order_data, **values):
+        order_data.update(values)
+        order_data['updated_at'] = datetime.utcnow().strftime(
+            '%Y-%m-%d %H:%M:%S'
+        )
+
+    # Core
+    def ol_websites_list(self):
+        return self.data.websites
+
+    def ol_groups_list(self, filters=None):
+        return [
+            store for store in self.data.stores if match(store, filters)
+        ]
+
+    def ol_storeviews_list(self, filters=None):
+        return [
+            view for view in self.data.store_views if match(view, filters)
+        ]
+
+    # Orders
+    def sales_order_get_order_states(self):
+        return self.data.order_states
+
+    def sales_order_shipping_methods(self):
+        return self.data.shipping_methods
+
+    def sales_order_list(self, filters=None):
+        return [
+            dict((key, order_data.get(key)) for key in ORDER_SUMMARY_FIELDS)
+            for order_data in sorted(
+                self.data.orders.itervalues(),
+                key=lambda order_data: order_data['increment_id']
+            ) if match(order_data, filters)
+        ]
+
+    def sales_order_search(self, options):
+        orders = self.sales_order_list(options.get('filters'))
+        limit = options.get('limit') or len(orders) or 1
+        start = ((options.get('page') or 1) - 1) * limit
+        return {
+            'hasNext': start + limit < len(orders),
+            'items': orders[start:start + limit],
+        }
+
+    def sales_order_info(self, increment_id):
+        return self.get_order(increment_id)
+
+    def sales_order_addComment(
+        self, increment_id, status, comment=None, notify=False
+    ):
+        order_data = self.get_order(increment_id)
+        history = order_data.setdefault('status_history', [])
+        history.append({'status': status, 'comment': comment})
+        self.touch_order(order_data, status=status)
+        return True
+
+    def sales_order_cancel(self, increment_id):
+        self.touch_order(
+            self.get_order(increment_id), state='canceled', status='canceled'
+        )
+        return True
+
+    def sales_order_hold(self, increment_id):
+        self.touch_order(
+            self.get_order(increment_id), state='holded', status='holded'
+        )
+        return True
+
+    def sales_order_unhold(self, increment_id):
+        self.touch_order(
+            self.get_order(increment_id), state='new', status='pending'
+        )
+        return True
+
+    # Shipments
+    def sales_order_shipment_create(
+        self, increment_id, items_qty, comment=None, email=True,
+        include_comment=False
+    ):
+        order_data = self.get_order(increment_id)
+        if any(
+            shipment['order_increment_id'] == increment_id
+            for shipment in self.data.shipments.itervalues()
+        ):
+            raise xmlrpclib.Fault(
+                CANNOT_SHIP, 'Cannot do shipment for the order.'
+            )
+        shipment_increment_id = str(
+            200000000 + len(self.data.shipments) + 1
+        )
+        self.data.shipments[shipment_increment_id] = {
+            'increment_id': shipment_increment_id,
+            'order_increment_id': increment_id,
+            'items': items_qty,
+            'comment': comment,
+            'tracks': [],
+        }
+        self.touch_order(order_data)
+        return shipment_increment_id
+
+    def sales_order_shipment_addTrack(
+        self, shipment_increment_id, carrier, title, track_number
+    ):
+        shipment = self.data.shipments.get(shipment_increment_id)
+        if shipment is None:
+            raise xmlrpclib.Fault(100, 'Requested shipment not exists.')
+        track_id = sum(
+            len(s['tracks']) for s in self.data.shipments.itervalues()
+        ) + 1
+        shipment['tracks'].append({
+            'track_id': track_id,
+            'carrier_code': carrier,
+            'title': title,
+            'number': track_number,
+        })
+        return track_id
+
+    def sales_order_shipment_info(self, shipment_increment_id):
+        shipment = self.data.shipments.get(shipment_increment_id)
+        if shipment is None:
+            raise xmlrpclib.Fault(100, 'Requested shipment not exists.')
+        return shipment
+
+    # Products
+    def catalog_product_list(self, filters=None, store_view=None):
+        return [
+            dict(
+                (key, product_data.get(key)) for key in [
+                    'product_id', 'sku', 'name', 'type', 'set',
+                    'category_ids',
+                ]
+            ) for product_data in self.data.products.itervalues()
+            if match(product_data, filters)
+        ]
+
+    def catalog_product_info(
+        self, product, store_view=None, attributes=None, identifierType=None
+    ):
+        return self.get_product(product, identifierType)
+
+    def product_tier_price_info(self, product, identifierType=None):
+        self.get_product(product, identifierType)
+        return self.data.tier_prices.get(str(product), [])
+
+    def product_tier_price_update(
+        self, product, tier_prices, identifierType=None
+    ):
+        self.get_product(product, identifierType)
+        self.data.tier_prices[str(product)] = tier_prices
+        return True
+
+    # Inventory
+    def cataloginventory_stock_item_list(self, products):
+        return [
+            dict(self.data.stock_items.get(str(product), {}), product=product)
+            for product in products
+        ]
+
+    def cataloginventory_stock_item_update(self, product, data):
+        self.get_product(product)
+        self.data.stock_items.setdefault(str(product), {}).update(data)
+        return True
+
+    # Categories
+    def catalog_category_tree(self, parent_id=None, store_view=None):
+        return self.data.category_tree
+
+    def catalog_category_info(
+        self, category_id, store_view=None, attributes=None
+    ):
+        category_data = self.data.categories.get(str(category_id))
+        if category_data is None:
+            # Categories missing from the fixtures are made up from one
+            category_data = copy.deepcopy(self.data.categories['8'])
+            category_data['category_id'] = str(category_id)
+        return category_data
+
+    # Customers
+    def customer_info(self, customer_id, attributes=None):
+        customer_data = self.data.customers.get(str(customer_id))
+        if customer_data is None:
+            raise xmlrpclib.Fault(102, 'Customer not exists.')
+        return customer_data
+
+    def customer_list(self, filters=None):
+        return [
+            customer_data
+            for customer_data in self.data.customers.itervalues()
+            if match(customer_data, filters)
+        ]
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    #: Any path is served, like index.php/api/xmlrpc
+    rpc_paths = ()
+    #: Keep connections alive like the web server of magento
+    protocol_version = 'HTTP/1.1'
+
+
+class MagentoServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    XML-RPC server of the stand-in, answering every request in its own
+    thread
+
+    :param stand_in: MagentoStandIn serving the calls
+    :param port: Port to listen on, any free port if 0
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, stand_in, host='127.0.0.1', port=0):
+        SimpleXMLRPCServer.__init__(
+            self, (host, port), requestHandler=RequestHandler,
+            logRequests=False, allow_none=True
+        )
+        self.stand_in = stand_in
+        self.register_instance(stand_in)
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+        URL to set as the magento URL of the channel
+        """
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving requests and close the socket
+        """
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--host', dest='host', default='127.0.0.1')
+    parser.add_option('-p', '--port', dest='port', type='int', default=9000)
+    parser.add_option(
+        '-n', '--orders', dest='orders', type='int',
+        help='Number of orders synthesized from the fixtures, instead of '
+        'the orders of the fixtures'
+    )
+    parser.add_option(
+        '--latency', dest='latency', type='float', default=0,
+        help='Seconds waited before answering every request'
+    )
+    parser.add_option(
+        '--fault-rate', dest='fault_rate', type='float', default=0,
+        help='Probability for a call to fail with a fault'
+    )
+    parser.add_option(
+        '--session-lifetime', dest='session_lifetime', type='float',
+        help='Seconds after which sessions expire'
+    )
+    parser.add_option('--user', dest='username', help='API user accepted')
+    parser.add_option('--key', dest='password', help='API key accepted')
+    parser.add_option(
+        '--seed', dest='seed', type='int', help='Seed of the random faults'
+    )
+    options, _ = parser.parse_args()
+
+    data = MagentoData.from_fixtures()
+    if options.orders is not None:
+        data.generate_orders(options.orders)
+
+    server = MagentoServer(MagentoStandIn(
+        data, latency=options.latency, fault_rate=options.fault_rate,
+        session_lifetime=options.session_lifetime,
+        username=options.username, password=options.password,
+        seed=options.seed,
+    ), options.host, options.port)
+    print 'Serving magento on %s' % server.url
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import sys
+import os
+import unittest
+import xmlrpclib
+
+import magento
+from mock import patch
+
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__, '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+from trytond.modules.magento.api import (  # noqa
+    SessionPool, Core, SESSION_EXPIRED
+)
+from tests.magento_server import (  # noqa
+    MagentoData, MagentoStandIn, MagentoServer
+)
+
+
+class TestSessionPool(unittest.TestCase):
+    """
+    Tests pooling of magento API sessions
+    """
+
+    def setUp(self):
+        self.pool = SessionPool()
+        patcher = patch('xmlrpclib.ServerProxy')
+        self.ServerProxy = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.proxy = self.ServerProxy.return_value
+        self.proxy.login.return_value = 'session-1'
+
+    def get_api(self, api_class, max_size=4):
+        return self.pool.get_api(
+            api_class, 'http://magento.test', 'admin', 'key', max_size
+        )
+
+    def test_0010_session_reused_across_resources(self):
+        """
+        Tests that a single login is shared by different API classes
+        """
+        self.proxy.call.return_value = []
+
+        with self.get_api(magento.Order) as order_api:
+            order_api.list()
+        with self.get_api(magento.Product) as product_api:
+            product_api.list()
+        with self.get_api(Core) as core_api:
+            core_api.websites()
+
+        self.assertEqual(self.proxy.login.call_count, 1)
+        self.assertEqual(self.ServerProxy.call_count, 1)
+        self.assertEqual(self.proxy.call.call_count, 3)
+        self.assertFalse(self.proxy.endSession.called)
+        self.proxy.call.assert_called_with(
+            'session-1', 'ol_websites.list', []
+        )
+
+    def test_0020_relogin_on_session_expiry(self):
+        """
+        Tests that an expired session is logged in again and the call is
+        retried
+        """
+        self.proxy.login.side_effect = ['session-1', 'session-2']
+        self.proxy.call.side_effect = [
+            xmlrpclib.Fault(SESSION_EXPIRED, 'Session expired'),
+            {'increment_id': '100000001'},
+        ]
+
+        with self.get_api(magento.Order) as order_api:
+            self.assertEqual(
+                order_api.info('100000001'), {'increment_id': '100000001'}
+            )
+
+        self.assertEqual(self.proxy.login.call_count, 2)
+        self.proxy.call.assert_called_with(
+            'session-2', 'sales_order.info', ['100000001']
+        )
+
+        # Other faults are raised as they are
+        self.proxy.call.side_effect = xmlrpclib.Fault(100, 'Not exists')
+        with self.get_api(magento.Order) as order_api:
+            self.assertRaises(xmlrpclib.Fault, order_api.info, '100000001')
+        self.assertEqual(self.proxy.login.call_count, 2)
+
+    def test_0030_pool_size(self):
+        """
+        Tests that sessions beyond the pool size are ended when released
+        """
+        self.proxy.login.side_effect = ['session-1', 'session-2']
+
+        with self.get_api(magento.Order, max_size=1):
+            # A nested block needs a second session
+            with self.get_api(magento.Product, max_size=1):
+                pass
+            self.assertFalse(self.proxy.endSession.called)
+
+        self.proxy.endSession.assert_called_once_with('session-1')
+        self.assertEqual(self.proxy.login.call_count, 2)
+
+
+class TestMagentoServer(unittest.TestCase):
+    """
+    Tests the API against the local magento stand-in server
+    """
+
+    def setUp(self):
+        self.pool = SessionPool()
+        self.addCleanup(self.pool.clear)
+        self.stand_in = MagentoStandIn(
+            MagentoData.from_fixtures(), username='admin', password='key'
+        )
+        self.server = MagentoServer(self.stand_in).start()
+        self.addCleanup(self.server.stop)
+
+    def get_api(self, api_class, password='key'):
+        return self.pool.get_api(
+            api_class, self.server.url, 'admin', password
+        )
+
+    def test_0010_calls_over_pooled_session(self):
+        """
+        Tests that the resources of the module are served and that a pooled
+        session logs in again once magento expires it
+        """
+        with self.get_api(Core) as core_api:
+            self.assertEqual(len(core_api.websites()), 1)
+        with self.get_api(magento.Order) as order_api:
+            self.assertEqual(
+                order_api.info('100000001')['state'], 'new'
+            )
+            result = order_api.search(
+                filters={'store_id': {'=': 1}}, limit=1, page=1
+            )
+            self.assertTrue(result['hasNext'])
+            self.assertEqual(len(result['items']), 1)
+
+        self.stand_in.expire_sessions()
+        with self.get_api(magento.Product) as product_api:
+            self.assertEqual(
+                product_api.info('micronmouse5000', identifierType='sku')[
+                    'sku'
+                ], 'micronmouse5000'
+            )
+
+        self.assertEqual(self.stand_in.calls['login'], 2)
+        self.assertEqual(self.stand_in.calls['sales_order.info'], 1)
+
+        # Wrong credentials are refused
+        with self.assertRaises(xmlrpclib.Fault):
+            with self.get_api(magento.Order, password='wrong'):
+                pass
+
+    def test_0020_fault_injection(self):
+        """
+        Tests that injected faults are raised, or returned in a multicall
+        """
+        self.stand_in.inject_fault('sales_order.info', 100, 'Not exists')
+
+        with self.get_api(magento.Order) as order_api:
+            first, second = order_api.info_multi(['100000001', '100000002'])
+            self.assertTrue(first['isFault'])
+            self.assertEqual(first['faultCode'], 100)
+            self.assertEqual(second['increment_id'], '100000002')
+
+            self.stand_in.inject_fault('sales_order.info', 100, 'Not exists')
+            self.assertRaises(xmlrpclib.Fault, order_api.info, '100000001')
+            self.assertEqual(
+                order_api.info('100000001')['increment_id'], '100000001'
+            )
+
+        # A multicall is a single request
+        self.assertEqual(self.stand_in.calls['multiCall'], 1)
+        self.assertEqual(self.stand_in.calls['sales_order.info'], 4)
+
+    def test_0030_invalid_api_path(self):
+        """
+        Tests that only the paths of the API are served, not the helpers of
+        the stand-in
+        """
+        with self.get_api(magento.Order) as order_api:
+            for path in [
+                'expire.sessions', 'inject.fault', 'touch.order',
+                'sales_order.unknown',
+            ]:
+                with self.assertRaises(xmlrpclib.Fault) as context:
+                    order_api.call(path, [])
+                self.assertEqual(context.exception.faultCode, 3)
+        self.assertEqual(len(self.stand_in.sessions), 1)
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = unittest.TestSuite()
+    test_suite.addTests([
+        unittest.TestLoader().loadTestsFromTestCase(TestSessionPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestMagentoServer),
+    ])
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -83,6 +83,7 @@ class TestBase(unittest.TestCase):
         self.ModelField = POOL.get('ir.model.field')
         self.SaleConfiguration = POOL.get('sale.configuration')
         self.Journal = POOL.get('account.journal')
+        self.Sale = POOL.get('sale.sale')
 
         self.country1, = self.Country.create([{
             'name': 'United States',
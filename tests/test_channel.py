@@ -0,0 +1,1028 @@
+# -*- coding: utf-8 -*-
+import sys
+import os
+
+import unittest
+import threading
+import Queue
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from mock import patch, MagicMock
+
+import trytond.tests.test_tryton
+from trytond import backend
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from tests.test_base import TestBase, load_json
+
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__, '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+
+def mock_product_api(mock):
+    """
+    Make the mocked magento.Product API return product data from the json
+    files, using the sku as the file name
+    """
+    product_api = mock.return_value.__enter__.return_value
+    product_api.info.side_effect = \
+        lambda sku, identifierType=None: load_json('products', sku)
+    return product_api
+
+
+def mock_customer_api(mock):
+    """
+    Make the mocked magento.Customer API return customer data from the json
+    files
+    """
+    def customer_list(filters=None):
+        return [
+            load_json('customers', str(customer_id))
+            for customer_id in filters['customer_id']['in']
+            if customer_id in (1, 2)
+        ]
+
+    customer_api = mock.return_value.__enter__.return_value
+    customer_api.info.side_effect = \
+        lambda customer_id: load_json('customers', customer_id)
+    customer_api.list.side_effect = customer_list
+    return customer_api
+
+
+def mock_category_api(mock):
+    """
+    Make the mocked magento.Category API return a category for any id
+    """
+    def category_info(category_id):
+        category_data = load_json('categories', '8')
+        category_data['category_id'] = str(category_id)
+        return category_data
+
+    category_api = mock.return_value.__enter__.return_value
+    category_api.info.side_effect = category_info
+    return category_api
+
+
+class TestChannel(TestBase):
+    """
+    Tests channel
+    """
+
+    def setup_order_import(self):
+        """
+        Setup the data required to import orders from magento on channel1
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(current_channel=self.channel1.id):
+            self.channel1.create_order_state('new', 'New')
+
+    def test_0010_import_bulk_orders(self):
+        """
+        Tests that orders are fetched in bulk with info_multi and that
+        already imported orders are not fetched again
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            order_infos = [
+                {'order_id': '1', 'increment_id': '100000001'},
+                {'order_id': '2', 'increment_id': '100000002'},
+            ]
+            orders_data = [
+                load_json('orders', '100000001'),
+                load_json('orders', '100000002'),
+            ]
+            # Magento sends the second order with a different order_id
+            orders_data[1]['order_id'] = '2'
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch('magento.Order', autospec=True) as order_mock, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                customer_api = mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+                order_api = order_mock.return_value.__enter__.return_value
+                order_api.info_multi.return_value = orders_data
+
+                sales = self.channel1.import_bulk_orders(order_infos)
+
+                self.assertEqual(len(sales), 2)
+                self.assertEqual(
+                    [sale.magento_id for sale in sales], [1, 2]
+                )
+                order_api.info_multi.assert_called_once_with(
+                    ['100000001', '100000002']
+                )
+                self.assertFalse(order_api.info.called)
+
+                # The customer of the orders is fetched once, with a list
+                customer_api.list.assert_called_once_with({
+                    'customer_id': {'in': [2]}
+                })
+                self.assertFalse(customer_api.info.called)
+                self.assertEqual(
+                    [sale.party for sale in sales],
+                    [self.Party.find_using_magento_id(2)] * 2
+                )
+
+                # Importing again must not fetch the orders again
+                order_api.info_multi.reset_mock()
+                self.assertEqual(
+                    self.channel1.import_bulk_orders(order_infos), sales
+                )
+                self.assertFalse(order_api.info_multi.called)
+                self.assertEqual(
+                    self.Sale.search([], count=True), 2
+                )
+
+    def test_0012_import_bulk_orders_fault(self):
+        """
+        Tests that orders which magento fails to send are queued for a retry
+        instead of being dropped
+        """
+        OrderQueue = POOL.get('magento.order.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch('magento.Order', autospec=True) as order_mock, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+                order_api = order_mock.return_value.__enter__.return_value
+                order_api.info_multi.return_value = [
+                    load_json('orders', '100000001'), {
+                        'isFault': True,
+                        'faultCode': 1,
+                        'faultMessage': 'Internal Error',
+                    }
+                ]
+
+                sales = self.channel1.import_bulk_orders([
+                    {'order_id': '1', 'increment_id': '100000001'},
+                    {'order_id': '2', 'increment_id': '100000002'},
+                ])
+
+                self.assertEqual([sale.magento_id for sale in sales], [1])
+                entry, = OrderQueue.search([])
+                self.assertEqual(entry.channel, self.channel1)
+                self.assertEqual(entry.increment_id, '100000002')
+                self.assertEqual(entry.state, 'pending')
+                self.assertEqual(entry.error, '1 Internal Error')
+
+    def test_0015_import_bulk_orders_with_workers(self):
+        """
+        Tests that orders are created one by one in the current transaction
+        when the import may not commit it, even when several import workers
+        are configured
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+            self.Channel.write([self.channel1], {
+                'magento_import_workers': 4,
+            })
+
+            self.assertFalse(self.channel1.may_commit_order_import())
+            with Transaction().set_context(magento_commit_order_import=True):
+                self.assertTrue(self.channel1.may_commit_order_import())
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch.object(
+                        self.Channel, 'import_orders_in_parallel'
+                    ) as import_orders_in_parallel, \
+                    patch('magento.Order', autospec=True) as order_mock, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+                order_api = order_mock.return_value.__enter__.return_value
+                order_api.info_multi.return_value = [
+                    load_json('orders', '100000001')
+                ]
+
+                sales = self.channel1.import_bulk_orders([
+                    {'order_id': '1', 'increment_id': '100000001'},
+                ])
+
+                self.assertEqual([sale.magento_id for sale in sales], [1])
+                self.assertFalse(import_orders_in_parallel.called)
+
+    @unittest.skipIf(
+        backend.name() == 'sqlite', 'Import workers are not used on SQLite'
+    )
+    def test_0016_import_orders_worker(self):
+        """
+        Tests that an import worker retries an order failing on a lock
+        timeout once, does not retry a bad order, and goes on with the other
+        orders, even if the failure cannot be recorded
+        """
+        Sale = POOL.get('sale.sale')
+        Channel = POOL.get('sale.channel')
+        ChannelException = POOL.get('channel.exception')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        orders_queue = Queue.Queue()
+        for increment_id in ('100000001', '100000002', '100000003'):
+            orders_queue.put(({'increment_id': increment_id}, 1))
+
+        locked = []
+
+        def create_using_magento_data(order_data):
+            if order_data['increment_id'] == '100000001':
+                raise Exception('Bad order')
+            if order_data['increment_id'] == '100000003' and not locked:
+                locked.append(True)
+                raise DatabaseOperationalError('Lock timeout')
+            return MagicMock(id=int(order_data['increment_id'][-1]))
+
+        sale_ids = []
+        with patch.object(
+            Sale, 'create_using_magento_data',
+            side_effect=create_using_magento_data
+        ) as create_sale, patch.object(
+            Sale, 'find_using_magento_data', return_value=None
+        ), patch.object(
+            ChannelException, 'create', side_effect=Exception('Lock timeout')
+        ) as create_exception:
+            worker = threading.Thread(
+                target=Channel.import_orders_worker, args=(
+                    DB_NAME, USER, {'current_channel': 1}, orders_queue,
+                    sale_ids
+                )
+            )
+            worker.start()
+            worker.join()
+
+        self.assertTrue(orders_queue.empty())
+        self.assertEqual(sale_ids, [2, 3])
+        # Only the order failing on a lock timeout is tried again
+        self.assertEqual(create_sale.call_count, 4)
+        self.assertEqual(create_exception.call_count, 1)
+
+    def test_0020_import_orders_since_last_import_time(self):
+        """
+        Tests that only orders updated since the last import time are
+        searched and that the last import time is advanced after the import
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            last_import_time = (
+                datetime.utcnow() - relativedelta(days=2)
+            ).replace(microsecond=0)
+            self.Channel.write([self.channel1], {
+                'last_order_import_time': last_import_time,
+                'magento_order_import_overlap': 15,
+            })
+
+            with Transaction().set_context(company=self.company.id), \
+                    patch('magento.Order', autospec=True) as order_mock:
+                order_api = order_mock.return_value.__enter__.return_value
+                order_api.search.return_value = {
+                    'hasNext': False, 'items': []
+                }
+
+                self.assertEqual(self.channel1.import_orders(), [])
+
+                filters = order_api.search.call_args[1]['filters']
+                self.assertEqual(
+                    filters['updated_at'], {
+                        'gteq': (
+                            last_import_time - relativedelta(minutes=15)
+                        ).strftime('%Y-%m-%d %H:%M:%S')
+                    }
+                )
+                self.assertTrue(
+                    self.channel1.last_order_import_time > last_import_time
+                )
+
+                # A full resync searches the whole window again
+                self.channel1.resync_orders(days=5)
+
+                filters = order_api.search.call_args[1]['filters']
+                updated_at_min = datetime.strptime(
+                    filters['updated_at']['gteq'], '%Y-%m-%d %H:%M:%S'
+                )
+                self.assertTrue(
+                    updated_at_min < datetime.utcnow() - relativedelta(days=5)
+                )
+                self.assertTrue(
+                    self.channel1.last_order_import_time > last_import_time
+                )
+
+    def test_0030_import_orders_streaming(self):
+        """
+        Tests that a streaming import commits a checkpoint after each page and
+        resumes from the page after the checkpoint
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            self.Channel.write([self.channel1], {
+                'magento_stream_order_import': True,
+            })
+            last_import_time = self.channel1.last_order_import_time
+            checkpoints = []
+
+            def search(filters, limit, page):
+                channel = self.Channel(self.channel1.id)
+                checkpoints.append((
+                    channel.magento_order_import_page,
+                    channel.magento_order_import_checkpoint,
+                ))
+                return {'hasNext': page < 3, 'items': []}
+
+            with Transaction().set_context(company=self.company.id), \
+                    patch.object(Transaction().cursor, 'commit') as commit, \
+                    patch('magento.Order', autospec=True) as order_mock:
+                order_api = order_mock.return_value.__enter__.return_value
+                order_api.search.side_effect = search
+
+                self.channel1.import_orders()
+
+                self.assertEqual(
+                    [page for page, _ in checkpoints], [None, 1, 2]
+                )
+                self.assertTrue(checkpoints[1][1])
+                self.assertEqual(commit.call_count, 3)
+
+                channel = self.Channel(self.channel1.id)
+                self.assertIsNone(channel.magento_order_import_page)
+                self.assertIsNone(channel.magento_order_import_checkpoint)
+                self.assertTrue(
+                    channel.last_order_import_time > last_import_time
+                )
+
+                # An unfinished import resumes from the next page
+                last_import_time = channel.last_order_import_time
+                import_started = datetime.utcnow().replace(microsecond=0)
+                self.Channel.write([channel], {
+                    'magento_order_import_page': 2,
+                    'magento_order_import_checkpoint': import_started,
+                })
+                order_api.search.reset_mock()
+                channel.import_orders()
+
+                self.assertEqual(
+                    [c[1]['page'] for c in order_api.search.call_args_list],
+                    [3]
+                )
+                # Orders may have moved between pages meanwhile, so the next
+                # import searches from the same time again
+                channel = self.Channel(channel.id)
+                self.assertEqual(
+                    channel.last_order_import_time, last_import_time
+                )
+                self.assertIsNone(channel.magento_order_import_checkpoint)
+
+                order_api.search.reset_mock()
+                channel.import_orders()
+                self.assertEqual(
+                    [c[1]['page'] for c in order_api.search.call_args_list],
+                    [1, 2, 3]
+                )
+                self.assertTrue(
+                    self.Channel(channel.id).last_order_import_time >=
+                    last_import_time
+                )
+
+    def test_0040_import_products_using_skus(self):
+        """
+        Tests that products are resolved in bulk and that missing ones are
+        fetched with a single multicall
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_category_api(category_mock)
+                product_api = product_mock.return_value.__enter__.return_value
+                product_api.multiCall.return_value = [
+                    load_json('products', 'VGN-TXN27N-B'),
+                    {'isFault': True, 'faultCode': 101, 'faultMessage': ''},
+                ]
+
+                products = self.channel1.import_products_using_skus(
+                    ['VGN-TXN27N-B', 'unknown', 'VGN-TXN27N-B']
+                )
+
+                self.assertEqual(products.keys(), ['VGN-TXN27N-B'])
+                self.assertEqual(products['VGN-TXN27N-B'].code, 'VGN-TXN27N-B')
+                product_api.multiCall.assert_called_once_with([
+                    ['catalog_product.info', [sku, None, None, 'sku']]
+                    for sku in ('VGN-TXN27N-B', 'unknown')
+                ])
+
+                # Products already imported are found without magento
+                product_api.multiCall.reset_mock()
+                self.assertEqual(
+                    self.channel1.import_products_using_skus(['VGN-TXN27N-B']),
+                    products
+                )
+                self.assertFalse(product_api.multiCall.called)
+
+    def test_0050_create_bulk_using_magento_data(self):
+        """
+        Tests that the lines of many orders are created with a single create
+        """
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            orders_data = [
+                load_json('orders', '100000001'),
+                load_json('orders', '300000001'),
+            ]
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch.object(
+                        SaleLine, 'create', wraps=SaleLine.create
+                    ) as create_lines, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+
+                sales = self.Sale.create_bulk_using_magento_data(orders_data)
+
+                self.assertEqual(
+                    [sale.magento_id for sale in sales], [1, 3]
+                )
+                self.assertEqual(create_lines.call_count, 1)
+                for sale, order_data in zip(sales, orders_data):
+                    # Item lines + shipping line
+                    self.assertEqual(
+                        len(sale.lines), len([
+                            item for item in order_data['items']
+                            if not item['parent_item_id']
+                        ]) + 1
+                    )
+                    self.assertEqual(sale.state, 'confirmed')
+
+    def test_0060_deferred_order_processing(self):
+        """
+        Tests that orders are imported in draft when processing is deferred
+        and processed in bulk later, one by one if the bulk processing fails
+        """
+        Journal = POOL.get('magento.order.state_journal')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+            self.Channel.write([self.channel1], {
+                'magento_defer_order_processing': True,
+            })
+
+            orders_data = []
+            for order_id in range(1, 7):
+                order_data = load_json('orders', '100000001')
+                order_data['order_id'] = str(order_id)
+                order_data['increment_id'] = '10000000%d' % order_id
+                orders_data.append(order_data)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+
+                sales = self.Sale.create_bulk_using_magento_data(
+                    orders_data[:2]
+                )
+                self.assertEqual(
+                    [(s.state, s.magento_pending_state) for s in sales],
+                    [('draft', 'new')] * 2
+                )
+
+                # Copies are not processed to the state of the order
+                copies = self.Sale.copy(sales)
+                self.assertEqual(
+                    [(s.state, s.magento_pending_state) for s in copies],
+                    [('draft', None)] * 2
+                )
+
+                with patch.object(
+                    self.Sale, 'confirm', wraps=self.Sale.confirm
+                ) as confirm:
+                    self.assertEqual(
+                        sorted(self.channel1.process_magento_orders()), sales
+                    )
+                    self.assertEqual(confirm.call_count, 1)
+
+                sales = self.Sale.browse(map(int, sales))
+                self.assertEqual(
+                    [(s.state, s.magento_pending_state) for s in sales],
+                    [('confirmed', None)] * 2
+                )
+                self.assertFalse(self.channel1.process_magento_orders())
+
+                # Sales are processed one by one when the batch fails
+                sales = self.Sale.create_bulk_using_magento_data(
+                    orders_data[2:4]
+                )
+                with patch.object(
+                    self.Sale, 'process_to_channel_state_in_bulk',
+                    side_effect=UserError('Batch failed')
+                ):
+                    self.channel1.process_magento_orders()
+
+                sales = self.Sale.browse(map(int, sales))
+                self.assertEqual(
+                    [(s.state, s.magento_pending_state) for s in sales],
+                    [('confirmed', None)] * 2
+                )
+
+                # States reached by the processing come from magento, they
+                # are not exported back to it
+                sales = self.Sale.create_bulk_using_magento_data(
+                    orders_data[4:]
+                )
+                with patch.object(
+                    self.Sale, 'process_to_channel_state_in_bulk',
+                    side_effect=lambda channel, sales, state:
+                        self.Sale.write(sales, {'state': 'done'})
+                ):
+                    self.channel1.process_magento_orders()
+
+                sales = self.Sale.browse(map(int, sales))
+                self.assertEqual(
+                    [(s.state, s.magento_exported_state) for s in sales],
+                    [('done', 'done')] * 2
+                )
+                self.assertEqual(Journal.search([], count=True), 0)
+
+    def test_0070_create_payments_using_magento_data(self):
+        """
+        Tests that the payments of many orders are created with a single
+        create and their transactions posted together
+        """
+        Payment = POOL.get('sale.payment')
+        PaymentTransaction = POOL.get('payment_gateway.transaction')
+        PaymentGateway = POOL.get('payment_gateway.gateway')
+        MagentoPaymentGateway = POOL.get('magento.instance.payment_gateway')
+        AccountMove = POOL.get('account.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            cash_account = self.get_account_by_kind('revenue')
+            self.Journal.write([self.cash_journal], {
+                'debit_account': cash_account,
+                'credit_account': cash_account,
+            })
+            cash_gateway, = PaymentGateway.create([{
+                'name': 'Manual Gateway',
+                'journal': self.cash_journal.id,
+                'provider': 'self',
+                'method': 'manual',
+            }])
+            MagentoPaymentGateway.create([{
+                'name': 'checkmo',
+                'title': 'checkmo',
+                'gateway': cash_gateway.id,
+                'channel': self.channel1.id,
+            }])
+
+            orders_data = []
+            for order_id in range(1, 7):
+                order_data = load_json(
+                    'orders', '300000001-completed-payment'
+                )
+                order_data['order_id'] = str(order_id)
+                order_data['increment_id'] = '30000000%d' % order_id
+                orders_data.append(order_data)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch.object(
+                        Payment, 'create', wraps=Payment.create
+                    ) as create_payments, \
+                    patch.object(
+                        PaymentTransaction, 'post',
+                        wraps=PaymentTransaction.post
+                    ) as post, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+
+                sales = self.Sale.create_bulk_using_magento_data(
+                    orders_data[:2]
+                )
+
+                self.assertEqual(create_payments.call_count, 1)
+                self.assertEqual(post.call_count, 1)
+                for sale in sales:
+                    payment, = sale.payments
+                    self.assertEqual(payment.amount, sale.total_amount)
+                    transaction, = payment.payment_transactions
+                    self.assertEqual(transaction.state, 'posted')
+                    self.assertTrue(transaction.move)
+
+                # Transactions are left completed with a log when posting
+                # fails
+                with patch.object(
+                    PaymentTransaction, 'create_move',
+                    side_effect=UserError('Missing period')
+                ):
+                    sales = self.Sale.create_bulk_using_magento_data(
+                        orders_data[2:4]
+                    )
+
+                for sale in sales:
+                    payment, = sale.payments
+                    transaction, = payment.payment_transactions
+                    self.assertEqual(transaction.state, 'completed')
+                    self.assertFalse(transaction.move)
+                    self.assertEqual(len(transaction.logs), 1)
+
+                # When a single transaction of the batch fails, the move
+                # left on the other one is deleted before it is posted again
+                create_move = PaymentTransaction.create_move
+                transaction_ids = []
+
+                def create_move_failing_second(transaction, *args, **kwargs):
+                    transaction_ids.append(transaction.id)
+                    if len(transaction_ids) > 1 and \
+                            transaction.id == transaction_ids[1]:
+                        raise UserError('Missing period')
+                    return create_move(transaction, *args, **kwargs)
+
+                moves_count = AccountMove.search([], count=True)
+                with patch.object(
+                    PaymentTransaction, 'create_move', autospec=True,
+                    side_effect=create_move_failing_second
+                ):
+                    sales = self.Sale.create_bulk_using_magento_data(
+                        orders_data[4:]
+                    )
+
+                (posted,), (failed,) = [
+                    sale.payments[0].payment_transactions for sale in sales
+                ]
+                self.assertEqual(failed.id, transaction_ids[1])
+                self.assertEqual(posted.state, 'posted')
+                self.assertTrue(posted.move)
+                self.assertFalse(posted.logs)
+                self.assertEqual(failed.state, 'completed')
+                self.assertFalse(failed.move)
+                self.assertEqual(len(failed.logs), 1)
+                self.assertEqual(
+                    AccountMove.search([], count=True), moves_count + 1
+                )
+
+    def test_0080_order_queue(self):
+        """
+        Tests that pushed orders are queued and imported, and that failing
+        orders are retried later
+        """
+        OrderQueue = POOL.get('magento.order.queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            order_data = load_json('orders', '100000001')
+            fetched_order_data = load_json('orders', '100000002')
+            fetched_order_data['order_id'] = '2'
+            failing_order_data = load_json('orders', '100000001')
+            failing_order_data['order_id'] = '3'
+            failing_order_data['increment_id'] = '100000003'
+
+            cursor = Transaction().cursor
+            with Transaction().set_context(company=self.company.id), \
+                    patch.object(cursor, 'commit'), \
+                    patch.object(cursor, 'rollback'), \
+                    patch('magento.Order', autospec=True) as order_mock, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+                order_api = order_mock.return_value.__enter__.return_value
+                order_api.info_multi.return_value = [fetched_order_data]
+
+                # Magento pushes the data of an order or only its id
+                entry_ids = self.Channel.push_magento_orders(
+                    [self.channel1], [order_data, {'increment_id': '100000002'}]
+                )
+
+                entries = OrderQueue.browse(entry_ids)
+                self.assertEqual(
+                    [(e.state, e.origin) for e in entries],
+                    [('done', 'push')] * 2
+                )
+                self.assertEqual(
+                    [e.sale.magento_id for e in entries], [1, 2]
+                )
+                order_api.info_multi.assert_called_once_with(['100000002'])
+
+                # Orders pushed again are not queued again
+                self.assertEqual(
+                    self.Channel.push_magento_orders(
+                        [self.channel1], [{'increment_id': '100000002'}]
+                    ), entry_ids[1:]
+                )
+                self.assertEqual(OrderQueue.search([], count=True), 2)
+                self.assertEqual(self.Sale.search([], count=True), 2)
+
+                with patch.object(
+                    self.Sale, 'create_using_magento_data',
+                    side_effect=Exception('Failed')
+                ):
+                    entry_id, = self.Channel.push_magento_orders(
+                        [self.channel1], [failing_order_data]
+                    )
+
+                entry = OrderQueue(entry_id)
+                self.assertEqual(entry.state, 'pending')
+                self.assertEqual(entry.attempts, 1)
+                self.assertTrue(entry.next_attempt > datetime.utcnow())
+                self.assertIn('Failed', entry.error)
+
+                # The entry is retried only once it is due
+                self.assertEqual(
+                    self.channel1.process_magento_order_queue(), []
+                )
+                OrderQueue.write([entry], {
+                    'next_attempt': datetime.utcnow() - relativedelta(
+                        minutes=1
+                    ),
+                })
+                sale, = self.channel1.process_magento_order_queue()
+                self.assertEqual(sale.magento_id, 3)
+                self.assertEqual(OrderQueue(entry_id).state, 'done')
+
+                # Orders failing too many times are left failed
+                self.assertEqual(OrderQueue.max_attempts, 8)
+                OrderQueue.write([entry], {
+                    'state': 'pending',
+                    'attempts': 7,
+                })
+                OrderQueue.retry_later(OrderQueue(entry_id), 'Failed')
+                self.assertEqual(OrderQueue(entry_id).state, 'failed')
+
+    def test_0090_payload_archive(self):
+        """
+        Tests that the data of orders, products, customers and categories is
+        archived and that orders and products are imported again from the
+        archive without calling magento
+        """
+        Archive = POOL.get('magento.payload.archive')
+        Party = POOL.get('party.party')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+            self.Channel.write([self.channel1], {
+                'magento_archive_payloads': True,
+            })
+
+            order_data = load_json('orders', '100000001')
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+
+                self.Sale.create_bulk_using_magento_data([order_data])
+
+            self.assertEqual(
+                Archive.load(self.channel1, 'order'),
+                {'100000001': order_data}
+            )
+            self.assertEqual(
+                sorted(Archive.load(self.channel1, 'product')),
+                ['HTC Touch Diamond', 'micronmouse5000']
+            )
+            self.assertEqual(
+                Archive.load(self.channel1, 'customer').keys(), ['2']
+            )
+            self.assertTrue(Archive.load(self.channel1, 'category'))
+
+            # Unchanged payloads are not written again
+            with patch.object(Archive, 'write') as write:
+                Archive.archive(
+                    self.channel1, 'order', {'100000001': order_data}
+                )
+                self.assertFalse(write.called)
+
+            other_order_data = load_json('orders', '100000002')
+            other_order_data['order_id'] = '2'
+            Archive.archive(
+                self.channel1, 'order', {'100000002': other_order_data}
+            )
+
+            with Transaction().set_context(company=self.company.id), \
+                    patch('magento.Order', autospec=True) as order_mock, \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                products = \
+                    self.channel1.reimport_products_from_magento_archive()
+                self.assertEqual(
+                    sorted(product.code for product in products),
+                    ['HTC Touch Diamond', 'micronmouse5000']
+                )
+
+                sale, = self.channel1.reimport_orders_from_magento_archive()
+                self.assertEqual(sale.magento_id, 2)
+                self.assertEqual(
+                    self.channel1.reimport_orders_from_magento_archive(), []
+                )
+
+                self.assertFalse(order_mock.called)
+                self.assertFalse(product_mock.called)
+                self.assertFalse(cust_mock.called)
+                self.assertFalse(category_mock.called)
+
+                # Payloads missing from the archive are not fetched
+                with Transaction().set_context({
+                    'current_channel': self.channel1.id,
+                    'magento_archive_only': True,
+                }):
+                    self.assertRaises(
+                        UserError, self.channel1.import_product, 'unknown'
+                    )
+                    self.assertRaises(
+                        UserError, Party.find_or_create_using_magento_id, 99
+                    )
+                    self.assertRaises(
+                        UserError, Party.find_or_create_all_using_magento_ids,
+                        [99]
+                    )
+                    self.assertRaises(
+                        UserError, Category.find_or_create_using_magento_id,
+                        999
+                    )
+                self.assertFalse(product_mock.called)
+                self.assertFalse(cust_mock.called)
+                self.assertFalse(category_mock.called)
+
+    def test_0100_update_order_status(self):
+        """
+        Tests that the status of sales is updated from the orders updated on
+        magento since the last update, searched by increment id
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_order_import()
+
+            order_data = load_json('orders', '100000001')
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }), \
+                    patch('magento.Product', autospec=True) as product_mock, \
+                    patch('magento.Customer', autospec=True) as cust_mock, \
+                    patch('magento.Category', autospec=True) as category_mock:
+                mock_product_api(product_mock)
+                mock_customer_api(cust_mock)
+                mock_category_api(category_mock)
+
+                sale, = self.Sale.create_bulk_using_magento_data([order_data])
+
+            self.assertFalse(self.channel1.magento_order_status_updated_at)
+            # The reference carries the order prefix of the channel
+            self.assertEqual(
+                sale.reference,
+                self.channel1.magento_order_prefix + '100000001'
+            )
+
+            with Transaction().set_context(company=self.company.id), \
+                    patch.object(
+                        self.Sale, 'update_order_status_from_magento',
+                        return_value=False
+                    ) as update_status, \
+                    patch('magento.Order', autospec=True) as order_mock:
+                order_api = order_mock.return_value.__enter__.return_value
+                # Summaries of sales_order.search only carry a few fields
+                summary = dict(
+                    (key, order_data[key]) for key in [
+                        'order_id', 'increment_id', 'store_id', 'state',
+                        'created_at', 'updated_at',
+                    ]
+                )
+                order_api.search.return_value = {
+                    'hasNext': False, 'items': [summary]
+                }
+                complete_order_data = dict(order_data, status='complete')
+                order_api.info_multi.return_value = [complete_order_data]
+
+                self.channel1.update_order_status()
+
+                filters = order_api.search.call_args[1]['filters']
+                self.assertEqual(filters, {
+                    'increment_id': {'in': ['100000001']},
+                })
+                # The per sale hook gets the full data of the order
+                order_api.info_multi.assert_called_once_with(['100000001'])
+                update_status.assert_called_once_with(
+                    order_data=complete_order_data, complete_shipments=False
+                )
+
+                updated_at = self.channel1.magento_order_status_updated_at
+                self.assertTrue(updated_at)
+
+                # Only the orders updated since the last update are searched
+                order_api.search.return_value = {
+                    'hasNext': False, 'items': []
+                }
+                self.channel1.update_order_status()
+
+                filters = order_api.search.call_args[1]['filters']
+                self.assertEqual(filters['updated_at'], {
+                    'gteq': (
+                        updated_at - relativedelta(
+                            minutes=self.channel1.magento_order_import_overlap
+                        )
+                    ).strftime('%Y-%m-%d %H:%M:%S')
+                })
+                self.assertEqual(update_status.call_count, 1)
+                self.assertEqual(order_api.info_multi.call_count, 1)
+
+                # Orders which could not be fetched are searched again by the
+                # next update
+                failed_updated_at = (
+                    datetime.utcnow() - relativedelta(hours=1)
+                ).replace(microsecond=0)
+                order_api.search.return_value = {
+                    'hasNext': False, 'items': [dict(
+                        summary, updated_at=failed_updated_at.strftime(
+                            '%Y-%m-%d %H:%M:%S'
+                        )
+                    )]
+                }
+                order_api.info_multi.return_value = [{
+                    'isFault': True,
+                    'faultCode': 1,
+                    'faultMessage': 'Internal Error',
+                }]
+                self.channel1.update_order_status()
+
+                self.assertEqual(update_status.call_count, 1)
+                self.assertEqual(
+                    self.channel1.magento_order_status_updated_at,
+                    failed_updated_at
+                )
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestChannel)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
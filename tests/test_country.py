@@ -8,6 +8,7 @@ import trytond.tests.test_tryton
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from mock import patch
 from tests.test_base import TestBase
 
 DIR = os.path.abspath(os.path.normpath(
@@ -18,6 +19,8 @@ DIR = os.path.abspath(os.path.normpath(
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
 
+from trytond.modules.magento.cache import import_cache  # noqa
+
 
 class TestCountry(TestBase):
     """
@@ -101,6 +104,59 @@ class TestCountry(TestBase):
                 None
             )
 
+    def test_0050_search_with_import_cache(self):
+        """
+        Tests that country and state lookups are cached while the import
+        cache is active and that writes invalidate the cache
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with import_cache.activate(), \
+                    patch.object(
+                        self.Subdivision, 'search',
+                        wraps=self.Subdivision.search
+                    ) as search:
+                country = self.Country.search_using_magento_code('US')
+                self.assertEqual(
+                    self.Country.search_using_magento_code('US'), country
+                )
+
+                for region in ('Florida', 'florida', 'abc', 'abc'):
+                    self.Subdivision.search_using_magento_region(
+                        region, country
+                    )
+                self.assertEqual(search.call_count, 2)
+                self.assertEqual(
+                    self.Subdivision.search_using_magento_region(
+                        'Florida', country
+                    ), self.subdivision1
+                )
+
+                # A state which was not found could be created
+                abc, = self.Subdivision.create([{
+                    'name': 'Abc',
+                    'code': 'US-ABC',
+                    'country': country.id,
+                    'type': 'state',
+                }])
+                self.assertEqual(
+                    self.Subdivision.search_using_magento_region(
+                        'abc', country
+                    ), abc
+                )
+
+                # Another country gets the code
+                self.Country.write([country], {'code': 'UM'})
+                self.Country.write([self.country2], {'code': 'US'})
+                self.assertEqual(
+                    self.Country.search_using_magento_code('US'),
+                    self.country2
+                )
+
+            # The cache is emptied at the end of the import
+            self.assertFalse(import_cache.stores)
+
 
 def suite():
     """
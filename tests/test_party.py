@@ -283,6 +283,104 @@ class TestParty(TestBase):
                 address.match_with_magento_data(load_json('addresses', '1e'))
             )
 
+    def test0050_find_address_using_fingerprint(self):
+        """
+        Tests that addresses are found with their fingerprint, which is kept
+        up to date on writes
+        """
+        Address = POOL.get('party.address')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id
+            }):
+                party = self.Party.find_or_create_using_magento_data(
+                    load_json('customers', '1')
+                )
+                address_data = load_json('addresses', '1')
+                address = Address.find_or_create_for_party_using_magento_data(
+                    party, address_data
+                )
+                self.assertEqual(
+                    address.magento_fingerprint,
+                    Address.get_magento_fingerprint_using_magento_data(
+                        address_data
+                    )
+                )
+
+                # Case and extra whitespace are ignored
+                address_data['street'] = ' TEST123 '
+                self.assertEqual(
+                    Address.find_or_create_for_party_using_magento_data(
+                        party, address_data
+                    ), address
+                )
+
+                # The fingerprint follows changes of the address
+                Address.write([address], {'street': 'new street'})
+                address_data['street'] = 'New Street'
+                self.assertEqual(
+                    Address.find_or_create_for_party_using_magento_data(
+                        party, address_data
+                    ), address
+                )
+                address_data['street'] = 'test123'
+                self.assertNotEqual(
+                    Address.find_or_create_for_party_using_magento_data(
+                        party, address_data
+                    ), address
+                )
+                self.assertEqual(len(party.addresses), 2)
+
+    def test0060_find_or_create_guest_party(self):
+        """
+        Tests that guest customers with the same email share a party on a
+        channel
+        """
+        MagentoParty = POOL.get('sale.channel.magento.party')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            guest_data = {
+                'firstname': 'Guest',
+                'lastname': 'Customer',
+                'email': 'Guest@Example.com ',
+                'customer_id': 0,
+            }
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id
+            }):
+                # A customer with the same email is not a guest
+                self.Party.find_or_create_using_magento_data(dict(
+                    guest_data, customer_id=1, email='guest@example.com'
+                ))
+
+                party = self.Party.find_or_create_guest_using_magento_data(
+                    guest_data
+                )
+                email, = party.contact_mechanisms
+                self.assertEqual(email.value, 'guest@example.com')
+                self.assertEqual(
+                    self.Party.find_or_create_guest_using_magento_data(
+                        dict(guest_data, email='guest@example.com')
+                    ), party
+                )
+
+            with Transaction().set_context({
+                'current_channel': self.channel2.id
+            }):
+                self.assertNotEqual(
+                    self.Party.find_or_create_guest_using_magento_data(
+                        guest_data
+                    ), party
+                )
+
+            self.assertEqual(MagentoParty.search([], count=True), 3)
+
 
 def suite():
     """
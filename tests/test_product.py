@@ -411,6 +411,183 @@ class TestProduct(TestBase):
                 listing.export_inventory()
                 self.assertEqual(listing.state, 'disabled')
 
+    def test_0085_export_inventory_delta(self):
+        """
+        Tests that only the listings whose inventory changed since the last
+        push are exported, unless a full push is due or forced
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+
+                category_data = load_json('categories', '17')
+                Category.create_using_magento_data(category_data)
+
+                product = Product.find_or_create_using_magento_data(
+                    load_json('products', '41')
+                )
+                listing, = product.channel_listings
+                other_product = Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+                other_listing, = other_product.channel_listings
+
+                with patch(
+                    'magento.Inventory', mock_inventory_api(), create=True
+                ) as inventory_api:
+                    update_multi = inventory_api.return_value.update_multi
+                    update_multi.side_effect = \
+                        lambda data: [True] * len(data)
+
+                    Listing.export_bulk_inventory([listing])
+
+                    update_multi.assert_called_once_with([
+                        [listing.product_identifier, {
+                            'qty': 0, 'is_in_stock': '0',
+                        }]
+                    ])
+                    listing = Listing(listing.id)
+                    self.assertEqual(listing.magento_pushed_quantity, 0)
+                    self.assertFalse(listing.magento_pushed_in_stock)
+                    self.assertTrue(listing.magento_inventory_pushed_at)
+
+                    # Exporting some listings of the channel is not a full
+                    # push, even when it is due
+                    self.assertFalse(
+                        self.channel1.magento_last_full_inventory_push
+                    )
+
+                    Listing.export_bulk_inventory([listing, other_listing])
+                    self.assertTrue(
+                        self.channel1.magento_last_full_inventory_push
+                    )
+                    # The full push sends the unchanged listing too
+                    self.assertEqual(len(update_multi.call_args[0][0]), 2)
+
+                    # Unchanged inventory is not pushed again
+                    update_multi.reset_mock()
+                    Listing.export_bulk_inventory([listing])
+                    self.assertFalse(update_multi.called)
+
+                    # Unless a full push is forced
+                    with Transaction().set_context(
+                            magento_force_inventory_export=True):
+                        Listing.export_bulk_inventory([listing])
+                    self.assertEqual(update_multi.call_count, 1)
+
+    def test_0087_export_inventory_quantities(self):
+        """
+        Tests that the inventory of the listings is computed in the
+        warehouses of their channels and pushed to magento
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Listing = POOL.get('product.product.channel_listing')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            # A second warehouse for the second channel
+            storage, input_, output = self.Location.create([{
+                'name': 'Storage 2',
+                'type': 'storage',
+            }, {
+                'name': 'Input 2',
+                'type': 'storage',
+            }, {
+                'name': 'Output 2',
+                'type': 'storage',
+            }])
+            warehouse2, = self.Location.create([{
+                'name': 'Warehouse 2',
+                'type': 'warehouse',
+                'storage_location': storage.id,
+                'input_location': input_.id,
+                'output_location': output.id,
+            }])
+            self.Channel.write([self.channel2], {'warehouse': warehouse2.id})
+            supplier, = self.Location.search([('type', '=', 'supplier')])
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                category_data = load_json('categories', '17')
+                Category.create_using_magento_data(category_data)
+
+                product = Product.find_or_create_using_magento_data(
+                    load_json('products', '41')
+                )
+                listing1, = product.channel_listings
+
+            with Transaction().set_context({
+                'current_channel': self.channel2.id,
+                'company': self.company.id,
+            }):
+                Product.find_or_create_using_magento_data(
+                    load_json('products', '41')
+                )
+                listing2, = Listing.search([
+                    ('product', '=', product.id),
+                    ('channel', '=', self.channel2.id),
+                ])
+
+            with Transaction().set_context(company=self.company.id):
+                moves = Move.create([{
+                    'product': product.id,
+                    'uom': product.default_uom.id,
+                    'quantity': quantity,
+                    'from_location': supplier.id,
+                    'to_location': to_location.id,
+                    'unit_price': Decimal('10'),
+                    'currency': self.company.currency.id,
+                    'company': self.company.id,
+                } for quantity, to_location in [
+                    (5, self.warehouse.storage_location),
+                    (3, storage),
+                ]])
+                Move.do(moves)
+
+            self.assertEqual(
+                Listing.get_magento_inventory_quantities(
+                    [listing1, listing2]
+                ),
+                {listing1.id: 5, listing2.id: 3}
+            )
+
+            with patch(
+                'magento.Inventory', mock_inventory_api(), create=True
+            ) as inventory_api:
+                update_multi = inventory_api.return_value.update_multi
+                update_multi.side_effect = lambda data: [True] * len(data)
+
+                Listing.export_bulk_inventory([listing1, listing2])
+
+                self.assertEqual(update_multi.call_count, 2)
+                update_multi.assert_any_call([
+                    [listing1.product_identifier, {
+                        'qty': 5, 'is_in_stock': '1',
+                    }]
+                ])
+                update_multi.assert_any_call([
+                    [listing2.product_identifier, {
+                        'qty': 3, 'is_in_stock': '1',
+                    }]
+                ])
+
+            self.assertEqual(Listing(listing1.id).magento_pushed_quantity, 5)
+            self.assertEqual(Listing(listing2.id).magento_pushed_quantity, 3)
+            self.assertTrue(Listing(listing2.id).magento_pushed_in_stock)
+
     def test_0090_tier_prices(self):
         """Checks the function field on product price tiers
         """
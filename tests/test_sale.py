@@ -6,7 +6,6 @@ from decimal import Decimal
 import unittest
 from datetime import datetime
 import pytz
-from dateutil.relativedelta import relativedelta
 
 import magento
 from mock import patch, MagicMock
@@ -508,7 +507,8 @@ class TestSale(TestBase):
 
     def test_0050_export_order_status_to_magento(self):
         """
-        Tests if order status is exported to magento
+        Tests that the state of done or cancelled orders is exported to
+        magento once
         """
         Sale = POOL.get('sale.sale')
         Category = POOL.get('product.category')
@@ -544,20 +544,31 @@ class TestSale(TestBase):
                         )
 
                 self.assertEqual(order.state, 'confirmed')
-
                 self.assertEqual(len(Sale.search([])), 1)
 
-                with patch('magento.Order', mock_order_api(), create=True):
-                    order_exported = \
-                        self.channel1.export_order_status()
+                order_api = mock_order_api()
+                with patch('magento.Order', order_api, create=True):
+                    # Confirmed orders are not exported
+                    self.assertEqual(self.channel1.export_order_status(), [])
 
-                    self.assertEqual(len(order_exported), 1)
-                    self.assertEqual(order_exported[0], order)
+                    Sale.write([order], {'state': 'done'})
+                    order_exported = self.channel1.export_order_status()
 
-    def test_0060_export_order_status_with_last_order_export_time_case1(self):
+                    self.assertEqual(order_exported, [order])
+                    order_api.return_value.addcomment.assert_called_once_with(
+                        '100000001', 'complete'
+                    )
+                    self.assertEqual(
+                        Sale(order.id).magento_exported_state, 'done'
+                    )
+
+                    # The state change is exported only once
+                    self.assertEqual(self.channel1.export_order_status(), [])
+
+    def test_0060_export_order_status_skips_exported_state(self):
         """
-        Tests that sale cannot be exported if last order export time is
-        greater than sale's write date
+        Tests that sales whose state is already exported are not exported
+        again
         """
         Sale = POOL.get('sale.sale')
         Category = POOL.get('product.category')
@@ -595,18 +606,15 @@ class TestSale(TestBase):
                 self.assertEqual(order.state, 'confirmed')
                 self.assertEqual(len(Sale.search([])), 1)
 
-                export_date = datetime.utcnow() + relativedelta(days=1)
-                self.channel1.last_order_export_time = export_date
-                self.channel1.save()
-
-                self.assertTrue(
-                    self.channel1.last_order_export_time > order.write_date
-                )
+                Sale.write([order], {'state': 'done'})
+                Sale.write([order], {'magento_exported_state': 'done'})
 
-                with patch('magento.Order', mock_order_api(), create=True):
+                order_api = mock_order_api()
+                with patch('magento.Order', order_api, create=True):
                     order_exported = self.channel1.export_order_status()
 
                     self.assertEqual(len(order_exported), 0)
+                    self.assertFalse(order_api.return_value.addcomment.called)
 
     def test_0050_export_shipment(self):
         """
@@ -691,6 +699,11 @@ class TestSale(TestBase):
                 SaleChannelCarrier.write([mag_carriers[0]], {
                     'carrier': carrier.id,
                 })
+                self.assertEqual(
+                    self.channel1.get_magento_carrier_mapping(), {
+                        carrier.id: mag_carriers[0].get_magento_mapping(),
+                    }
+                )
 
                 Sale.write([order], {'invoice_method': 'manual'})
                 order = Sale(order.id)
@@ -707,21 +720,228 @@ class TestSale(TestBase):
 
                 self.assertFalse(shipment.magento_increment_id)
 
+                # Only the outgoing moves are shipped, not the inventory moves
+                items_qty = {}
+                for move in shipment.outgoing_moves:
+                    if move.origin.magento_id:
+                        items_qty.setdefault(str(move.origin.magento_id), 0)
+                        items_qty[str(move.origin.magento_id)] += \
+                            move.quantity
+                self.assertEqual(
+                    self.channel1.get_magento_shipments_to_export(), [(
+                        shipment.id, order.id, '100000001', items_qty
+                    )]
+                )
+
                 with patch(
                     'magento.Shipment', mock_shipment_api(), create=True
-                ):
+                ) as shipment_api:
 
-                    self.channel1.export_shipment_status_to_magento()
+                    sales = self.channel1.export_shipment_status_to_magento()
+                    self.assertEqual(sales, [order])
 
                     shipment = Shipment(shipment.id)
                     self.assertTrue(shipment.magento_increment_id)
+                    self.assertEqual(
+                        shipment_api.return_value.create.call_count, 1
+                    )
+
+                    # Exported shipments are not selected again
+                    self.assertEqual(
+                        self.channel1.export_shipment_status_to_magento(), []
+                    )
+                    self.assertEqual(
+                        shipment_api.return_value.create.call_count, 1
+                    )
+
+    def test_0055_export_tracking_info_in_bulk(self):
+        """
+        Tests that the tracks of shipments are added to magento with
+        multicalls and that the shipments whose tracks are added are flagged
+        with a single write
+        """
+        Party = POOL.get('party.party')
+        Carrier = POOL.get('carrier')
+        ProductTemplate = POOL.get('product.template')
+        SaleChannelCarrier = POOL.get('sale.channel.carrier')
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            party, = Party.create([{
+                'name': 'Carrier and Customer',
+                'addresses': [('create', [{'name': 'Carrier and Customer'}])],
+            }])
+            product, = ProductTemplate.create([{
+                'name': 'Shipping product',
+                'type': 'service',
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'default_uom': self.uom.id,
+                'sale_uom': self.uom.id,
+                'products': [('create', [{
+                    'code': 'code',
+                    'list_price': Decimal('100'),
+                    'cost_price': Decimal('1'),
+                }])]
+            }])
+            mapped_carrier, other_carrier = Carrier.create([{
+                'party': party.id,
+                'carrier_product': product.products[0].id,
+            }] * 2)
+            mag_carrier, = SaleChannelCarrier.create([{
+                'name': 'Flat Rate',
+                'code': 'flatrate_flatrate',
+                'channel': self.channel1.id,
+                'carrier': mapped_carrier.id,
+            }])
+
+            with Transaction().set_context(company=self.company.id):
+                shipments = Shipment.create([{
+                    'customer': party.id,
+                    'delivery_address': party.addresses[0].id,
+                    'warehouse': self.warehouse.id,
+                    'magento_increment_id': '20000000%d' % index,
+                } for index in range(1, 5)])
+            for shipment, carrier, tracking_number in zip(shipments, [
+                mapped_carrier, other_carrier, other_carrier, other_carrier,
+            ], ['T1', 'T2', 'T3', None]):
+                shipment.carrier = carrier
+                shipment.tracking_number = tracking_number
+
+            with Transaction().set_context(
+                    current_channel=self.channel1.id), \
+                    patch.object(
+                        Shipment, 'write', wraps=Shipment.write
+                    ) as write, \
+                    patch(
+                        'magento.Shipment', mock_shipment_api(), create=True
+                    ) as shipment_api:
+                multicall = shipment_api.return_value.multiCall
+                multicall.side_effect = [
+                    [1, {
+                        'isFault': True,
+                        'faultCode': 100,
+                        'faultMessage': 'Requested shipment not exists.',
+                    }],
+                    [3],
+                ]
+
+                results = Shipment.export_tracking_info_to_magento_in_bulk(
+                    shipments, batch_size=2
+                )
+
+                code, title = mag_carrier.get_magento_mapping()
+                self.assertEqual(multicall.call_args_list, [
+                    ((
+                        [
+                            ['sales_order_shipment.addTrack', [
+                                '200000001', code, title, 'T1'
+                            ]],
+                            ['sales_order_shipment.addTrack', [
+                                '200000002', 'custom', other_carrier.rec_name,
+                                'T2'
+                            ]],
+                        ],
+                    ), {}),
+                    ((
+                        [
+                            ['sales_order_shipment.addTrack', [
+                                '200000003', 'custom', other_carrier.rec_name,
+                                'T3'
+                            ]],
+                        ],
+                    ), {}),
+                ])
+                self.assertEqual(
+                    results, {shipments[0].id: 1, shipments[2].id: 3}
+                )
+                self.assertEqual(write.call_count, 1)
+
+            self.assertEqual([
+                shipment.is_tracking_exported_to_magento
+                for shipment in Shipment.browse(map(int, shipments))
+            ], [True, False, True, False])
+
+    def test_0065_complete_shipments_from_magento(self):
+        """
+        Tests that the shipments of sales completed on magento are processed
+        to done with a single call per transition
+        """
+        Sale = POOL.get('sale.sale')
+        Shipment = POOL.get('stock.shipment.out')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.import_order_states(self.channel1)
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                orders = []
+                orders_data = []
+                for order_id, increment_id in [
+                        ('1', '100000001'), ('2', '100000002')]:
+                    order_data = load_json('orders', increment_id)
+                    order_data['order_id'] = order_id
+                    orders_data.append(order_data)
+
+                    with patch(
+                            'magento.Customer', mock_customer_api(),
+                            create=True):
+                        self.Party.find_or_create_using_magento_id(
+                            order_data['customer_id']
+                        )
+
+                    with Transaction().set_context(company=self.company):
+                        with patch(
+                                'magento.Product', mock_product_api(),
+                                create=True):
+                            orders.append(
+                                Sale.find_or_create_using_magento_data(
+                                    order_data
+                                )
+                            )
 
-    def test_0070_export_order_status_with_last_order_export_time_case2(self):
+                Sale.write(orders, {'invoice_method': 'manual'})
+                orders = Sale.browse(map(int, orders))
+                with Transaction().set_user(0, set_context=True):
+                    Sale.process(orders)
+
+                shipments = Shipment.search([])
+                self.assertEqual(len(shipments), 2)
+
+                with patch.object(
+                    Shipment, 'pack', wraps=Shipment.pack
+                ) as pack, patch.object(
+                    Shipment, 'done', wraps=Shipment.done
+                ) as done:
+                    Sale.update_order_status_from_magento_in_bulk([
+                        (order, dict(order_data, status='complete'))
+                        for order, order_data in zip(orders, orders_data)
+                    ])
+
+                    self.assertEqual(pack.call_count, 1)
+                    self.assertEqual(done.call_count, 1)
+
+                self.assertEqual(
+                    set(shipment.state for shipment in Shipment.search([])),
+                    set(['done'])
+                )
+
+    def test_0070_order_state_journal(self):
         """
-        Tests that sale can be exported if last order export time is
-        smaller than sale's write date
+        Tests that only the transitions of sales to the exported states are
+        recorded in the state journal
         """
         Sale = POOL.get('sale.sale')
+        Journal = POOL.get('magento.order.state_journal')
         Category = POOL.get('product.category')
 
         with Transaction().start(DB_NAME, USER, CONTEXT):
@@ -757,20 +977,44 @@ class TestSale(TestBase):
                 self.assertEqual(order.state, 'confirmed')
                 self.assertEqual(len(Sale.search([])), 1)
 
-                export_date = datetime.utcnow() - relativedelta(days=1)
-                self.Channel.write([self.channel1], {
-                    'last_order_export_time': export_date
-                })
+                # Confirming the order is not journaled
+                self.assertEqual(Journal.search([], count=True), 0)
 
-                self.assertTrue(
-                    self.channel1.last_order_export_time < order.write_date
-                )
+                Sale.write([order], {'state': 'done'})
+                Sale.write([order], {'state': 'done'})
+
+                entry, = Journal.search([])
+                self.assertEqual(entry.sale, order)
+                self.assertEqual(entry.channel, self.channel1)
+                self.assertEqual(entry.state, 'done')
 
                 with patch('magento.Order', mock_order_api(), create=True):
-                    order_exported = self.channel1.export_order_status()
+                    order_exported = self.channel1.export_order_status(
+                        batch_size=1
+                    )
 
-                    self.assertEqual(len(order_exported), 1)
-                    self.assertEqual(order_exported[0], order)
+                    self.assertEqual(order_exported, [order])
+                    self.assertEqual(Journal.search([], count=True), 0)
+
+                # States which come from magento are not sent back to it
+                past_order_data = load_json('orders', '100000002')
+                past_order_data.update({'order_id': '2', 'state': 'complete'})
+                with Transaction().set_context(company=self.company):
+                    with patch(
+                            'magento.Product', mock_product_api(), create=True):
+                        past_order = Sale.find_or_create_using_magento_data(
+                            past_order_data
+                        )
+                self.assertEqual(past_order.state, 'done')
+                self.assertEqual(past_order.magento_exported_state, 'done')
+
+                with Transaction().set_context(
+                        magento_state_from_channel=True):
+                    Sale.write([past_order], {'state': 'cancel'})
+                self.assertEqual(
+                    Sale(past_order.id).magento_exported_state, 'cancel'
+                )
+                self.assertEqual(Journal.search([], count=True), 0)
 
     def test_0080_import_sale_order_with_bundle_product(self):
         """
@@ -893,6 +1137,120 @@ class TestSale(TestBase):
                 # virtual product is ignored
                 self.assertEqual(len(product.boms[0].bom.inputs), 1)
 
+    def test_0095_find_bom_using_magento_signature(self):
+        """
+        Tests that the BoM of a bundle is found with its signature
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        Bom = POOL.get('production.bom')
+        BomInput = POOL.get('production.bom.input')
+
+        self.assertEqual(
+            Bom.get_magento_signature([(1, 0.1 + 0.2), (2, 1)]),
+            Bom.get_magento_signature([(2, 1.0), (1, 0.3)])
+        )
+        self.assertEqual(
+            Bom.get_magento_signature([(1, 0.1), (1, 0.2)]),
+            Bom.get_magento_signature([(1, 0.3)])
+        )
+        self.assertNotEqual(
+            Bom.get_magento_signature([(1, 0.3)]),
+            Bom.get_magento_signature([(1, 0.4)])
+        )
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+                order_data = load_json('orders', '300000001')
+
+                with patch(
+                        'magento.Customer', mock_customer_api(), create=True):
+                    self.Party.find_or_create_using_magento_id(
+                        order_data['customer_id']
+                    )
+
+                with Transaction().set_context({'company': self.company.id}):
+                    with patch(
+                        'magento.Product', mock_product_api(), create=True
+                    ):
+                        Sale.find_or_create_using_magento_data(order_data)
+
+                    product = self.channel1.import_product('VGN-TXN27N-BW')
+                    product_bom, = product.boms
+                    bom = product_bom.bom
+                    self.assertEqual(
+                        bom.magento_signature,
+                        Bom.get_magento_signature([
+                            (input.product.id, input.quantity)
+                            for input in bom.inputs
+                        ])
+                    )
+
+                    self.assertEqual(
+                        Bom.find_or_create_bom_for_magento_bundle(order_data),
+                        product_bom
+                    )
+
+                    # BoMs without a signature get one when looked up
+                    Bom.write([bom], {'magento_signature': None})
+                    self.assertEqual(
+                        Bom.find_or_create_bom_for_magento_bundle(order_data),
+                        product_bom
+                    )
+                    self.assertTrue(Bom(bom.id).magento_signature)
+                    self.assertEqual(len(product.boms), 1)
+
+                    # The signature follows changes of the inputs
+                    input, = bom.inputs
+                    Bom.write([bom], {
+                        'inputs': [('write', [input.id], {'quantity': 2})],
+                    })
+                    self.assertNotEqual(
+                        Bom(bom.id).magento_signature, bom.magento_signature
+                    )
+
+                    # And so it does when the inputs are changed directly
+                    def inputs_signature(bom):
+                        return Bom.get_magento_signature([
+                            (input.product.id, input.quantity)
+                            for input in bom.inputs
+                        ])
+
+                    BomInput.write([input], {'quantity': 3})
+                    bom = Bom(bom.id)
+                    self.assertEqual(
+                        bom.magento_signature, inputs_signature(bom)
+                    )
+
+                    BomInput.create([{
+                        'bom': bom.id,
+                        'uom': input.uom.id,
+                        'product': input.product.id,
+                        'quantity': 1,
+                    }])
+                    bom = Bom(bom.id)
+                    self.assertEqual(len(bom.inputs), 2)
+                    self.assertEqual(
+                        bom.magento_signature, inputs_signature(bom)
+                    )
+
+                    BomInput.delete([input])
+                    bom = Bom(bom.id)
+                    self.assertEqual(
+                        bom.magento_signature, inputs_signature(bom)
+                    )
+
     def test_0100_import_sale_with_bundle_plus_child_separate(self):
         """
         Tests import of sale order with bundle product using magento data
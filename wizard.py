@@ -203,10 +203,7 @@ class ConfigureMagento(Wizard):
         """
         magento_channel = self.start.channel
 
-        with Core(
-            magento_channel.magento_url, magento_channel.magento_api_user,
-            magento_channel.magento_api_key
-        ) as core_api:
+        with magento_channel.get_magento_api(Core) as core_api:
             websites = core_api.websites()
 
         selection = []
@@ -231,10 +228,7 @@ class ConfigureMagento(Wizard):
 
         selected_website = json.loads(self.import_website.magento_websites)
 
-        with Core(
-            magento_channel.magento_url, magento_channel.magento_api_user,
-            magento_channel.magento_api_key
-        ) as core_api:
+        with magento_channel.get_magento_api(Core) as core_api:
             stores = core_api.stores(selected_website['id'])
 
         all_stores = []
@@ -406,10 +400,8 @@ class ExportDataWizardConfigure(ModelView):
         channel = Channel(Transaction().context['active_id'])
         channel.validate_magento_channel()
 
-        with magento.ProductAttributeSet(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as attribute_set_api:
+        with channel.get_magento_api(
+                magento.ProductAttributeSet) as attribute_set_api:
             attribute_sets = attribute_set_api.list()
 
         return [(